@@ -1,12 +1,14 @@
 import express from 'express';
 
-import { getTotalDocumentCount, getTopicsAndAssociatedDocuments, getDocumentCoords }  from './db_functions.js';
-import { publishString  } from './redis_functions.js';
+import { getTotalDocumentCount, getTopicsAndAssociatedDocuments, getDocumentCoords, getRecentStageRuns, getStageTotals, getSweepResults }  from './db_functions.js';
+import { publishString, publishJob, getQueueStatus } from './redis_functions.js';
 
 const app = express();
 app.set( 'view engine' , 'ejs' );
 app.set( 'views', './views'); // optional, this is the default
 const port = 3000;
+// most map points /api/coords sends at once
+const COORDS_MAX_POINTS = parseInt(process.env.COORDS_MAX_POINTS || '20000', 10);
 
 app.use((req, res, next) => {
   console.log(`📥 ${new Date().toISOString()} - ${req.method} ${req.url}`);
@@ -14,41 +16,118 @@ app.use((req, res, next) => {
 });
 
 app.get('/', async (req, res) => {
+  // the page fetches the map from /api/coords
   res.render('index', { 
-    chartData : await getDocumentCoords(),
     count: await getTotalDocumentCount(),
     topicData: await getTopicsAndAssociatedDocuments()
   });
 });
 
-app.get('/load_docs', async (req, res) => {
-  await publishString( 'process_pdfs');
-  res.send(`Message pushed to redis`);
+// Map points as columns, ?x0=&x1=&y0=&y1= for a viewport and ?limit= for the most points to send (sampled above it).
+// res.json sets a weak ETag, so an unchanged map is answered with 304
+app.get('/api/coords', async (req, res) => {
+  const names = ['x0', 'x1', 'y0', 'y1'];
+  const given = names.some(name => req.query[name] !== undefined);
+  const bounds = names.map(name => req.query[name] === undefined ? NaN : Number(req.query[name]));
+  if (given && bounds.some(Number.isNaN)) {
+    res.status(400).json({ error : 'a viewport needs numeric x0, x1, y0 and y1' });
+    return;
+  }
+  const viewport = given ? { x0 : bounds[0], x1 : bounds[1], y0 : bounds[2], y1 : bounds[3] } : null;
+  const limit = Math.min(Math.max(parseInt(req.query.limit, 10) || COORDS_MAX_POINTS, 1), COORDS_MAX_POINTS);
+  const coords = await getDocumentCoords(viewport, limit);
+  if (coords === null) {
+    res.status(500).json({ error : 'could not load the coordinates' });
+    return;
+  }
+  res.set('Cache-Control', 'no-cache').json(coords);
 });
 
-app.get( '/embed_docs', async ( req, res ) => {
-  await publishString( 'embed_pdfs');
-  res.send(`messages pushed to redis`);
-});
+// Query parameters are passed on as task params: the worker checks them against the task's typed keyword
+// arguments (see task_params in nlp_pipeline/jobs.py), converts them and dead-letters a job with unknown names
+// or values that do not convert. e.g. /embed_docs?chunk_strategy=sentences&chunk_size=800, /umap?n_neighbors=30
+function taskParams( query ) {
+  return { ...query };
+}
 
-app.get( '/umap', async ( req, res ) => {
-  await publishString( 'umap');
-  res.send(`Message pushed to redis`);
-});
+async function publishTask( task, req, res ) {
+  const id = await publishJob( task, taskParams( req.query ) );
+  res.send(`Message pushed to redis (job ${id})`);
+}
+
+app.get('/load_docs', async (req, res) => publishTask( 'process_pdfs', req, res ));
+
+app.get( '/embed_docs', async ( req, res ) => publishTask( 'embed_pdfs', req, res ));
+
+// Refits projection and topics; ?sample_size=, ?threads=, ?memory_mb= and ?pca_components= tune the large corpus path,
+// ?n_neighbors=, ?min_dist=, ?min_cluster_size= and ?min_samples= the fit itself
+app.get( '/umap', async ( req, res ) => publishTask( 'umap', req, res ));
+
+app.get( '/umap_incremental', async ( req, res ) => publishTask( 'umap_incremental', req, res ));
 
 app.get( '/topics', async ( req, res ) => {
   await publishString( 'topics');
   res.send(`Message pushed to redis`);
 });
 
-app.get( '/terms', async ( req, res ) => {
-  await publishString( 'terms');
-  res.send(`Message pushed to redis`);
+// Renders topic_map.png from the stored coordinates, ?dpi=, ?max_labels= and ?density_threshold= override the defaults
+app.get( '/render_map', async ( req, res ) => publishTask( 'render_map', req, res ));
+
+// ?force=1 rebuilds the indexes even when their delta is small
+app.get( '/ann_index', async ( req, res ) => publishTask( 'ann_index', req, res ));
+
+app.get( '/terms', async ( req, res ) => publishTask( 'terms', req, res ));
+
+// ?mode=full|incremental, ?engine=sql|python, ?weighting=, ?top_k=
+app.get( '/tf_idf', async ( req, res ) => publishTask( 'tf_idf', req, res ));
+
+// Runs the whole pipeline (or ?stages=embed_pdfs,umap_incremental,...), each stage starts once the ones it depends on are done.
+// <stage>.<param>=value sets a stage parameter for this run, e.g. ?umap_incremental.drift_threshold=0.3&embed_pdfs.chunk_size=128
+app.get( '/pipeline', async ( req, res ) => {
+  const params = {};
+  const stageParams = {};
+  for (const [key, value] of Object.entries(req.query)) {
+    if (key === 'stages') {
+      params.stages = String(value).split(',').map(s => s.trim()).filter(s => s.length > 0);
+    } else if (key.includes('.')) {
+      const [stage, name] = key.split('.', 2);
+      stageParams[stage] = { ...stageParams[stage], [name]: value };
+    }
+  }
+  if (Object.keys(stageParams).length > 0) {
+    params.stage_params = stageParams;
+  }
+  await publishJob( 'pipeline', params );
+  res.send(`Pipeline pushed to redis`);
 });
 
-app.get( '/tf_idf', async ( req, res ) => {
-  await publishString( 'tf_idf');
-  res.send(`Message pushed to redis`);
+// Parameter sweep: every query parameter is a comma separated list of values, each combination is evaluated as its
+// own job on any worker without touching the stored results, e.g.
+// /sweep?n_neighbors=10,15,30&min_cluster_size=2,5 (UMAP/HDBSCAN) or /sweep?chunk_strategy=tokens,sentences&chunk_size=128,256
+app.get( '/sweep', async ( req, res ) => {
+  if (Object.keys(req.query).length === 0) {
+    res.status(400).send('Pass the parameter values to sweep, e.g. /sweep?n_neighbors=10,15,30');
+    return;
+  }
+  const id = await publishJob( 'sweep', { grid : taskParams( req.query ) } );
+  res.send(`Sweep pushed to redis, results at /sweep/${id}`);
+});
+
+// Timing and quality of every evaluated variant of a sweep
+app.get( '/sweep/:id', async ( req, res ) => {
+  res.json( await getSweepResults( req.params.id ) );
+});
+
+// Live progress from redis and timing history from pipeline_runs, ?run_id=... for the totals of another run
+app.get( '/status', async ( req, res ) => {
+  const queue = await getQueueStatus();
+  const runId = req.query.run_id || (queue.pipelines.length > 0 ? queue.pipelines[0].run_id : null);
+  res.json({
+    ...queue,
+    run_id : runId,
+    stages : runId ? await getStageTotals(runId) : [],
+    recent : await getRecentStageRuns()
+  });
 });
 
 app.listen(port, () => {
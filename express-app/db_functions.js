@@ -52,91 +52,103 @@ async function getTopicsAndAssociatedDocuments() {
 
 }
 
-async function getTopicDocumentMapping() { 
-  try  {
-    let sql = "select document_id , topic_id from document_topics ";
-    let data = {};
-    const topicResult = await client.query( sql );
-    for( var i = 0; i < topicResult.rows.length; i++ ){
-      let element = topicResult.rows[i];
-      let doc_id = element['document_id' ];
-      let topic_id = element['topic_id' ];
-      data[doc_id] = topic_id;
-      //data.element['document_id'] = element['topic_id'];
+// Map points as columns, the same shape as the dashboard's /api/coords JSON: ids, x, y, topics (-1 without one),
+// marker sizes scaled from documents.char_length and titles. With a viewport { x0, x1, y0, y1 } only the points inside
+// it are returned, and above limit points a sample of them: the points are ordered by a fixed hash of their id, so
+// zooming in only ever adds points to the ones already shown.
+async function getDocumentCoords(viewport = null, limit = 20000) {
+  try {
+    const params = [limit];
+    let where = '';
+    if (viewport) {
+      params.push(viewport.x0, viewport.x1, viewport.y0, viewport.y1);
+      where = 'WHERE dc.x BETWEEN $2 AND $3 AND dc.y BETWEEN $4 AND $5';
     }
-    return data;
-  } catch ( err ) {
-    console.error( 'Error executing select: ', err.stack );
+    const result = await client.query(
+      `WITH bounds AS (
+         SELECT MIN(COALESCE(d.char_length, 0)) AS min_size, MAX(COALESCE(d.char_length, 0)) AS max_size
+         FROM doc_coords dc JOIN documents d ON d.id = dc.document_id
+       )
+       SELECT d.id, dc.x, dc.y, COALESCE(dt.topic_id, -1) AS topic_id, COALESCE(d.char_length, 0) AS size,
+              SUBSTRING(d.title FROM 1 FOR 20) AS title, b.min_size, b.max_size, COUNT(*) OVER () AS total
+       FROM doc_coords dc
+       JOIN documents d ON d.id = dc.document_id
+       LEFT JOIN document_topics dt ON dt.document_id = dc.document_id
+       CROSS JOIN bounds b
+       ${where}
+       ORDER BY (d.id::bigint * 2654435761) % 4294967296
+       LIMIT $1`,
+      params
+    );
+    const rows = result.rows;
+    // 5 plus the length over a 40th of the length range of the whole map
+    const scale = rows.length ? (rows[0].max_size - rows[0].min_size) / 40 : 0;
+    return {
+      total: rows.length ? Number(rows[0].total) : 0,
+      count: rows.length,
+      ids: rows.map(row => row.id),
+      x: rows.map(row => row.x),
+      y: rows.map(row => row.y),
+      topics: rows.map(row => row.topic_id),
+      sizes: rows.map(row => scale ? 5 + row.size / scale : 20),
+      labels: rows.map(row => row.title)
+    };
+  } catch (err) {
+    console.error('Error executing select: ', err.stack);
+    return null;
   }
 }
 
-
-async function getDocumentCoords() {
+async function getRecentStageRuns(limit = 50) {
   try {
+    const result = await client.query(
+      `SELECT run_id, stage, worker_id, status, started_at, finished_at, wall_seconds, db_seconds, compute_seconds,
+              documents, chunks, docs_per_second, chunks_per_second, peak_rss_mb, children_peak_rss_mb, error, params, quality
+       FROM pipeline_runs ORDER BY started_at DESC LIMIT $1`,
+      [limit]
+    );
+    return result.rows;
+  } catch (err) {
+    console.error('Error executing select: ', err.stack);
+    return [];
+  }
+}
 
-    // The data is coming out of the model , and will go into db, like this 
-    // let data =  [
-    //       {id :   1730,  x  :   -2.5284564, y  :    -2.507452, t_id  :   13 },
-    //       {id :   1731,  x  :   -3.067392,  y  :    -2.27532,  t_id  :   -1 },
-    //       {id :   1732,  x  :   3.50704,    y  :    1.6525944, t_id  :   1 },
-    //       {id :   1733,  x  :   7.276127,   y  :    2.7509475, t_id  :   4 },
-
-    // ];
-
-    const topicData = await getTopicDocumentMapping();
-    let data = [];
-    const coordResult = await client.query(" select d.id as document_id,  substring( d.title from 1 for 20 )  as title, x, y, length( d.raw_text ) as size from doc_coords dc, documents d where  d.id = dc.document_id " );
-    if( coordResult.rows.length > 0 ) 
-      data = coordResult.rows;
-
-    const colors= [ 'AliceBlue', 'Azure', 'Bisque', 'CadetBlue', 'BurlyWood', 'Coral','DarkCyan',
-      'DarkKhaki', 'DarkOrange','DarkSlateBlue', 
-    
-      'Yellow', 'Violet','SteelBlue', 'Tan', 'Teal','SpringGreen', 
-      'SlateGrey', 'Thistle','Tomato', 'Salmon', 'SandyBrown','SeaGreen' 
-    ];
-
-    //TODO make it also grab length( d.raw_text ) as size in above sql , push that to a new data element called sizes : []
-    // later in the express template tell plotly to use that sizes for the sizes. normalize in this method if needed. 
-    let ref_colors = [];
-    let plotData = { x : [], y : [] , labels : [], originalSizes : [], sizes : [] , colors : [] } ;
-
-
-    // this is the format that plotly.js expects it for a scatter plot. 
-    for( var i = 0; i < data.length; i++ ){
-      let element = data[i];
-      const doc_id = element.document_id;
-      plotData.x.push( element.x );
-      plotData.y.push( element.y );
-      plotData.labels.push( element.title );
-      plotData.originalSizes.push( element.size  );
-      
-      plotData.colors.push(  colors[ topicData[doc_id] % colors.length]  );
-    }
-
-
-    // find min, max
-    // edit the size to be w/in range 20 - 60 via scale factor
-    let min = 0, max = 0;
-    for( var i = 0; i < plotData.originalSizes.length; i++ ){
-      let s = plotData.originalSizes[i];
-      if( min == 0 || s <= min ){ min  = s;}
-      if( max == 0 || s >= max ){ max = s; }
-    }
-    // // want to map ( max - min ) onto ( 50  - 10 ), and have a scale factor. 
-    let scale = ( max - min ) / ( 50 - 10 );
-
-    for( var i = 0; i < plotData.originalSizes.length; i++ ){
-      plotData.sizes.push( 5 + ( plotData.originalSizes[i] /  scale ) );
-
-    }
-
-    return plotData;
-
+// Per stage totals of one pipeline run, sub-tasks of a fanned out stage added up
+async function getStageTotals(runId) {
+  try {
+    const result = await client.query(
+      `SELECT stage, COUNT(*) AS tasks, MIN(started_at) AS started_at, MAX(finished_at) AS finished_at,
+              EXTRACT(EPOCH FROM MAX(finished_at) - MIN(started_at)) AS elapsed_seconds,
+              SUM(wall_seconds) AS wall_seconds, SUM(db_seconds) AS db_seconds, SUM(compute_seconds) AS compute_seconds,
+              SUM(documents) AS documents, SUM(chunks) AS chunks, MAX(peak_rss_mb) AS peak_rss_mb,
+              COUNT(*) FILTER (WHERE status = 'failed') AS failed
+       FROM pipeline_runs WHERE run_id = $1
+       GROUP BY stage ORDER BY MIN(started_at)`,
+      [runId]
+    );
+    return result.rows;
   } catch (err) {
     console.error('Error executing select: ', err.stack);
+    return [];
   }
+}
 
+// Evaluated variants of a parameter sweep with their settings, timing and quality measures
+async function getSweepResults(runId) {
+  try {
+    const result = await client.query(
+      `SELECT stage, worker_id, status, params, quality, wall_seconds, compute_seconds, documents, chunks,
+              peak_rss_mb, error
+       FROM pipeline_runs WHERE run_id = $1 AND stage <> 'sweep'
+       ORDER BY stage, started_at`,
+      [runId]
+    );
+    return result.rows;
+  } catch (err) {
+    console.error('Error executing select: ', err.stack);
+    return [];
+  }
 }
 
-export { client, getTotalDocumentCount, getTopicsAndAssociatedDocuments, getDocumentCoords};
+export { client, getTotalDocumentCount, getTopicsAndAssociatedDocuments, getDocumentCoords, getRecentStageRuns, getStageTotals, getSweepResults };
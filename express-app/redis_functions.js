@@ -1,7 +1,45 @@
 import Redis from 'ioredis';
+import { randomUUID } from 'crypto';
 const redis = new Redis( process.env.REDIS_URL );
 const queueName = process.env.QUEUE_NAME || 'python_tasks';
 
-async function publishString(s){ await redis.lpush(queueName, JSON.stringify({ task : s }));}
+// Same envelope the python worker's JobQueue builds, params are passed to the task as keyword arguments
+async function publishJob(task, params = {}){
+  const job = { id : randomUUID(), task : task, params : params, attempts : 0 };
+  await redis.lpush(queueName, JSON.stringify(job));
+  return job.id;
+}
 
-export { publishString };
\ No newline at end of file
+async function publishString(s){ return publishJob(s); }
+
+// Queue lengths, what every worker is running right now and the state of the latest pipelines
+async function getQueueStatus(pipelineCount = 10){
+  const processing = {};
+  for (const key of await redis.keys(`${queueName}:processing:*`)) {
+    processing[key.slice(`${queueName}:processing:`.length)] = await redis.llen(key);
+  }
+
+  const running = [];
+  const status = await redis.hgetall(`${queueName}:status`);
+  for (const [worker, value] of Object.entries(status)) {
+    running.push({ worker, ...JSON.parse(value) });
+  }
+
+  const pipelines = [];
+  for (const runId of await redis.zrevrange('pipelines', 0, pipelineCount - 1)) {
+    const run = await redis.hgetall(`pipeline:${runId}`);
+    if (Object.keys(run).length > 0) {
+      pipelines.push({ run_id : runId, ...run });
+    }
+  }
+
+  return {
+    queued : await redis.llen(queueName),
+    dead : await redis.llen(`${queueName}:dead`),
+    processing,
+    running,
+    pipelines
+  };
+}
+
+export { publishString, publishJob, getQueueStatus };
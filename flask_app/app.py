@@ -1,179 +1,374 @@
-from flask import Flask, jsonify, render_template
+from flask import Flask, jsonify, render_template, request
 import os
-import psycopg2
+import sys
+import time
+import gzip
+import struct
+import threading
+import json
+import urllib.error
+import urllib.parse
+import urllib.request
+from array import array
+from contextlib import contextmanager
+import psycopg2.errors
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
 import datetime
 
 
 app = Flask(__name__)
 
+DB_CONFIG = {
+    "host": os.getenv('DB_HOST', 'postgres'), # The name of your postgres service in docker-compose
+    "port": int(os.getenv('DB_PORT', '5432')),
+    "database": os.getenv('DB_NAME', 'second_brain'),
+    "user": os.getenv('DB_USER', 'postgres'),
+    "password": os.getenv('DB_PASSWORD', 'test_case')
+}
+# connections kept open by the pool, a request waits for a free one beyond DB_POOL_MAX concurrent queries
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+# dashboard payloads are cached until the worker bumps pipeline_state.version, which is read at most this often
+VERSION_CHECK_INTERVAL = float(os.getenv('VERSION_CHECK_INTERVAL', '1'))
+# the nlp_pipeline search service answering similarity queries from its ANN indexes
+SEARCH_URL = os.getenv('SEARCH_URL', 'http://search:8001')
+SEARCH_TIMEOUT = float(os.getenv('SEARCH_TIMEOUT', '5'))
+# most map points /api/coords sends at once, more than that in the viewport are sampled
+COORDS_MAX_POINTS = int(os.getenv('COORDS_MAX_POINTS', '20000'))
+# smaller responses are not worth compressing
+GZIP_MIN_BYTES = 1024
+# /api/coords?format=binary: magic, format version, points sent, points in the viewport
+COORDS_MAGIC = b'TPTS'
+COORDS_VERSION = 1
+COORDS_HEADER = struct.Struct('<4sIII')
 
+_pool = None
+_pool_lock = threading.Lock()
+_pool_slots = None
+
+
+def get_pool():
+    global _pool, _pool_slots
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+                _pool = ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, **DB_CONFIG)
+    return _pool
+
+
+@contextmanager
 def get_db_connection():
-    # Use environment variables or hardcode the service name from docker-compose.yml
-    conn = psycopg2.connect(
-        host='postgres', # The name of your postgres service in docker-compose
-        database='second_brain',
-        user='postgres',
-        password='test_case'
-    )
-    return conn
-
-@app.route("/document/<id>")
+    """Borrow a pooled connection, the transaction is committed (or rolled back) before it goes back"""
+    pool = get_pool()
+    # ThreadedConnectionPool raises once every connection is in use, wait for one instead
+    with _pool_slots:
+        conn = pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            pool.putconn(conn, close=conn.closed != 0)
+
+
+class PayloadCache:
+    """Dashboard payloads keyed by name, dropped as soon as pipeline_state.version changes"""
+
+    def __init__(self, check_interval=VERSION_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self.version = None
+        self.checked_at = 0.0
+        self.payloads = {}
+        self.lock = threading.Lock()
+        self.loading = {}
+
+    def current_version(self):
+        now = time.monotonic()
+        if self.version is None or now - self.checked_at > self.check_interval:
+            try:
+                with get_db_connection() as conn, conn.cursor() as cur:
+                    cur.execute("SELECT version FROM pipeline_state")
+                    row = cur.fetchone()
+            except psycopg2.errors.UndefinedTable:
+                # the worker has not applied its migrations yet, serve uncached
+                return None
+            version = row[0] if row else 0
+            with self.lock:
+                if version != self.version:
+                    self.payloads.clear()
+                    self.version = version
+                self.checked_at = now
+        return self.version
+
+    def get(self, name, loader):
+        version = self.current_version()
+        if version is None:
+            return loader()
+        with self.lock:
+            if name in self.payloads:
+                return self.payloads[name]
+            # one request loads a payload, concurrent requests for it wait for that result
+            load_lock = self.loading.setdefault(name, threading.Lock())
+        with load_lock:
+            with self.lock:
+                if name in self.payloads:
+                    return self.payloads[name]
+            payload = loader()
+            with self.lock:
+                if self.version == version and payload is not None:
+                    self.payloads[name] = payload
+            return payload
+
+
+payload_cache = PayloadCache()
+
+
+@app.route("/document/<int:id>")
 def document_by_id( id ):
-    sql = f" select id, file_path, left(  d.raw_text, 20000 ) || ' ...'  as preview , length( raw_text ) as len , embedding is null as embedded from documents d where d.id = {id}"
-    
-    con = get_db_connection()
-    curr = con.cursor( cursor_factory=RealDictCursor)
-    curr.execute( sql )
-    doc_data = curr.fetchall()
-    curr.close()
-    con.close()
+    # substr only detoasts the first 20000 characters, the length comes from the precomputed metadata columns
+    sql = " select id, file_path, substr(  d.raw_text, 1, 20000 ) || ' ...'  as preview , d.char_length as len , d.page_count, d.byte_size, embedding is null as embedded from documents d where d.id = %s"
+
+    with get_db_connection() as con, con.cursor( cursor_factory=RealDictCursor) as curr:
+        curr.execute( sql, ( id, ) )
+        doc_data = curr.fetchall()
     return render_template( 'document.html', id=id, doc_data=doc_data )
 
 
+def query_search_service(path, **params):
+    url = f"{SEARCH_URL}{path}?{urllib.parse.urlencode(params)}"
+    try:
+        with urllib.request.urlopen(url, timeout=SEARCH_TIMEOUT) as response:
+            return 200, json.load(response)
+    except urllib.error.HTTPError as e:
+        try:
+            return e.code, json.load(e)
+        except ValueError:
+            # an error page from a proxy in between, not an answer of the search service
+            app.logger.info(f"Search service returned {e.code} without a JSON body")
+            return 502, {'error': 'bad response from the search service'}
+    except (urllib.error.URLError, OSError) as e:
+        app.logger.info(f"Search service unavailable: {e}")
+        return 503, {'error': 'search service unavailable'}
+    except ValueError as e:
+        app.logger.info(f"Search service returned invalid JSON: {e}")
+        return 502, {'error': 'bad response from the search service'}
+
+
+def get_document_summaries(document_ids):
+    with get_db_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("SELECT id, title, file_path, preview FROM documents WHERE id = ANY(%s)", (list(document_ids),))
+        return {row['id']: row for row in cur.fetchall()}
+
+
+@app.route("/document/<int:id>/similar")
+def similar_documents( id ):
+    """Documents closest to this one by embedding, best first"""
+    status, payload = query_search_service(f"/similar/{id}", k=request.args.get('k', 10, type=int))
+    if status != 200:
+        return jsonify(payload), status
+    documents = get_document_summaries([hit['document_id'] for hit in payload['results']])
+    results = [{**hit, **documents[hit['document_id']]} for hit in payload['results'] if hit['document_id'] in documents]
+    return jsonify({'document_id': id, 'results': results})
+
+
+@app.route("/search")
+def semantic_search():
+    """?q=<text>, chunks closest to the query with their documents, or whole documents with &scope=documents"""
+    text = request.args.get('q', '').strip()
+    if not text:
+        return jsonify({'error': 'missing q'}), 400
+    scope = request.args.get('scope', 'chunks')
+    status, payload = query_search_service("/search", q=text, scope=scope, k=request.args.get('k', 10, type=int))
+    if status != 200:
+        return jsonify(payload), status
+    hits = payload['results']
+    documents = get_document_summaries({hit['document_id'] for hit in hits})
+    if scope == 'chunks' and hits:
+        with get_db_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """SELECT ce.document_id, ce.sequence_number,
+                          COALESCE(ce.input_text, substr(d.raw_text, ce.start_offset + 1, ce.end_offset - ce.start_offset))
+                   FROM chunked_embeddings ce
+                   JOIN documents d ON d.id = ce.document_id
+                   JOIN unnest(%s::integer[], %s::integer[]) AS h(document_id, sequence_number)
+                     ON ce.document_id = h.document_id AND ce.sequence_number = h.sequence_number""",
+                ([hit['document_id'] for hit in hits], [hit['sequence_number'] for hit in hits])
+            )
+            chunks = {(row[0], row[1]): row[2] for row in cur.fetchall()}
+        # chunks of documents that were re-embedded since the index was built are gone
+        hits = [{**hit, 'text': chunks[(hit['document_id'], hit['sequence_number'])]}
+                for hit in hits if (hit['document_id'], hit['sequence_number']) in chunks]
+    results = [{**hit, **documents[hit['document_id']]} for hit in hits if hit['document_id'] in documents]
+    return jsonify({'query': text, 'scope': scope, 'results': results})
+
+
 @app.route("/")
 def hello_world():
     app.logger.info('A user visited the index page.') # Log an informational message
-    c = get_db_connection()
-    count = get_count_docs()
-    topic_data = get_topics_and_associated_documents()
-    coords = get_document_coords( c )
-    return render_template( 'index.html', count=count, topic_data=topic_data, date=datetime.datetime.now(), x = coords ) 
+    count = payload_cache.get( 'count', get_count_docs )
+    topic_data = payload_cache.get( 'topics', get_topics_and_associated_documents )
+    # the map is fetched by the page from /api/coords
+    return render_template( 'index.html', count=count, topic_data=topic_data, date=datetime.datetime.now() )
 
 
 def get_topics_and_associated_documents():
-    conn = get_db_connection()
-    cur = conn.cursor( cursor_factory=RealDictCursor)
     sql = """
     WITH topic_titles AS (
-        SELECT ttt.topic_id, 
-               STRING_AGG( term_text, '-' ORDER BY rank DESC) AS label 
-        FROM topic_top_terms ttt 
+        SELECT ttt.topic_id,
+               STRING_AGG( term_text, '-' ORDER BY rank DESC) AS label
+        FROM topic_top_terms ttt
         GROUP BY ttt.topic_id
-      ) 
-      SELECT tt.label, 
+      )
+      SELECT tt.label,
              STRING_AGG( '<a href="/document/' || d.id || '">' || d.title || '</a>', ', ') AS document_titles
-      FROM topic_titles tt, 
-           document_topics dt, 
-           documents d 
-      WHERE d.id = dt.document_id 
-        AND dt.topic_id = tt.topic_id 
+      FROM topic_titles tt,
+           document_topics dt,
+           documents d
+      WHERE d.id = dt.document_id
+        AND dt.topic_id = tt.topic_id
       GROUP BY tt.label order by count( d.title ) desc;
     """
-    cur.execute( sql )
-    topic_data = cur.fetchall()
-    cur.close()
-    conn.close()
-    return topic_data
+    with get_db_connection() as conn, conn.cursor( cursor_factory=RealDictCursor) as cur:
+        cur.execute( sql )
+        return cur.fetchall()
 
 
 def get_count_docs():
-    conn = get_db_connection()
-    
-    # Use RealDictCursor to get results as "mapish" dictionaries
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+    with get_db_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute('SELECT COUNT(*) FROM documents;')
+        return cur.fetchone()['count']
+
+
+class CoordColumns:
+    """
+    The map points as columns (document ids, x, y, topic, marker size, title), loaded once per pipeline version.
+    order lists the points by a fixed hash of their id: a level of detail sample takes the first points of it in the
+    viewport, so zooming in only ever adds points to the ones already shown.
+    """
 
-    # 1. Query for a single integer (e.g., a count)
-    cur.execute('SELECT COUNT(*) FROM documents;')
-    document_count = cur.fetchone()['count']
+    def __init__(self, rows):
+        self.ids = array('i', (row[0] for row in rows))
+        self.x = array('f', (row[1] for row in rows))
+        self.y = array('f', (row[2] for row in rows))
+        self.topics = array('i', (-1 if row[3] is None else row[3] for row in rows))
+        self.sizes = array('f', marker_sizes([row[4] or 0 for row in rows]))
+        self.labels = [(row[5] or '').replace('\n', ' ') for row in rows]
+        self.order = sorted(range(len(rows)), key=lambda i: (self.ids[i] * 2654435761) & 0xffffffff)
 
+    def __len__(self):
+        return len(self.ids)
 
-    cur.close()
-    conn.close()
+    def select(self, viewport=None, limit=COORDS_MAX_POINTS):
+        """(indices of at most limit points inside viewport (x0, x1, y0, y1), number of points inside it)"""
+        if viewport is None:
+            inside = self.order
+        else:
+            x0, x1, y0, y1 = viewport
+            xs, ys = self.x, self.y
+            inside = [i for i in self.order if x0 <= xs[i] <= x1 and y0 <= ys[i] <= y1]
+        return inside[:limit], len(inside)
 
-    return document_count
-    # return jsonify({
-    #     "total_docs": user_count,
-    #     # "user_list": recent_users,
-    #     # "products": active_products
-    # })
+    def to_json(self, indices, total):
+        return {
+            'total': total, 'count': len(indices),
+            'ids': [self.ids[i] for i in indices],
+            # float32 digits beyond these only add bytes
+            'x': [round(self.x[i], 4) for i in indices],
+            'y': [round(self.y[i], 4) for i in indices],
+            'topics': [self.topics[i] for i in indices],
+            'sizes': [round(self.sizes[i], 1) for i in indices],
+            'labels': [self.labels[i] for i in indices],
+        }
 
-def get_topic_document_mapping():    
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)    
-    sql = "select document_id , topic_id from document_topics "
-    cur.execute( sql )
-    return_data = {}
-    for row in cur:
-        return_data[ row['document_id']] = row['topic_id']
-    cur.close()
-    conn.close()
+    def to_binary(self, indices, total):
+        """COORDS_HEADER, then the ids, x, y, topics and sizes as little endian int32/float32 and the titles as
+        newline separated UTF-8"""
+        parts = [COORDS_HEADER.pack(COORDS_MAGIC, COORDS_VERSION, len(indices), total)]
+        for column in (self.ids, self.x, self.y, self.topics, self.sizes):
+            values = array(column.typecode, (column[i] for i in indices))
+            if sys.byteorder == 'big':
+                values.byteswap()
+            parts.append(values.tobytes())
+        parts.append('\n'.join(self.labels[i] for i in indices).encode())
+        return b''.join(parts)
 
-    return return_data
 
+def marker_sizes(lengths):
+    """Document lengths scaled to marker sizes, 5 plus the length over a 40th of the length range"""
+    if not lengths:
+        return []
+    low, high = min(lengths), max(lengths)
+    if high == low:
+        return [20] * len(lengths)
+    scale = (high - low) / 40
+    return [5 + s / scale for s in lengths]
 
-def get_document_coords(conn):
-    try:
-        # 1. Get the mapping first (replaces await getTopicDocumentMapping())
-        topic_data = get_topic_document_mapping()
-
-        colors = [
-            'AliceBlue', 'Azure', 'Bisque', 'CadetBlue', 'BurlyWood', 'Coral', 'DarkCyan',
-            'DarkKhaki', 'DarkOrange', 'DarkSlateBlue', 'Yellow', 'Violet', 'SteelBlue', 
-            'Tan', 'Teal', 'SpringGreen', 'SlateGrey', 'Thistle', 'Tomato', 'Salmon', 
-            'SandyBrown', 'SeaGreen'
-        ]
-
-        plot_data = {
-            "x": [], "y": [], "labels": [], 
-            "originalSizes": [], "sizes": [], "colors": [], "ids" : []
-        }
 
-        # 2. Fetch the document coordinates
-        query = """
-            SELECT 
-                d.id AS document_id, 
-                SUBSTRING(d.title FROM 1 FOR 20) AS title, 
-                x, 
-                y, 
-                LENGTH(d.raw_text) AS size 
-            FROM doc_coords dc
-            JOIN documents d ON d.id = dc.document_id
-        """
-
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(query)
-            rows = cur.fetchall()
-
-        if not rows:
-            return plot_data
-
-        # 3. Process data & assign colors
-        for row in rows:
-            doc_id = row['document_id']
-            plot_data['x'].append(row['x'])
-            plot_data['y'].append(row['y'])
-            plot_data['labels'].append(row['title'])
-            plot_data['ids'].append( doc_id )
-            size_val = row['size'] if row['size'] else 0
-            plot_data['originalSizes'].append(size_val)
-
-            # Match color based on the topic_data dict
-            topic_id = topic_data.get(doc_id, 0)
-            color_idx = topic_id % len(colors)
-            plot_data['colors'].append(colors[color_idx])
-
-        # 4. Normalize Sizes (The Math)
-        # Replicating JS logic: scale = (max - min) / (50 - 10)
-        orig_sizes = plot_data['originalSizes']
-        if orig_sizes:
-            min_s, max_s = min(orig_sizes), max(orig_sizes)
-            range_s = max_s - min_s
-            
-            if range_s == 0:
-                plot_data['sizes'] = [20] * len(orig_sizes)
-            else:
-                scale = range_s / 40
-                for s in orig_sizes:
-                    # formula: 5 + (size / scale)
-                    plot_data['sizes'].append(5 + (s / scale))
-        return plot_data
-
-    except Exception as e:
-        app.logger.info(f"General Error in get_document_coords: {e}")
-        return None
+def get_coord_columns():
+    query = """
+        SELECT d.id, dc.x, dc.y, dt.topic_id, d.char_length, SUBSTRING(d.title FROM 1 FOR 20)
+        FROM doc_coords dc
+        JOIN documents d ON d.id = dc.document_id
+        LEFT JOIN document_topics dt ON dt.document_id = dc.document_id
+        ORDER BY d.id
+    """
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute(query)
+        return CoordColumns(cur.fetchall())
+
+
+def compressed_response(body, mimetype, etag=None):
+    response = app.response_class(body, mimetype=mimetype)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept-Encoding')
+    if etag is not None:
+        response.set_etag(etag)
+        response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+    if len(body) >= GZIP_MIN_BYTES and 'gzip' in request.accept_encodings:
+        response.set_data(gzip.compress(body, compresslevel=5))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+@app.route("/api/coords")
+def coords_api():
+    """
+    Map points as columns. ?x0=&x1=&y0=&y1= keeps the points inside a viewport, ?limit= (at most
+    COORDS_MAX_POINTS) samples that many of them, ?format=binary answers with typed arrays instead of JSON.
+    The ETag is the pipeline version, so an unchanged map is answered with 304.
+    """
+    output = request.args.get('format', 'json')
+    if output not in ('json', 'binary'):
+        return jsonify({'error': f'unknown format {output}'}), 400
+    bounds = [request.args.get(name, type=float) for name in ('x0', 'x1', 'y0', 'y1')]
+    if any(bound is None for bound in bounds) and any(bound is not None for bound in bounds):
+        return jsonify({'error': 'a viewport needs all of x0, x1, y0 and y1'}), 400
+    viewport = None if bounds[0] is None else tuple(bounds)
+    limit = min(max(request.args.get('limit', COORDS_MAX_POINTS, type=int), 1), COORDS_MAX_POINTS)
+
+    version = payload_cache.current_version()
+    etag = None if version is None else '-'.join(map(str, (version, output, limit, *(viewport or ()))))
+    if etag is not None and request.if_none_match.contains(etag):
+        return compressed_response(b'', None, etag)
+
+    def render():
+        columns = payload_cache.get('coord_columns', get_coord_columns)
+        indices, total = columns.select(viewport, limit)
+        if output == 'binary':
+            return columns.to_binary(indices, total)
+        return json.dumps(columns.to_json(indices, total), separators=(',', ':')).encode()
+
+    # the page asks for the whole map on every load, viewports and other limits are rendered per request
+    cached = viewport is None and limit == COORDS_MAX_POINTS
+    body = payload_cache.get(f'coords:{output}', render) if cached else render()
+    return compressed_response(body, 'application/octet-stream' if output == 'binary' else 'application/json', etag)
 
 if __name__ == "__main__":
     # Ensure the app runs on all available network interfaces
-    app.run(host='0.0.0.0', port=5000) 
-
+    app.run(host='0.0.0.0', port=5000, threaded=True)
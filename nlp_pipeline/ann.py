@@ -0,0 +1,321 @@
+"""Approximate nearest neighbour search over document and chunk vectors: an IVF index plus an append-only delta"""
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+
+from config import (ANN_INDEX_DIR, ANN_REBUILD_RATIO, ANN_NLIST, ANN_NPROBE, ANN_TRAIN_SAMPLE,
+                    EMBEDDING_MODEL_NAME, EMBEDDING_STORE_DIR)
+from db import connect_db
+from embedding import EmbeddingStore, parse_copy_embeddings, latest_rows
+from metrics import record_progress
+
+INDEX_NAMES = ('documents', 'chunks')
+# chunk vectors are keyed by (document id, sequence number) packed into one int64, so embed_pdfs can append them
+# to the delta without waiting for their chunked_embeddings ids
+CHUNK_KEY_BITS = 24
+
+def chunk_keys(document_ids, sequence_numbers) -> np.ndarray:
+    return (np.asarray(document_ids, dtype=np.int64) << CHUNK_KEY_BITS) | np.asarray(sequence_numbers, dtype=np.int64)
+
+def split_chunk_keys(keys) -> Tuple[np.ndarray, np.ndarray]:
+    keys = np.asarray(keys, dtype=np.int64)
+    return keys >> CHUNK_KEY_BITS, keys & ((1 << CHUNK_KEY_BITS) - 1)
+
+def normalize(vectors) -> np.ndarray:
+    """float32 copy with unit length rows, so the dot product is the cosine similarity"""
+    vectors = np.array(vectors, dtype=np.float32, ndmin=2)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.divide(vectors, norms, out=vectors, where=norms > 0)
+    return vectors
+
+def delta_store(name: str, model_name: str = EMBEDDING_MODEL_NAME) -> EmbeddingStore:
+    """Vectors added since the index was built, scanned exhaustively at query time"""
+    return EmbeddingStore(os.path.join(ANN_INDEX_DIR, name, 'delta'), model_name)
+
+def append_delta(name: str, ids, vectors, model_name: str = EMBEDDING_MODEL_NAME):
+    delta_store(name, model_name).append(list(ids), normalize(vectors))
+
+def append_tombstones(name: str, ids, model_name: str = EMBEDDING_MODEL_NAME):
+    """
+    Remove ids from an index: a zero vector in the delta hides the indexed row of its id until the next rebuild,
+    which no longer reads it. Appending a real vector for the id later makes it searchable again
+    """
+    ids = list(ids)
+    if not ids:
+        return
+    store = delta_store(name, model_name)
+    dimension = store.dimension()
+    if dimension is None:
+        try:
+            with open(os.path.join(ANN_INDEX_DIR, name, 'CURRENT')) as f, \
+                    open(os.path.join(ANN_INDEX_DIR, name, f.read().strip(), 'meta.json')) as meta:
+                dimension = json.load(meta)['dimension']
+        except OSError:
+            # no index and no delta, nothing to hide
+            return
+    store.append(ids, np.zeros((len(ids), dimension), dtype=np.float32))
+
+def assign_lists(vectors: np.ndarray, centroids: np.ndarray, block_rows: int = 65536) -> np.ndarray:
+    """Inverted list (the centroid with the highest dot product) of every normalized vector"""
+    lists = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), block_rows):
+        lists[start:start + block_rows] = np.argmax(vectors[start:start + block_rows] @ centroids.T, axis=1)
+    return lists
+
+def train_centroids(vectors, nlist: int, sample_size: int = ANN_TRAIN_SAMPLE, iterations: int = 10,
+                    random_state: int = 42) -> np.ndarray:
+    """Spherical k-means on a sample of the vectors, returns nlist unit length centroids"""
+    rng = np.random.default_rng(random_state)
+    rows = np.sort(rng.choice(len(vectors), size=min(len(vectors), max(sample_size, nlist)), replace=False))
+    sample = normalize(vectors[rows])
+    centroids = sample[rng.choice(len(sample), size=nlist, replace=False)]
+    for _ in range(iterations):
+        lists = assign_lists(sample, centroids)
+        order = np.argsort(lists, kind='stable')
+        counts = np.bincount(lists, minlength=nlist)
+        filled = np.flatnonzero(counts)
+        sums = np.empty_like(centroids)
+        sums[filled] = np.add.reduceat(sample[order], np.cumsum(counts)[filled] - counts[filled])
+        # an empty list starts over from a random sample vector
+        empty = np.flatnonzero(counts == 0)
+        sums[empty] = sample[rng.choice(len(sample), size=len(empty))]
+        centroids = normalize(sums)
+    return centroids
+
+class IVFIndex:
+    """
+    Inverted file index in ANN_INDEX_DIR/<name>/<version>/: unit length centroids, and the normalized vectors
+    and ids sorted by inverted list with the list offsets, all memory-mapped. A query scans the nprobe lists
+    whose centroids are closest, plus the delta segment; a delta row replaces the indexed row of the same id,
+    a zero (tombstone) row removes it.
+    refresh() swaps in new (main, delta) tuples, so concurrent queries always see one consistent snapshot.
+    """
+
+    def __init__(self, name: str, path: str = ANN_INDEX_DIR):
+        self.name = name
+        self.path = os.path.join(path, name)
+        self.delta = delta_store(name)
+        self.version = None
+        self.delta_signature = None
+        self.meta = None
+        # (centroids, offsets, ids, vectors, ids argsort) and (unique ids, vectors, not a tombstone) or None
+        self.main = None
+        self.recent = None
+        self._lock = threading.Lock()
+
+    def _current_version(self) -> Optional[str]:
+        try:
+            with open(os.path.join(self.path, 'CURRENT')) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def _load_main(self, version: str):
+        directory = os.path.join(self.path, version)
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        n, dimension, nlist = meta['count'], meta['dimension'], meta['nlist']
+        centroids = np.fromfile(os.path.join(directory, 'centroids.f32'), dtype=np.float32).reshape(nlist, dimension)
+        offsets = np.fromfile(os.path.join(directory, 'offsets.i64'), dtype=np.int64)
+        ids = np.memmap(os.path.join(directory, 'ids.i64'), dtype=np.int64, mode='r', shape=(n,))
+        vectors = np.memmap(os.path.join(directory, 'vectors.f32'), dtype=np.float32, mode='r', shape=(n, dimension))
+        return meta, (centroids, offsets, ids, vectors, np.argsort(ids, kind='stable'))
+
+    def refresh(self):
+        """Pick up a rebuilt index or rows appended to the delta since the last call, cheap when nothing changed"""
+        version = self._current_version()
+        try:
+            # discard_head() replaces the file, appends grow it
+            stat = os.stat(self.delta.ids_path)
+            delta_signature = (stat.st_ino, stat.st_size)
+        except OSError:
+            delta_signature = None
+        if version == self.version and delta_signature == self.delta_signature:
+            return
+        with self._lock:
+            if version != self.version:
+                self.meta, self.main = self._load_main(version) if version is not None else (None, None)
+                self.version = version
+            if delta_signature != self.delta_signature:
+                ids, vectors = self.delta.open()
+                if ids is not None:
+                    # the last append of an id wins
+                    unique_ids, first_in_reversed = np.unique(ids[::-1], return_index=True)
+                    recent_vectors = np.asarray(vectors[len(ids) - 1 - first_in_reversed])
+                    self.recent = (unique_ids, recent_vectors, recent_vectors.any(axis=1))
+                else:
+                    self.recent = None
+                self.delta_signature = delta_signature
+
+    def __len__(self) -> int:
+        return (self.meta['count'] if self.meta else 0) + (int(self.recent[2].sum()) if self.recent else 0)
+
+    def vector(self, item_id: int) -> Optional[np.ndarray]:
+        """Stored vector of an id, None when it is not indexed"""
+        main, recent = self.main, self.recent
+        if recent is not None:
+            position = np.searchsorted(recent[0], item_id)
+            if position < len(recent[0]) and recent[0][position] == item_id:
+                return recent[1][position] if recent[2][position] else None
+        if main is None:
+            return None
+        _, _, ids, vectors, id_order = main
+        position = np.searchsorted(ids, item_id, sorter=id_order)
+        if position < len(ids) and ids[id_order[position]] == item_id:
+            return np.asarray(vectors[id_order[position]])
+        return None
+
+    def search(self, query: np.ndarray, k: int = 10, nprobe: int = ANN_NPROBE) -> Tuple[np.ndarray, np.ndarray]:
+        """The k most similar ids to query by cosine similarity, returns (ids, scores) best first"""
+        main, recent = self.main, self.recent
+        query = normalize(query)[0]
+        candidate_ids, candidate_scores = [], []
+        if main is not None:
+            centroids, offsets, ids, vectors, _ = main
+            nprobe = min(max(nprobe, 1), len(centroids))
+            probe = np.argpartition(-(centroids @ query), nprobe - 1)[:nprobe]
+            for inverted_list in probe.tolist():
+                start, end = offsets[inverted_list], offsets[inverted_list + 1]
+                if end > start:
+                    candidate_ids.append(ids[start:end])
+                    candidate_scores.append(vectors[start:end] @ query)
+        if recent is not None:
+            if candidate_ids:
+                ids, scores = np.concatenate(candidate_ids), np.concatenate(candidate_scores)
+                current = ~np.isin(ids, recent[0])
+                candidate_ids, candidate_scores = [ids[current]], [scores[current]]
+            recent_ids, recent_vectors, live = recent
+            candidate_ids.append(recent_ids[live])
+            candidate_scores.append(recent_vectors[live] @ query)
+        if not candidate_ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        ids, scores = np.concatenate(candidate_ids), np.concatenate(candidate_scores)
+        if len(scores) > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return ids[best], scores[best]
+
+def build_index(name: str, ids: np.ndarray, vectors, model_name: str = EMBEDDING_MODEL_NAME,
+                nlist: int = ANN_NLIST, path: str = ANN_INDEX_DIR, block_rows: int = 65536) -> int:
+    """Write a new version of an index from (ids, vectors) and make it current, returns the row count"""
+    n = len(ids)
+    if nlist <= 0:
+        nlist = int(np.sqrt(n))
+    nlist = min(max(nlist, 1), n)
+    start = time.time()
+    centroids = train_centroids(vectors, nlist)
+    lists = np.empty(n, dtype=np.int32)
+    for row in range(0, n, block_rows):
+        lists[row:row + block_rows] = assign_lists(normalize(vectors[row:row + block_rows]), centroids)
+    order = np.argsort(lists, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=nlist))]).astype(np.int64)
+
+    index_path = os.path.join(path, name)
+    os.makedirs(index_path, exist_ok=True)
+    directory = tempfile.mkdtemp(dir=index_path, prefix='v')
+    centroids.tofile(os.path.join(directory, 'centroids.f32'))
+    offsets.tofile(os.path.join(directory, 'offsets.i64'))
+    np.asarray(ids, dtype=np.int64)[order].tofile(os.path.join(directory, 'ids.i64'))
+    with open(os.path.join(directory, 'vectors.f32'), 'wb') as f:
+        for row in range(0, n, block_rows):
+            rows = np.sort(order[row:row + block_rows])
+            # read the source in order, write the rows in list order
+            positions = np.argsort(np.argsort(order[row:row + block_rows], kind='stable'), kind='stable')
+            normalize(vectors[rows])[positions].tofile(f)
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump({'model': model_name, 'dimension': int(centroids.shape[1]), 'nlist': nlist, 'count': n,
+                   'built_at': time.time()}, f)
+
+    version = os.path.basename(directory)
+    with open(os.path.join(index_path, 'CURRENT.tmp'), 'w') as f:
+        f.write(version)
+    os.replace(os.path.join(index_path, 'CURRENT.tmp'), os.path.join(index_path, 'CURRENT'))
+    # readers that still map an older version keep their open files
+    for entry in os.listdir(index_path):
+        if entry.startswith('v') and entry != version:
+            shutil.rmtree(os.path.join(index_path, entry), ignore_errors=True)
+    print(f"Built the {name} index: {n} vectors in {nlist} lists in {time.time() - start:.1f}s")
+    return n
+
+def document_vectors(conn) -> Tuple[np.ndarray, np.ndarray]:
+    """Latest vector of every embedded document, from the on-disk embedding store"""
+    store = EmbeddingStore(EMBEDDING_STORE_DIR)
+    ids, vectors = store.open()
+    if ids is None:
+        ids, vectors = store.rebuild(conn)
+    if ids is None:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+    # the store keeps the vectors of documents that were deleted or changed since, leave those out
+    with conn.cursor() as cur:
+        cur.execute("SELECT id FROM documents WHERE embedding IS NOT NULL")
+        embedded = np.array([row[0] for row in cur.fetchall()], dtype=np.int64)
+    conn.commit()
+    unique_ids = np.intersect1d(np.unique(ids), embedded)
+    return unique_ids, vectors[latest_rows(ids, unique_ids)]
+
+def chunk_vectors(conn, directory: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Every chunk vector keyed by chunk_keys(), through a binary COPY into raw files in directory"""
+    copy_path = os.path.join(directory, 'chunks.copy')
+    with open(copy_path, 'wb') as copy_file, conn.cursor() as cur:
+        cur.copy_expert(
+            f"""COPY (SELECT (document_id::bigint << {CHUNK_KEY_BITS}) | sequence_number, embedding
+                      FROM chunked_embeddings WHERE embedding IS NOT NULL ORDER BY 1)
+                TO STDOUT WITH (FORMAT binary)""",
+            copy_file
+        )
+    conn.commit()
+    ids_path, vectors_path = os.path.join(directory, 'ids.i64'), os.path.join(directory, 'vectors.f32')
+    with open(ids_path, 'wb') as ids_out, open(vectors_path, 'wb') as vectors_out:
+        dimension = parse_copy_embeddings(copy_path, ids_out, vectors_out)
+    os.remove(copy_path)
+    if not dimension:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+    ids = np.fromfile(ids_path, dtype=np.int64)
+    return ids, np.memmap(vectors_path, dtype=np.float32, mode='r', shape=(len(ids), dimension))
+
+def ann_index(force: bool = False, indexes: Optional[List[str]] = None):
+    """
+    Rebuild the document and chunk indexes that do not exist yet, were built for another model, or whose delta
+    grew past ANN_REBUILD_RATIO of the indexed rows; force rebuilds them regardless
+    """
+    conn = connect_db()
+    try:
+        for name in indexes or INDEX_NAMES:
+            index = IVFIndex(name)
+            index.refresh()
+            indexed = index.meta['count'] if index.meta else 0
+            delta_rows = index.delta.n_rows()
+            stale = index.meta is None or index.meta['model'] != EMBEDDING_MODEL_NAME
+            if not (force or stale or delta_rows > ANN_REBUILD_RATIO * indexed):
+                print(f"The {name} index is current ({indexed} indexed, {delta_rows} in the delta)")
+                continue
+            # everything in the delta so far is committed, and so part of what is read below
+            os.makedirs(ANN_INDEX_DIR, exist_ok=True)
+            with tempfile.TemporaryDirectory(dir=ANN_INDEX_DIR) as tmp:
+                ids, vectors = document_vectors(conn) if name == 'documents' else chunk_vectors(conn, tmp)
+                if len(ids) == 0:
+                    print(f"Nothing to index for {name}")
+                    continue
+                build_index(name, ids, vectors)
+            index.delta.discard_head(delta_rows)
+            record_progress(documents=len(ids) if name == 'documents' else 0,
+                            chunks=len(ids) if name == 'chunks' else 0)
+    finally:
+        conn.close()
+
+_indexes: Dict[str, IVFIndex] = {}
+
+def get_index(name: str) -> IVFIndex:
+    """Process-wide index, refreshed from disk on every call"""
+    if name not in _indexes:
+        _indexes[name] = IVFIndex(name)
+    index = _indexes[name]
+    index.refresh()
+    return index
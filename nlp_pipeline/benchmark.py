@@ -0,0 +1,368 @@
+"""
+End-to-end benchmark of the worker stages on a synthetic corpus.
+
+    python benchmark.py --docs 1000 --format pdf --output bench_1k.json
+    python benchmark.py --docs 100000 --format text --stages embed_pdfs,umap_incremental,terms,tf_idf
+
+A throwaway database (bench_<id>) is created next to DB_NAME on DB_HOST, loaded with sql/output_schema.sql
+and the migrations, and dropped afterwards unless --keep. The corpus is written to a temporary data folder
+(pdf) or inserted into documents directly (text). The stages then run as one pipeline through the Redis job
+queue (under its own queue name), drained by this process, and the per stage totals the worker records in
+pipeline_runs are printed as JSON. All stages run in this one process, so peak RSS includes what earlier
+stages kept loaded (the embedding model, spaCy).
+
+The default --embedding-model stub needs no model weights; pass a sentence-transformers model name to
+benchmark the real encoder.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import hashlib
+import argparse
+import platform
+import resource
+import tempfile
+import textwrap
+import traceback
+from typing import List, Tuple
+
+import redis
+import psycopg2
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sql', 'output_schema.sql')
+PIPELINE_STAGES = ['process_pdfs', 'embed_pdfs', 'terms', 'umap_incremental', 'tf_idf']
+LINES_PER_PAGE = 60
+LINE_WIDTH = 90
+
+class CorpusGenerator:
+    """
+    Deterministic synthetic documents: each document draws most of its words from one of n_topics word lists,
+    and shares header, footer and a few boilerplate paragraphs (copyright notices, disclaimers) with the rest
+    of the corpus, the way real collections repeat text across files
+    """
+
+    SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'te', 'vo', 'zi', 'pa', 'qu', 'de', 'fo', 'gi', 'ha', 'ju',
+                 'bel', 'cor', 'dan', 'fer', 'gal', 'hor', 'lin', 'mor', 'nal', 'per', 'ros', 'tur', 'ven', 'xis']
+
+    def __init__(self, n_topics: int = 20, words_per_doc: int = 600, boilerplate: float = 0.2, seed: int = 0):
+        self.n_topics = n_topics
+        self.words_per_doc = words_per_doc
+        self.boilerplate = boilerplate
+        self.seed = seed
+        rng = random.Random(seed)
+        vocabulary = set()
+        while len(vocabulary) < 6000:
+            vocabulary.add(''.join(rng.choice(self.SYLLABLES) for _ in range(rng.randint(2, 4))))
+        vocabulary = sorted(vocabulary)
+        self.common_words = rng.sample(vocabulary, 400)
+        self.topic_words = [rng.sample(vocabulary, 250) for _ in range(n_topics)]
+        self.header = self._paragraph(rng, self.common_words, 25)
+        self.footer = self._paragraph(rng, self.common_words, 40)
+        self.boilerplate_paragraphs = [self._paragraph(rng, self.common_words, 60) for _ in range(8)]
+
+    @staticmethod
+    def _sentence(rng: random.Random, words: List[str]) -> str:
+        sentence = ' '.join(rng.choice(words) for _ in range(rng.randint(6, 18)))
+        return sentence[0].upper() + sentence[1:] + '.'
+
+    def _paragraph(self, rng: random.Random, words: List[str], n_words: int) -> str:
+        sentences, count = [], 0
+        while count < n_words:
+            sentence = self._sentence(rng, words)
+            sentences.append(sentence)
+            count += sentence.count(' ') + 1
+        return ' '.join(sentences)
+
+    def document(self, index: int) -> Tuple[str, str]:
+        """(title, text) of document index"""
+        rng = random.Random(self.seed * 1_000_003 + index)
+        topic = index % self.n_topics
+        words = self.topic_words[topic] * 3 + self.common_words
+        paragraphs = [self.header]
+        count = 0
+        while count < self.words_per_doc:
+            if rng.random() < self.boilerplate:
+                paragraphs.append(rng.choice(self.boilerplate_paragraphs))
+            paragraph = self._paragraph(rng, words, rng.randint(60, 150))
+            paragraphs.append(paragraph)
+            count += paragraph.count(' ') + 1
+        paragraphs.append(self.footer)
+        title = f"Synthetic document {index:06d} topic {topic}"
+        return title, '\n\n'.join(paragraphs)
+
+def pdf_escape(line: str) -> str:
+    return line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+def write_pdf(path: str, text: str):
+    """Write text as a minimal PDF with one Helvetica font and LINES_PER_PAGE wrapped lines per page"""
+    lines = []
+    for paragraph in text.split('\n\n'):
+        lines.extend(textwrap.wrap(paragraph, LINE_WIDTH) or [''])
+        lines.append('')
+    pages = [lines[i:i + LINES_PER_PAGE] for i in range(0, len(lines), LINES_PER_PAGE)] or [[]]
+
+    # 1 catalog, 2 page tree, 3 font, then a page and its content stream for every page
+    page_numbers = [4 + 2 * i for i in range(len(pages))]
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        f"<< /Type /Pages /Kids [{' '.join(f'{n} 0 R' for n in page_numbers)}] /Count {len(pages)} >>".encode(),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for number, page_lines in zip(page_numbers, pages):
+        stream = ("BT /F1 10 Tf 12 TL 50 790 Td "
+                  + ' '.join(f"({pdf_escape(line)}) Tj T*" for line in page_lines)
+                  + " ET").encode('latin-1', errors='replace')
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {number + 1} 0 R >>".encode()
+        )
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n".encode() + stream + b"\nendstream")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, 'wb') as f:
+        f.write(out)
+
+def admin_connection(args):
+    conn = psycopg2.connect(dbname=args.admin_db, user=args.db_user, password=args.db_password,
+                            host=args.db_host, port=args.db_port)
+    conn.autocommit = True
+    return conn
+
+def create_database(args, name: str):
+    conn = admin_connection(args)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f'CREATE DATABASE "{name}"')
+    finally:
+        conn.close()
+
+    # output_schema.sql is a pg_dump, leave out the psql meta-commands (\restrict ...)
+    with open(SCHEMA_FILE) as f:
+        schema = ''.join(line for line in f if not line.startswith('\\'))
+    conn = psycopg2.connect(dbname=name, user=args.db_user, password=args.db_password,
+                            host=args.db_host, port=args.db_port)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(schema)
+        conn.commit()
+    finally:
+        conn.close()
+
+def drop_database(args, name: str):
+    conn = admin_connection(args)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)')
+    finally:
+        conn.close()
+
+def generate_corpus(generator: CorpusGenerator, args) -> dict:
+    """Write the corpus as PDFs into DATA_FOLDER, or insert it as documents rows for --format text"""
+    from config import DATA_FOLDER
+    from db import connect_db
+    from psycopg2.extras import execute_values
+    start = time.time()
+    total_bytes = 0
+    if args.format == 'pdf':
+        os.makedirs(DATA_FOLDER, exist_ok=True)
+        for index in range(args.docs):
+            _, text = generator.document(index)
+            path = os.path.join(DATA_FOLDER, f"doc_{index:06d}.pdf")
+            write_pdf(path, text)
+            total_bytes += os.path.getsize(path)
+    else:
+        conn = connect_db()
+        try:
+            with conn.cursor() as cur:
+                batch = []
+                for index in range(args.docs):
+                    title, text = generator.document(index)
+                    total_bytes += len(text.encode())
+                    batch.append((f"synthetic/doc_{index:06d}.txt", text, title,
+                                  hashlib.sha256(text.encode()).hexdigest(), len(text.encode())))
+                    if len(batch) >= 1000 or index == args.docs - 1:
+                        execute_values(
+                            cur,
+                            "INSERT INTO documents (file_path, raw_text, title, content_hash, file_size) VALUES %s",
+                            batch
+                        )
+                        conn.commit()
+                        batch = []
+        finally:
+            conn.close()
+    return {'documents': args.docs, 'format': args.format, 'bytes': total_bytes,
+            'generation_seconds': time.time() - start}
+
+def drain(queue):
+    """Run queued jobs in this process until the queue is empty, like run_worker() without the waiting"""
+    from jobs import run_job, fail_pipeline
+    while True:
+        reserved = queue.reserve(timeout=1)
+        if reserved is None:
+            return
+        raw, job = reserved
+        print(f"--- Benchmark task: {job['task']} ---")
+        try:
+            run_job(queue, job)
+        except Exception as e:
+            traceback.print_exc()
+            if not queue.fail(raw, job, e):
+                fail_pipeline(queue, job, e)
+            continue
+        queue.ack(raw)
+
+def stage_results(run_id: str) -> dict:
+    from db import connect_db
+    conn = connect_db()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT stage, COUNT(*), EXTRACT(EPOCH FROM MAX(finished_at) - MIN(started_at)),
+                       SUM(wall_seconds), SUM(db_seconds), SUM(compute_seconds), SUM(documents), SUM(chunks),
+                       MAX(peak_rss_mb), MAX(children_peak_rss_mb), COUNT(*) FILTER (WHERE status = 'failed')
+                FROM pipeline_runs WHERE run_id = %s
+                GROUP BY stage ORDER BY MIN(started_at)
+            """, (run_id,))
+            rows = cur.fetchall()
+    finally:
+        conn.close()
+    results = {}
+    for stage, tasks, elapsed, wall, db, compute, documents, chunks, peak_rss, children_rss, failed in rows:
+        elapsed = float(elapsed)
+        results[stage] = {
+            'tasks': tasks,
+            'elapsed_seconds': elapsed,
+            'wall_seconds': wall,
+            'db_seconds': db,
+            'compute_seconds': compute,
+            'documents': int(documents or 0),
+            'chunks': int(chunks or 0),
+            'docs_per_second': (documents or 0) / elapsed if elapsed > 0 else None,
+            'chunks_per_second': (chunks or 0) / elapsed if elapsed > 0 else None,
+            'peak_rss_mb': peak_rss,
+            'children_peak_rss_mb': children_rss,
+            'failed_tasks': failed,
+        }
+    return results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', type=int, default=1000, help="number of documents (e.g. 1000, 10000, 100000)")
+    parser.add_argument('--format', choices=['pdf', 'text'], default='pdf',
+                        help="generate PDF files for process_pdfs, or insert raw text and skip process_pdfs")
+    parser.add_argument('--words-per-doc', type=int, default=600)
+    parser.add_argument('--topics', type=int, default=20, help="number of synthetic topics")
+    parser.add_argument('--boilerplate', type=float, default=0.2,
+                        help="chance of a shared boilerplate paragraph before each paragraph")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', default=','.join(PIPELINE_STAGES), help="comma separated pipeline stages")
+    parser.add_argument('--embedding-model', default='stub', help="'stub', 'stub:<dimension>' or a model name")
+    parser.add_argument('--db-host', default=os.getenv('DB_HOST', 'localhost'))
+    parser.add_argument('--db-port', type=int, default=int(os.getenv('DB_PORT', '5432')))
+    parser.add_argument('--db-user', default=os.getenv('DB_USER', 'postgres'))
+    parser.add_argument('--db-password', default=os.getenv('DB_PASSWORD', 'test_case'))
+    parser.add_argument('--admin-db', default='postgres', help="database to connect to for CREATE / DROP DATABASE")
+    parser.add_argument('--redis-url', default=os.getenv('BENCHMARK_REDIS_URL', 'redis://localhost:6379/15'))
+    parser.add_argument('--workdir', help="data folder and outputs go here (default: a temporary directory)")
+    parser.add_argument('--keep', action='store_true', help="keep the database, redis keys and workdir")
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+    if args.format == 'text' and 'process_pdfs' in stages:
+        stages.remove('process_pdfs')
+    bench_id = uuid.uuid4().hex[:12]
+    database = f"bench_{bench_id}"
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='latent-bench-'))
+
+    # config.py reads the worker configuration at import time, so the worker modules are imported after this
+    os.environ.update({
+        'DB_NAME': database,
+        'DB_HOST': args.db_host,
+        'DB_PORT': str(args.db_port),
+        'DB_USER': args.db_user,
+        'DB_PASSWORD': args.db_password,
+        'REDIS_URL': args.redis_url,
+        'QUEUE_NAME': f"bench:{bench_id}",
+        'DATA_FOLDER': os.path.join(workdir, 'data') + os.sep,
+        'EMBEDDING_MODEL': args.embedding_model,
+        # a failing stage fails the benchmark instead of being retried
+        'JOB_MAX_ATTEMPTS': '1',
+    })
+
+    create_database(args, database)
+    from db import apply_migrations
+    from jobs import JobQueue, Pipeline
+    queue, run = None, None
+    try:
+        apply_migrations()
+        generator = CorpusGenerator(args.topics, args.words_per_doc, args.boilerplate, args.seed)
+        corpus = generate_corpus(generator, args)
+        print(f"Generated {corpus['documents']} {args.format} documents ({corpus['bytes'] / 2**20:.1f} MB) "
+              f"in {corpus['generation_seconds']:.1f}s")
+
+        # umap and topics write their csv and png outputs to the working directory
+        os.chdir(workdir)
+        queue = JobQueue(redis.from_url(args.redis_url))
+        start = time.time()
+        run = Pipeline.create(queue, stages)
+        run.start_ready_stages()
+        drain(queue)
+        state = run.state()
+
+        report = {
+            'benchmark': {key: value for key, value in vars(args).items() if key not in ('db_password', 'output')},
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+            },
+            'corpus': corpus,
+            'pipeline': {
+                'run_id': run.run_id,
+                'stages': stages,
+                'status': state.get('status'),
+                'error': state.get('error'),
+                'wall_seconds': time.time() - start,
+                # lifetime peak of this process, in KB on Linux
+                'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            },
+            'stages': stage_results(run.run_id),
+        }
+    finally:
+        if not args.keep:
+            if queue is not None:
+                for key in queue.r.scan_iter(match=f"bench:{bench_id}*"):
+                    queue.r.delete(key)
+                if run is not None:
+                    queue.r.delete(run.key, f"{run.key}:done")
+                    queue.r.zrem('pipelines', run.run_id)
+            os.chdir(os.path.dirname(workdir))
+            drop_database(args, database)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 0 if report['pipeline']['status'] == 'done' else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""
+Chunking strategies for embed_pdfs. A chunker returns the (start, end) character spans of the chunks of a text,
+chunked_embeddings stores those offsets into documents.raw_text rather than a copy of the text.
+"""
+import re
+import numpy as np
+from typing import List, Optional
+
+from config import CHUNK_STRATEGY, CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS, CHUNK_CHARS, PAGE_BREAK
+
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+|\n{2,}')
+WORD = re.compile(r'\S+')
+
+def no_spans() -> np.ndarray:
+    return np.empty((0, 2), dtype=np.int64)
+
+def window_spans(token_offsets: np.ndarray, size: int, overlap: int) -> np.ndarray:
+    """Spans of windows of size tokens overlapping by overlap tokens, token_offsets: (n, 2) character offsets"""
+    n = len(token_offsets)
+    if n == 0:
+        return no_spans()
+    step = max(size - overlap, 1)
+    first = np.arange(0, max(n - overlap, 1), step)
+    last = np.minimum(first + size, n) - 1
+    return np.column_stack([token_offsets[first, 0], token_offsets[last, 1]]).astype(np.int64)
+
+class CharChunker:
+    """The original chunking: fixed windows of chunk_size characters overlapping by overlap characters"""
+
+    def __init__(self, chunk_size: int = 100, overlap: int = 10):
+        self.chunk_size = chunk_size
+        self.overlap = min(overlap, chunk_size - 1)
+
+    def spans(self, text: str) -> np.ndarray:
+        n = len(text)
+        if n <= self.chunk_size:
+            return np.array([[0, n]], dtype=np.int64) if n else no_spans()
+        starts = np.arange(0, n, self.chunk_size - self.overlap)
+        ends = np.minimum(starts + self.chunk_size, n)
+        # stop after the first window that reaches the end
+        count = int(np.argmax(ends >= n)) + 1
+        return np.column_stack([starts[:count], ends[:count]])
+
+    def spans_many(self, texts: List[str]) -> List[np.ndarray]:
+        return [self.spans(text) for text in texts]
+
+class TokenChunker:
+    """
+    Windows of size tokens overlapping by overlap tokens. With a fast (Rust) Hugging Face tokenizer the whole
+    batch of documents is tokenized in one call and its offset mapping gives the spans; without one (e.g. the stub
+    model) whitespace separated words stand in for tokens.
+    """
+
+    def __init__(self, tokenizer=None, size: int = CHUNK_TOKENS, overlap: int = CHUNK_OVERLAP_TOKENS):
+        self.tokenizer = tokenizer if getattr(tokenizer, 'is_fast', False) else None
+        self.size = size
+        self.overlap = min(overlap, size - 1)
+
+    def token_offsets(self, texts: List[str]) -> List[np.ndarray]:
+        if self.tokenizer is None:
+            return [np.array([match.span() for match in WORD.finditer(text)], dtype=np.int64).reshape(-1, 2)
+                    for text in texts]
+        encoded = self.tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True, truncation=False,
+                                 return_attention_mask=False, return_token_type_ids=False, verbose=False)
+        return [np.array(offsets, dtype=np.int64).reshape(-1, 2) for offsets in encoded['offset_mapping']]
+
+    def spans(self, text: str) -> np.ndarray:
+        return self.spans_many([text])[0]
+
+    def spans_many(self, texts: List[str]) -> List[np.ndarray]:
+        return [window_spans(offsets, self.size, self.overlap) for offsets in self.token_offsets(texts)]
+
+class SentenceChunker:
+    """Whole sentences packed into chunks of up to max_chars characters; a chunk never crosses a page break"""
+
+    def __init__(self, max_chars: int = CHUNK_CHARS):
+        self.max_chars = max_chars
+
+    def page_sentences(self, text: str, start: int, end: int) -> List[List[int]]:
+        """Non-empty sentence spans of text[start:end], longer sentences cut into max_chars pieces"""
+        bounds = [start] + [m.end() + start for m in SENTENCE_END.finditer(text[start:end])] + [end]
+        sentences = []
+        for s, e in zip(bounds[:-1], bounds[1:]):
+            while e > s and text[e - 1].isspace():
+                e -= 1
+            for piece in range(s, e, self.max_chars):
+                sentences.append([piece, min(piece + self.max_chars, e)])
+        return sentences
+
+    def spans(self, text: str) -> np.ndarray:
+        spans = []
+        page_start = 0
+        while page_start <= len(text):
+            page_end = text.find(PAGE_BREAK, page_start)
+            if page_end == -1:
+                page_end = len(text)
+            current = None
+            for s, e in self.page_sentences(text, page_start, page_end):
+                if current is not None and e - current[0] <= self.max_chars:
+                    current[1] = e
+                else:
+                    if current is not None:
+                        spans.append(current)
+                    current = [s, e]
+            if current is not None:
+                spans.append(current)
+            page_start = page_end + len(PAGE_BREAK)
+        return np.array(spans, dtype=np.int64).reshape(-1, 2)
+
+    def spans_many(self, texts: List[str]) -> List[np.ndarray]:
+        return [self.spans(text) for text in texts]
+
+CHUNKERS = {
+    'tokens': TokenChunker,
+    'sentences': SentenceChunker,
+    'chars': CharChunker,
+}
+
+def get_chunker(strategy: str = CHUNK_STRATEGY, model=None, size: Optional[int] = None,
+                overlap: Optional[int] = None):
+    """
+    Chunker for a strategy; token windows use the tokenizer of model and stay within its sequence length.
+    size and overlap override the configured chunk size in the strategy's unit (tokens, or characters for
+    'sentences' and 'chars'; sentence chunks do not overlap)
+    """
+    if strategy not in CHUNKERS:
+        raise ValueError(f"Unknown chunking strategy: {strategy}")
+    if strategy == 'chars':
+        return CharChunker(size or 100, 10 if overlap is None else overlap)
+    if strategy == 'sentences':
+        return SentenceChunker(size or CHUNK_CHARS)
+    size = size or CHUNK_TOKENS
+    max_seq_length: Optional[int] = getattr(model, 'max_seq_length', None)
+    if max_seq_length:
+        # leave room for the special tokens the model adds
+        size = min(size, max_seq_length - 2)
+    return TokenChunker(getattr(model, 'tokenizer', None), size, CHUNK_OVERLAP_TOKENS if overlap is None else overlap)
@@ -0,0 +1,498 @@
+"""umap, umap_incremental and topics stages: projection, clustering and the saved topic model"""
+import os
+import io
+import time
+import fcntl
+import tempfile
+import numpy as np
+from typing import Optional, Tuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2.extras import execute_values
+
+from ann import normalize
+from config import (TOPIC_MODEL_PATH, REFIT_DRIFT_THRESHOLD, RENDER_MAP_ON_UMAP, UMAP_SAMPLE_SIZE, UMAP_PCA_COMPONENTS,
+                    UMAP_THREADS, UMAP_MEMORY_MB, UMAP_N_NEIGHBORS, UMAP_MIN_DIST, HDBSCAN_MIN_CLUSTER_SIZE,
+                    HDBSCAN_MIN_SAMPLES)
+from db import connect_db, bump_pipeline_version
+from embedding import load_embedding_matrix, open_embedding_rows
+from metrics import record_progress, current_rss_mb
+from models import cached_model
+from plotting import plot_topic_map
+
+# rough peak memory per document for the large corpus path: fitting UMAP and HDBSCAN on the sample (neighbour
+# graphs, layout and condensed tree), and projecting a chunk (vectors, neighbour search and coordinates)
+FIT_BYTES_PER_ROW = 8192
+ASSIGN_BYTES_PER_ROW = 4096
+MAX_CHUNK_ROWS = 20000
+MIN_CHUNK_ROWS = 1000
+# k-means cells the stratified sample is drawn from, and the fewest documents taken from a cell
+SAMPLE_STRATA = 100
+MIN_PER_STRATUM = 10
+
+def fetch_documents(conn):
+    """Ids, titles and file names of the documents with an embedding"""
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT id, file_path, title
+            FROM documents 
+            WHERE embedding IS NOT NULL
+            ORDER BY id
+        """)
+        rows = cursor.fetchall()
+    conn.commit()
+    
+    doc_ids = [row[0] for row in rows]
+    filenames = [ str(row[0] ) + str(row[2] ) if row[2] else f"Document {row[0]}" for row in rows]
+    titles = [ ( str(row[0]) + "," + str(row[1] ) ) if row[1] else f"doc_{row[0]}" for row in rows]
+    return doc_ids, titles, filenames
+
+def create_umap_projection(embeddings, n_neighbors=15, min_dist=0.1, random_state=42, metric='cosine'):
+    """Create UMAP 2D projection of embeddings"""
+    from umap import UMAP
+    print("Creating UMAP projection...")
+    
+    # Initialize UMAP
+    reducer = UMAP(
+        n_neighbors=n_neighbors,
+        min_dist=min_dist,
+        n_components=2,
+        random_state=random_state,
+        metric=metric  # cosine is good for text embeddings
+    )
+    
+    # Fit and transform
+    embedding_2d = reducer.fit_transform(embeddings)
+    
+    print(f"UMAP projection complete. Shape: {embedding_2d.shape}")
+    return embedding_2d, reducer
+
+def cluster_documents(embedding_2d, min_cluster_size=2, core_dist_n_jobs=4, min_samples=1, gen_min_span_tree=False):
+    """Cluster documents using HDBSCAN"""
+    import hdbscan
+    print("Clustering documents...")
+    
+    # prediction_data lets new documents be assigned later with approximate_predict
+    clusterer = hdbscan.HDBSCAN(
+        min_cluster_size=min_cluster_size,
+        min_samples=min_samples,
+        metric='euclidean',
+        prediction_data=True,
+        # needed for relative_validity_ (DBCV), which the sweep evaluations report
+        gen_min_span_tree=gen_min_span_tree,
+        core_dist_n_jobs=core_dist_n_jobs
+    )
+    
+    cluster_labels = clusterer.fit_predict(embedding_2d)
+    
+    n_clusters = len(set(cluster_labels)) - (1 if -1 in cluster_labels else 0)
+    n_noise = list(cluster_labels).count(-1)
+    
+    print(f"Found {n_clusters} clusters")
+    print(f"Noise points: {n_noise}")
+    
+    return cluster_labels, clusterer
+
+def embedding_block(vectors, rows: Optional[np.ndarray], start: int, stop: int) -> np.ndarray:
+    """Unit length embeddings of documents start:stop, rows maps documents to rows of the embedding store"""
+    return normalize(vectors[start:stop] if rows is None else vectors[rows[start:stop]])
+
+def memory_plan(memory_mb: int, n: int, dims: int, sample_size: int, threads: int) -> Tuple[int, int]:
+    """
+    (sample size, rows per chunk) for the large corpus path. Within a memory ceiling the reduced embeddings
+    (and their copy for the documents outside the sample) come first, the rest is split between the fit and the
+    chunks being projected
+    """
+    if memory_mb <= 0:
+        return sample_size, MAX_CHUNK_ROWS
+    budget = (memory_mb - current_rss_mb()) * 2**20 - 2 * n * dims * 4
+    sample_size = min(sample_size, int(budget / 2 / FIT_BYTES_PER_ROW))
+    if sample_size < MIN_CHUNK_ROWS:
+        raise ValueError(f"memory_mb={memory_mb} leaves no room to cluster {n} documents in {dims} dimensions")
+    chunk_rows = int(budget / 2 / (threads * ASSIGN_BYTES_PER_ROW))
+    return sample_size, min(max(chunk_rows, MIN_CHUNK_ROWS), MAX_CHUNK_ROWS)
+
+def fit_pca(vectors, rows: Optional[np.ndarray], n: int, n_components: int, sample_size: int, random_state=42):
+    """PCA of the unit length embeddings fitted on a random sample, None when it would not reduce the dimension"""
+    if n_components <= 0 or n_components >= vectors.shape[1]:
+        return None
+    from sklearn.decomposition import PCA
+    rng = np.random.default_rng(random_state)
+    sample = np.sort(rng.choice(n, size=min(n, max(sample_size, n_components)), replace=False))
+    pca = PCA(n_components=n_components, svd_solver='randomized', random_state=random_state)
+    pca.fit(normalize(vectors[sample] if rows is None else vectors[rows[sample]]))
+    print(f"PCA to {n_components} dimensions keeps {pca.explained_variance_ratio_.sum():.1%} of the variance")
+    return pca
+
+def reduce_embeddings(embeddings, pca=None) -> np.ndarray:
+    """Embeddings in the space the large corpus path fits in: unit length, projected by pca"""
+    vectors = normalize(embeddings)
+    return vectors if pca is None else pca.transform(vectors).astype(np.float32)
+
+def reduce_documents(vectors, rows: Optional[np.ndarray], n: int, pca, threads: int, block_rows: int) -> np.ndarray:
+    """reduce_embeddings of all n documents, read from the store in blocks on threads"""
+    dims = vectors.shape[1] if pca is None else pca.n_components_
+    reduced = np.empty((n, dims), dtype=np.float32)
+
+    def reduce_block(start):
+        block = embedding_block(vectors, rows, start, start + block_rows)
+        reduced[start:start + len(block)] = block if pca is None else pca.transform(block)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(reduce_block, range(0, n, block_rows)))
+    return reduced
+
+def stratified_sample(reduced: np.ndarray, sample_size: int, strata: int = SAMPLE_STRATA,
+                      random_state=42) -> np.ndarray:
+    """
+    Sorted rows of a sample of about sample_size documents, drawn from every k-means cell of the reduced
+    embeddings in proportion to its size but at least MIN_PER_STRATUM, so small topics survive the sampling
+    """
+    from sklearn.cluster import MiniBatchKMeans
+    strata = max(1, min(strata, sample_size // MIN_PER_STRATUM))
+    cells = MiniBatchKMeans(n_clusters=strata, batch_size=4096, n_init=3,
+                            random_state=random_state).fit_predict(reduced)
+    counts = np.bincount(cells, minlength=strata)
+    quotas = np.minimum(counts, np.maximum(np.ceil(sample_size * counts / len(cells)).astype(np.int64),
+                                           MIN_PER_STRATUM))
+    order = np.argsort(cells, kind='stable')
+    starts = np.cumsum(counts) - counts
+    rng = np.random.default_rng(random_state)
+    picked = [rng.choice(order[start:start + count], size=quota, replace=False)
+              for start, count, quota in zip(starts.tolist(), counts.tolist(), quotas.tolist()) if quota]
+    return np.sort(np.concatenate(picked))
+
+def project_and_assign(reducer, clusterer, inputs: np.ndarray, threads: int = UMAP_THREADS,
+                       chunk_rows: int = MAX_CHUNK_ROWS) -> Tuple[np.ndarray, np.ndarray]:
+    """2D coordinates and topic labels of documents from the fitted reducer and clusterer, in chunks on threads"""
+    import hdbscan
+    n = len(inputs)
+    coords = np.empty((n, 2), dtype=np.float32)
+    labels = np.empty(n, dtype=np.int64)
+
+    def assign(start):
+        chunk_coords = reducer.transform(inputs[start:start + chunk_rows])
+        chunk_labels, _ = hdbscan.approximate_predict(clusterer, chunk_coords)
+        coords[start:start + len(chunk_coords)] = chunk_coords
+        labels[start:start + len(chunk_coords)] = chunk_labels
+
+    starts = list(range(0, n, chunk_rows))
+    if starts:
+        # the reducer prepares its neighbour search on first use, so the first chunk runs alone
+        assign(starts[0])
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(assign, starts[1:]))
+    return coords, labels
+
+def umap_large_corpus(vectors, rows: Optional[np.ndarray], n: int, sample_size: int, threads: int, memory_mb: int,
+                      pca_components: int, n_neighbors=15, min_dist=0.1, min_cluster_size=2, min_samples=1,
+                      random_state=42):
+    """
+    Fit on a sample instead of the whole corpus: the unit length embeddings are reduced by a PCA, UMAP and
+    HDBSCAN are fitted on a stratified sample and the other documents are projected and assigned in chunks.
+    Returns (coordinates, labels) of all n documents and the fitted (reducer, clusterer, pca)
+    """
+    dims = pca_components if 0 < pca_components < vectors.shape[1] else vectors.shape[1]
+    sample_size, chunk_rows = memory_plan(memory_mb, n, dims, sample_size, threads)
+    pca = fit_pca(vectors, rows, n, pca_components, sample_size, random_state)
+    reduced = reduce_documents(vectors, rows, n, pca, threads, chunk_rows)
+
+    sample = stratified_sample(reduced, sample_size, random_state=random_state)
+    print(f"Fitting on a stratified sample of {len(sample)} of {n} documents")
+    # euclidean distance between unit vectors ranks neighbours like the cosine distance
+    sample_2d, reducer = create_umap_projection(reduced[sample], n_neighbors, min_dist, random_state, metric='euclidean')
+    sample_labels, clusterer = cluster_documents(sample_2d, min_cluster_size, threads, min_samples)
+
+    embedding_2d = np.empty((n, 2), dtype=np.float32)
+    cluster_labels = np.empty(n, dtype=np.int64)
+    embedding_2d[sample] = sample_2d
+    cluster_labels[sample] = sample_labels
+    rest = np.setdiff1d(np.arange(n), sample, assume_unique=True)
+    print(f"Projecting {len(rest)} documents in chunks of {chunk_rows} on {threads} threads")
+    embedding_2d[rest], cluster_labels[rest] = project_and_assign(reducer, clusterer, reduced[rest], threads,
+                                                                  chunk_rows)
+    return embedding_2d, cluster_labels, (reducer, clusterer, pca)
+
+def analyze_clusters(doc_ids, filenames, cluster_labels):
+    """Analyze and print cluster information"""
+    import pandas as pd
+    df = pd.DataFrame({
+        'doc_id': doc_ids,
+        
+        'filename': filenames,
+        'cluster': cluster_labels
+    })
+    
+    print("\n=== CLUSTER ANALYSIS ===")
+    
+    # groupby splits the frame once, filtering it per cluster is quadratic on large corpora
+    for cluster_id, cluster_docs in df.groupby('cluster', sort=True):
+        if cluster_id == -1:
+            print(f"\nNOISE POINTS:")
+        else:
+            print(f"\nTOPIC {cluster_id}:")
+        
+        # for _, doc in cluster_docs.iterrows():
+        #     print(f"  - {doc['title']} (ID: {doc['doc_id']}, File: {doc['filename']})")
+    
+    return df
+
+def save_results(df, embedding_2d, save_prefix='topic_analysis'):
+    """Save results for later analysis"""
+    import pandas as pd
+    # Save cluster assignments
+    df.to_csv(f'{save_prefix}_clusters.csv', index=False)
+    
+    # Save UMAP coordinates
+    coords_df = pd.DataFrame({
+        'doc_id': df['doc_id'],
+        'umap_x': embedding_2d[:, 0],
+        'umap_y': embedding_2d[:, 1],
+        'cluster': df['cluster']
+    })
+    coords_df.to_csv(f'{save_prefix}_coordinates.csv', index=False)
+    
+    print(f"\nResults saved:")
+    print(f"- {save_prefix}_clusters.csv")
+    print(f"- {save_prefix}_coordinates.csv")
+
+def write_topics(doc_ids, cluster_labels, embedding_2d):
+    """
+    Replace topics, document_topics and doc_coords with one clustering result in a single transaction,
+    readers keep seeing the previous topic set until the commit
+    """
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    cluster_labels = np.asarray(cluster_labels, dtype=np.int64)
+    embedding_2d = np.asarray(embedding_2d, dtype=np.float64)
+    labels = np.unique(cluster_labels)
+
+    conn = connect_db()
+    try:
+        with conn.cursor() as cur:
+            # in order to make this step idempotent, first delete from all these child tables in reverse order
+            cur.execute("DELETE FROM doc_coords")
+            cur.execute("DELETE FROM document_topics")
+            cur.execute("DELETE FROM topics")
+
+            cur.execute(
+                """INSERT INTO topics (title, cluster_label)
+                   SELECT 'default', label FROM unnest(%s::integer[]) AS label
+                   RETURNING cluster_label, id""",
+                (labels.tolist(),)
+            )
+            label_topics = dict(cur.fetchall())
+            topic_ids = np.array([label_topics[label] for label in labels.tolist()], dtype=np.int64)
+            doc_topic_ids = topic_ids[np.searchsorted(labels, cluster_labels)]
+
+            cur.copy_expert(
+                "COPY document_topics (topic_id, document_id) FROM STDIN",
+                io.StringIO(''.join(f"{t}\t{d}\n" for t, d in zip(doc_topic_ids.tolist(), doc_ids.tolist())))
+            )
+            cur.copy_expert(
+                "COPY doc_coords (document_id, x, y) FROM STDIN",
+                io.StringIO(''.join(
+                    f"{d}\t{x!r}\t{y!r}\n"
+                    for d, (x, y) in zip(doc_ids.tolist(), embedding_2d[:, :2].tolist())
+                ))
+            )
+            bump_pipeline_version(cur)
+        conn.commit()
+        print(f"Saved {len(labels)} topics and {len(doc_ids)} document assignments")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def topics():
+    """Re-apply the last saved clustering (topic_analysis_coordinates.csv), umap() already writes its results"""
+    import pandas as pd
+    df = pd.read_csv(r'topic_analysis_coordinates.csv')
+    record_progress(documents=len(df))
+    write_topics(df['doc_id'].to_numpy(), df['cluster'].to_numpy(), df[['umap_x', 'umap_y']].to_numpy())
+
+@contextmanager
+def topic_model_lock():
+    """Serialize the read-modify-write of the saved topic model between workers sharing its volume"""
+    os.makedirs(os.path.dirname(TOPIC_MODEL_PATH), exist_ok=True)
+    with open(TOPIC_MODEL_PATH + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def dump_topic_model(model: dict):
+    """Write the topic model next to the old one and swap it in, readers never see a partial pickle"""
+    import joblib
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(TOPIC_MODEL_PATH), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            joblib.dump(model, f)
+        os.replace(tmp_path, TOPIC_MODEL_PATH)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def save_topic_model(reducer, clusterer, cluster_labels, pca=None, reduced=False):
+    """
+    Persist the fitted reducer and clusterer for incremental assignment, reduced when they were fitted on
+    reduce_embeddings output (the large corpus path) rather than on the raw embeddings
+    """
+    cluster_labels = np.asarray(cluster_labels)
+    model = {
+        'reducer': reducer,
+        'clusterer': clusterer,
+        'reduced': reduced,
+        'pca': pca,
+        # the clusterer only knows the labels of the sample it was fitted on
+        'labels': np.unique(cluster_labels).tolist(),
+        'n_fitted': len(cluster_labels),
+        'n_assigned': 0,
+        'fit_noise_ratio': float(np.mean(cluster_labels == -1)) if len(cluster_labels) else 0.0,
+        'assigned_noise': 0,
+        'fitted_at': time.time()
+    }
+    with topic_model_lock():
+        dump_topic_model(model)
+    print(f"Saved topic model to {TOPIC_MODEL_PATH}")
+
+def load_topic_model() -> Optional[dict]:
+    """The saved topic model, kept in memory until the file on disk changes"""
+    if not os.path.exists(TOPIC_MODEL_PATH):
+        return None
+    import joblib
+    return cached_model(('topic_model', TOPIC_MODEL_PATH), lambda: joblib.load(TOPIC_MODEL_PATH),
+                        version=os.path.getmtime(TOPIC_MODEL_PATH))
+
+def topic_drift(model: dict, new_labels: np.ndarray) -> float:
+    """Drift of the fitted model if new_labels were added: corpus growth, or the rise in the noise share"""
+    n_assigned = model['n_assigned'] + len(new_labels)
+    growth = n_assigned / max(model['n_fitted'], 1)
+    assigned_noise = model['assigned_noise'] + int(np.sum(new_labels == -1))
+    noise_increase = assigned_noise / max(n_assigned, 1) - model['fit_noise_ratio']
+    return max(growth, noise_increase)
+
+def umap_incremental(drift_threshold: float = REFIT_DRIFT_THRESHOLD, threads: int = UMAP_THREADS):
+    """
+    Project and assign only documents without coordinates using the persisted reducer and clusterer,
+    falls back to a full refit when there is no usable model or drift passes drift_threshold
+    """
+    model = load_topic_model()
+    if model is None:
+        print("No fitted topic model yet, running a full refit")
+        return umap()
+
+    conn = connect_db()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT d.id FROM documents d
+                WHERE d.embedding IS NOT NULL
+                  AND NOT EXISTS (SELECT 1 FROM doc_coords dc WHERE dc.document_id = d.id)
+                ORDER BY d.id
+            """)
+            new_ids = np.array([row[0] for row in cur.fetchall()], dtype=np.int64)
+            cur.execute("SELECT cluster_label, id FROM topics WHERE cluster_label IS NOT NULL")
+            label_topics = dict(cur.fetchall())
+        conn.commit()
+        if len(new_ids) == 0:
+            print("No new documents to assign")
+            return
+
+        # the topics table must come from the same fit as the saved model
+        fitted_labels = model.get('labels', np.unique(model['clusterer'].labels_).tolist())
+        if set(label_topics) != set(int(label) for label in fitted_labels):
+            print("Topics do not match the saved topic model, running a full refit")
+            return umap()
+
+        embeddings = load_embedding_matrix(conn, new_ids)
+        if model.get('reduced'):
+            embeddings = reduce_embeddings(embeddings, model['pca'])
+        coords, labels = project_and_assign(model['reducer'], model['clusterer'], embeddings, threads)
+
+        drift = topic_drift(model, labels)
+        print(f"Assigned {len(new_ids)} new documents, drift {drift:.3f}")
+        if drift > drift_threshold:
+            print(f"Drift is above {drift_threshold}, running a full refit")
+            return umap()
+
+        with conn.cursor() as cur:
+            execute_values(
+                cur,
+                "INSERT INTO doc_coords (document_id, x, y) VALUES %s",
+                [(int(doc_id), float(x), float(y)) for doc_id, (x, y) in zip(new_ids, coords)]
+            )
+            execute_values(
+                cur,
+                "INSERT INTO document_topics (topic_id, document_id) VALUES %s ON CONFLICT DO NOTHING",
+                [(label_topics[int(label)], int(doc_id)) for doc_id, label in zip(new_ids, labels)]
+            )
+            bump_pipeline_version(cur)
+        conn.commit()
+        record_progress(documents=len(new_ids))
+
+        with topic_model_lock():
+            # add to the counts on disk, other workers may have assigned documents since the model was loaded
+            current = load_topic_model()
+            if current is None or current.get('fitted_at') != model.get('fitted_at'):
+                print("The topic model was refitted meanwhile, not updating its drift counts")
+                return
+            current = dict(current)
+            current['n_assigned'] += len(labels)
+            current['assigned_noise'] += int(np.sum(labels == -1))
+            dump_topic_model(current)
+    finally:
+        conn.close()
+
+def umap(sample_size: int = UMAP_SAMPLE_SIZE, threads: int = UMAP_THREADS, memory_mb: int = UMAP_MEMORY_MB,
+         pca_components: int = UMAP_PCA_COMPONENTS, n_neighbors: int = UMAP_N_NEIGHBORS,
+         min_dist: float = UMAP_MIN_DIST, min_cluster_size: int = HDBSCAN_MIN_CLUSTER_SIZE,
+         min_samples: int = HDBSCAN_MIN_SAMPLES):
+    """
+    Project and cluster every document with an embedding. Corpora of more than sample_size documents
+    (0 for no limit) take the umap_large_corpus path, threads, memory_mb and pca_components only apply there
+    """
+    # Step 1: Fetch embeddings from the on-disk store
+    conn = connect_db()
+    try:
+        doc_ids, titles, filenames = fetch_documents(conn)
+        large_corpus = 0 < sample_size < len(doc_ids)
+        if large_corpus:
+            vectors, rows = open_embedding_rows(conn, np.array(doc_ids, dtype=np.int64))
+        else:
+            embeddings = load_embedding_matrix(conn, np.array(doc_ids, dtype=np.int64))
+            print(f"Embedding shape: {embeddings.shape}")
+    finally:
+        conn.close()
+    print(f"Loaded {len(doc_ids)} document embeddings")
+    record_progress(documents=len(doc_ids))
+    
+    if large_corpus:
+        # Steps 2 and 3 on a sample, the rest projected and assigned
+        embedding_2d, cluster_labels, (reducer, clusterer, pca) = umap_large_corpus(
+            vectors, rows, len(doc_ids), sample_size, threads, memory_mb, pca_components,
+            n_neighbors, min_dist, min_cluster_size, min_samples)
+        save_topic_model(reducer, clusterer, cluster_labels, pca=pca, reduced=True)
+    else:
+        # Step 2: Create UMAP projection
+        embedding_2d, reducer = create_umap_projection(embeddings, n_neighbors, min_dist)
+        
+        # Step 3: Cluster documents
+        cluster_labels, clusterer = cluster_documents(embedding_2d, min_cluster_size, min_samples=min_samples)
+        save_topic_model(reducer, clusterer, cluster_labels)
+    
+    # Step 4: Visualize results (otherwise the render_map task draws the map on demand)
+    if RENDER_MAP_ON_UMAP:
+        plot_topic_map(embedding_2d, cluster_labels, filenames)
+    
+    # Step 5: Analyze clusters
+    df = analyze_clusters(doc_ids, filenames, cluster_labels)
+    
+    # Step 6: Save results
+    save_results(df, embedding_2d)
+    
+    # Step 7: Store topics and coordinates
+    write_topics(doc_ids, cluster_labels, embedding_2d)
+    
+    return df, embedding_2d, cluster_labels
@@ -0,0 +1,125 @@
+"""Worker settings, read from the environment where they can differ between deployments"""
+import os
+import socket
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://redis:6379')
+DB_CONFIG = {
+    "dbname": os.getenv('DB_NAME', "second_brain"),
+    "user": os.getenv('DB_USER', "postgres"),
+    "password": os.getenv('DB_PASSWORD', "test_case"),
+    "host": os.getenv('DB_HOST', "postgres"),
+    "port": int(os.getenv('DB_PORT', '5432'))
+}
+MAX_BYTES = 1048575
+DATA_FOLDER = os.getenv('DATA_FOLDER', "data/")
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sql', 'migrations')
+PAGE_BREAK = "\n\n<<PAGE_BREAK>>\n\n"
+# PDF extraction: parallel processes, hard per-file timeout in seconds, pages read per file, rows per insert batch
+PDF_WORKERS = int(os.getenv('PDF_WORKERS', str(os.cpu_count() or 1)))
+PDF_TIMEOUT = float(os.getenv('PDF_TIMEOUT', '300'))
+PDF_MAX_PAGES = int(os.getenv('PDF_MAX_PAGES', '2000'))
+PDF_INSERT_BATCH = int(os.getenv('PDF_INSERT_BATCH', '50'))
+# a sentence-transformers model name, or 'stub' / 'stub:<dimension>' for the hashing model (no weights to download)
+EMBEDDING_MODEL_NAME = os.getenv('EMBEDDING_MODEL', 'all-MiniLM-L6-v2')
+# chunks per model.encode call, and how many chunks (across documents) are packed before encoding
+EMBED_BATCH_SIZE = int(os.getenv('EMBED_BATCH_SIZE', '64'))
+EMBED_PACK_SIZE = int(os.getenv('EMBED_PACK_SIZE', '4096'))
+# rows buffered per COPY/commit, and the COPY encoding ('binary' or 'text')
+COPY_BATCH_SIZE = int(os.getenv('COPY_BATCH_SIZE', '5000'))
+COPY_FORMAT = os.getenv('COPY_FORMAT', 'binary')
+# rows per round-trip when streaming documents through a server-side cursor
+EMBED_FETCH_SIZE = int(os.getenv('EMBED_FETCH_SIZE', '50'))
+# chunk embedding cache: entries kept in the in-process LRU (0 disables it) and whether to use the embedding_cache table
+EMBED_CACHE_SIZE = int(os.getenv('EMBED_CACHE_SIZE', '50000'))
+EMBED_CACHE_PERSIST = os.getenv('EMBED_CACHE_PERSIST', '1') == '1'
+# float32 document embedding matrix kept on disk for the umap task
+EMBEDDING_STORE_DIR = os.getenv('EMBEDDING_STORE_DIR', os.path.join(DATA_FOLDER, 'output', 'embeddings'))
+# fitted UMAP reducer and HDBSCAN clusterer kept for incremental topic assignment
+TOPIC_MODEL_PATH = os.getenv('TOPIC_MODEL_PATH', os.path.join(DATA_FOLDER, 'output', 'models', 'topic_model.joblib'))
+# incremental assignment falls back to a full refit once drift (corpus growth since the fit, or the
+# increase in the share of noise points among newly assigned documents) passes this
+REFIT_DRIFT_THRESHOLD = float(os.getenv('REFIT_DRIFT_THRESHOLD', '0.2'))
+# umap fits the reducer and clusterer on a stratified sample of UMAP_SAMPLE_SIZE documents once the corpus is
+# larger (0 always fits on everything), after a PCA of the embeddings to UMAP_PCA_COMPONENTS dimensions (0 skips it),
+# and projects the other documents in chunks on UMAP_THREADS threads, sized to stay within UMAP_MEMORY_MB of worker
+# memory (0 for no ceiling)
+UMAP_SAMPLE_SIZE = int(os.getenv('UMAP_SAMPLE_SIZE', '50000'))
+UMAP_PCA_COMPONENTS = int(os.getenv('UMAP_PCA_COMPONENTS', '50'))
+UMAP_THREADS = int(os.getenv('UMAP_THREADS', str(os.cpu_count() or 1)))
+UMAP_MEMORY_MB = int(os.getenv('UMAP_MEMORY_MB', '0'))
+# UMAP neighbourhood size and minimum distance, HDBSCAN minimum cluster size and samples (defaults of the umap task)
+UMAP_N_NEIGHBORS = int(os.getenv('UMAP_N_NEIGHBORS', '15'))
+UMAP_MIN_DIST = float(os.getenv('UMAP_MIN_DIST', '0.1'))
+HDBSCAN_MIN_CLUSTER_SIZE = int(os.getenv('HDBSCAN_MIN_CLUSTER_SIZE', '2'))
+HDBSCAN_MIN_SAMPLES = int(os.getenv('HDBSCAN_MIN_SAMPLES', '1'))
+# the topic map PNG is rendered by the render_map task, or by umap itself with RENDER_MAP_ON_UMAP=1
+RENDER_MAP_ON_UMAP = os.getenv('RENDER_MAP_ON_UMAP', '0') == '1'
+TOPIC_MAP_PATH = os.getenv('TOPIC_MAP_PATH', 'topic_map.png')
+TOPIC_MAP_DPI = int(os.getenv('TOPIC_MAP_DPI', '150'))
+# above this many documents the map is drawn as a density image instead of one marker per document
+TOPIC_MAP_DENSITY_THRESHOLD = int(os.getenv('TOPIC_MAP_DENSITY_THRESHOLD', '20000'))
+# document titles drawn on the map, sampled when there are more documents
+TOPIC_MAP_MAX_LABELS = int(os.getenv('TOPIC_MAP_MAX_LABELS', '100'))
+# approximate nearest neighbour indexes over document and chunk vectors (IVF, memory-mapped): embed_pdfs appends
+# new vectors to a delta segment, the ann_index stage rebuilds an index once its delta passes ANN_REBUILD_RATIO
+ANN_INDEX_DIR = os.getenv('ANN_INDEX_DIR', os.path.join(DATA_FOLDER, 'output', 'ann'))
+ANN_INDEX_DELTA = os.getenv('ANN_INDEX_DELTA', '1') == '1'
+ANN_REBUILD_RATIO = float(os.getenv('ANN_REBUILD_RATIO', '0.1'))
+# inverted lists per index (0 picks about sqrt(n)), lists scanned per query, vectors sampled to train the centroids
+ANN_NLIST = int(os.getenv('ANN_NLIST', '0'))
+ANN_NPROBE = int(os.getenv('ANN_NPROBE', '16'))
+ANN_TRAIN_SAMPLE = int(os.getenv('ANN_TRAIN_SAMPLE', '100000'))
+SEARCH_PORT = int(os.getenv('SEARCH_PORT', '8001'))
+# embed_pdfs chunking: 'tokens' (windows of CHUNK_TOKENS model tokens overlapping by CHUNK_OVERLAP_TOKENS),
+# 'sentences' (sentences packed up to CHUNK_CHARS characters, never across a page break) or 'chars' (the original
+# 100 character windows)
+CHUNK_STRATEGY = os.getenv('CHUNK_STRATEGY', 'tokens')
+CHUNK_TOKENS = int(os.getenv('CHUNK_TOKENS', '256'))
+CHUNK_OVERLAP_TOKENS = int(os.getenv('CHUNK_OVERLAP_TOKENS', '32'))
+CHUNK_CHARS = int(os.getenv('CHUNK_CHARS', '1000'))
+# documents tokenized together in one call
+CHUNK_BATCH_DOCS = int(os.getenv('CHUNK_BATCH_DOCS', '16'))
+SPACY_MODEL = 'en_core_web_sm'
+SPACY_MAX_LENGTH = 5000000
+# pipeline components the token / noun chunk filter never reads (noun_chunks needs the parser, lemmas need the tagger)
+SPACY_DISABLED_COMPONENTS = ['ner']
+# worker processes for term extraction (1 keeps the serial path) and documents handed to a worker at a time
+TERMS_PROCESSES = int(os.getenv('TERMS_PROCESSES', '1'))
+TERMS_BATCH_SIZE = int(os.getenv('TERMS_BATCH_SIZE', '20'))
+# 'incremental' applies only the documents whose terms or topic changed since the last tf_idf run,
+# 'full' rebuilds every topic table; incremental falls back to full past TFIDF_FULL_REBUILD_RATIO changed documents
+TFIDF_MODE = os.getenv('TFIDF_MODE', 'incremental')
+TFIDF_FULL_REBUILD_RATIO = float(os.getenv('TFIDF_FULL_REBUILD_RATIO', '0.2'))
+# 'sql' runs the refresh procedures above, 'python' computes topic_top_terms in memory with sparse matrices
+# ('legacy' weighting reproduces the SQL scores, 'ctfidf' is the BERTopic class-based tf-idf)
+TFIDF_ENGINE = os.getenv('TFIDF_ENGINE', 'sql')
+TFIDF_WEIGHTING = os.getenv('TFIDF_WEIGHTING', 'legacy')
+TFIDF_TOP_K = int(os.getenv('TFIDF_TOP_K', '5'))
+# Redis job queue: jobs are reserved into a per-worker processing list and removed once done,
+# a failed job is retried until JOB_MAX_ATTEMPTS and then moved to the dead letter list
+JOB_QUEUE = os.getenv('QUEUE_NAME', 'python_tasks')
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+# embed_pdfs and terms are split into sub-tasks of this many documents that any worker replica can pick up,
+# 0 runs them as a single job
+JOB_DOCS_PER_TASK = int(os.getenv('JOB_DOCS_PER_TASK', '500'))
+# a worker whose heartbeat is older than this is considered dead and its reserved jobs are re-queued
+WORKER_HEARTBEAT_TTL = int(os.getenv('WORKER_HEARTBEAT_TTL', '60'))
+WORKER_ID = os.getenv('WORKER_ID', f"{socket.gethostname()}-{os.getpid()}")
+PIPELINE_TTL = 7 * 24 * 3600
+# a sweep job fans out at most this many evaluation variants, each evaluated on up to SWEEP_SAMPLE_DOCUMENTS
+# (chunking) documents
+SWEEP_MAX_VARIANTS = int(os.getenv('SWEEP_MAX_VARIANTS', '100'))
+SWEEP_SAMPLE_DOCUMENTS = int(os.getenv('SWEEP_SAMPLE_DOCUMENTS', '200'))
+# pipeline stage -> stages it waits for. The pipeline projects and assigns new documents with the saved
+# topic model, umap_incremental refits only without one or on drift; the full refit stays the umap task
+PIPELINE_STAGES = {
+    'process_pdfs': [],
+    'embed_pdfs': ['process_pdfs'],
+    'terms': ['process_pdfs'],
+    'umap_incremental': ['embed_pdfs'],
+    'tf_idf': ['umap_incremental', 'terms'],
+    'ann_index': ['embed_pdfs'],
+}
+# running tasks publish their progress to this Redis hash (worker id -> JSON) every METRICS_PUBLISH_INTERVAL seconds
+STATUS_KEY = f"{JOB_QUEUE}:status"
+METRICS_PUBLISH_INTERVAL = float(os.getenv('METRICS_PUBLISH_INTERVAL', '2'))
@@ -0,0 +1,154 @@
+"""Database connections, migrations and the COPY helpers shared by the stages"""
+import os
+import struct
+import tempfile
+import psycopg2
+import numpy as np
+from typing import List, Iterator
+
+from config import DB_CONFIG, EMBED_FETCH_SIZE, MIGRATIONS_DIR
+from metrics import db_timer
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Cursor that adds the time spent waiting on the database to the running StageMetrics"""
+
+    def execute(self, query, vars=None):
+        with db_timer():
+            return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        with db_timer():
+            return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        with db_timer():
+            return super().copy_expert(sql, file, size)
+
+    def fetchone(self):
+        with db_timer():
+            return super().fetchone()
+
+    def fetchmany(self, size=None):
+        with db_timer():
+            return super().fetchmany(self.arraysize if size is None else size)
+
+    def fetchall(self):
+        with db_timer():
+            return super().fetchall()
+
+    def __iter__(self):
+        # named cursors fetch itersize rows per round trip, time each round trip
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            yield from rows
+
+class TimedConnection(psycopg2.extensions.connection):
+    def commit(self):
+        with db_timer():
+            return super().commit()
+
+def connect_db():
+    """Open a database connection whose time is accounted as DB time in the running StageMetrics"""
+    return psycopg2.connect(connection_factory=TimedConnection, cursor_factory=TimedCursor, **DB_CONFIG)
+
+def iter_documents(conn, sql: str, params=None, name: str = 'document_stream',
+                   itersize: int = EMBED_FETCH_SIZE) -> Iterator[tuple]:
+    """
+    Stream rows through a server-side (named) cursor so only itersize rows are held at a time.
+    Use a connection that is not committed while iterating, committing closes the cursor.
+    """
+    with conn.cursor(name=name) as cur:
+        cur.itersize = itersize
+        cur.execute(sql, params)
+        for row in cur:
+            yield row
+
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+
+PGCOPY_TRAILER = struct.pack('!h', -1)
+
+FLOAT4_OID = 700
+
+def copy_text_escape(value: str) -> str:
+    """Escape a value for COPY text format"""
+    return (value.replace('\\', '\\\\').replace('\n', '\\n')
+                 .replace('\r', '\\r').replace('\t', '\\t'))
+
+def copy_binary_real_arrays(embeddings: np.ndarray) -> List[bytes]:
+    """Encode each row of a 2D matrix as a COPY binary real[] field (length prefix included)"""
+    n_rows, dim = embeddings.shape
+    # each element is an int32 length (always 4) followed by the big-endian float4 value
+    cells = np.empty((n_rows, dim), dtype=[('len', '>i4'), ('val', '>f4')])
+    cells['len'] = 4
+    cells['val'] = embeddings
+    # field length, then the array header: ndim, has_nulls, element type, dimension size, lower bound
+    header = struct.pack('!iiiiii', 20 + 8 * dim, 1, 0, FLOAT4_OID, dim, 1)
+    return [header + row.tobytes() for row in cells]
+
+def copy_int_columns(conn, query: str, n_columns: int) -> List[np.ndarray]:
+    """
+    Run a query returning n_columns non-null integer columns through a binary COPY and return each column
+    as an int32 array, the COPY file is read as a fixed-size record array instead of row by row
+    """
+    row_dtype = np.dtype([('nfields', '>i2')] + [(f'c{i}', [('len', '>i4'), ('val', '>i4')]) for i in range(n_columns)])
+    with tempfile.NamedTemporaryFile(suffix='.copy') as copy_file:
+        with conn.cursor() as cur:
+            cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT binary)", copy_file)
+        copy_file.flush()
+        with open(copy_file.name, 'rb') as f:
+            header = f.read(19)
+        if header[:11] != PGCOPY_HEADER[:11]:
+            raise ValueError("not a binary COPY file")
+        offset = 19 + struct.unpack('!i', header[15:19])[0]
+        body = os.path.getsize(copy_file.name) - offset - len(PGCOPY_TRAILER)
+        if body % row_dtype.itemsize:
+            raise ValueError("unexpected row layout in integer COPY")
+        n_rows = body // row_dtype.itemsize
+        if n_rows == 0:
+            return [np.empty(0, dtype=np.int32) for _ in range(n_columns)]
+        rows = np.memmap(copy_file.name, dtype=row_dtype, mode='r', offset=offset, shape=(n_rows,))
+        if (rows['nfields'] != n_columns).any() or any((rows[f'c{i}']['len'] != 4).any() for i in range(n_columns)):
+            raise ValueError("unexpected row layout in integer COPY")
+        columns = [np.array(rows[f'c{i}']['val'], dtype=np.int32) for i in range(n_columns)]
+        del rows
+    return columns
+
+# pg_advisory_lock key serializing apply_migrations between workers
+MIGRATIONS_LOCK_ID = 7215304
+# held shared by every embed_pdfs run, exclusively by an unscoped run while it removes leftover chunks
+EMBED_LOCK_ID = 7215305
+
+def bump_pipeline_version(cur):
+    """Invalidate the dashboard caches, call it in the transaction that changes what they show"""
+    cur.execute("UPDATE pipeline_state SET version = version + 1, updated_at = now()")
+
+def apply_migrations():
+    """
+    Apply the sql/migrations scripts not recorded in schema_migrations yet, on top of output_schema.sql, in file
+    name order, each in its own transaction. The scripts stay idempotent: a database from before schema_migrations
+    runs every one of them once more
+    """
+    conn = connect_db()
+    try:
+        with conn.cursor() as cur:
+            # workers starting together wait here for the first one, which applies the new scripts; the lock is
+            # held by the session, so it spans the commits and goes away with the connection
+            cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK_ID,))
+            cur.execute("""CREATE TABLE IF NOT EXISTS public.schema_migrations (
+                               name text PRIMARY KEY,
+                               applied_at timestamp without time zone NOT NULL DEFAULT now()
+                           )""")
+            cur.execute("SELECT name FROM schema_migrations")
+            applied = {row[0] for row in cur.fetchall()}
+            conn.commit()
+            for name in sorted(os.listdir(MIGRATIONS_DIR)):
+                if name.endswith('.sql') and name not in applied:
+                    with open(os.path.join(MIGRATIONS_DIR, name)) as f:
+                        cur.execute(f.read())
+                    cur.execute("INSERT INTO schema_migrations (name) VALUES (%s)", (name,))
+                    conn.commit()
+                    print(f"Applied migration {name}")
+    finally:
+        conn.close()
@@ -0,0 +1,734 @@
+"""embed_pdfs stage: chunk embeddings, document means and the on-disk document embedding store"""
+import os
+import io
+import re
+import json
+import struct
+import fcntl
+import hashlib
+import zlib
+import tempfile
+import psycopg2
+import numpy as np
+from typing import List, Tuple, Dict, Iterable, Iterator, Optional
+from contextlib import contextmanager
+from collections import defaultdict, OrderedDict
+
+from config import (EMBEDDING_MODEL_NAME, EMBED_BATCH_SIZE, EMBED_PACK_SIZE, COPY_BATCH_SIZE, COPY_FORMAT,
+                    EMBED_CACHE_SIZE, EMBED_CACHE_PERSIST, EMBEDDING_STORE_DIR, ANN_INDEX_DELTA,
+                    CHUNK_BATCH_DOCS, CHUNK_STRATEGY)
+from chunking import get_chunker
+from db import connect_db, iter_documents, EMBED_LOCK_ID, PGCOPY_HEADER, PGCOPY_TRAILER, copy_binary_real_arrays
+from metrics import record_progress
+from models import cached_model
+
+class EmbeddingCache:
+    """
+    Content-addressed chunk embedding cache keyed by (model name, hash of the chunk text).
+    A bounded in-process LRU sits in front of the persistent embedding_cache table.
+    """
+
+    def __init__(self, model_name: str, max_entries: int = EMBED_CACHE_SIZE, persistent: bool = EMBED_CACHE_PERSIST):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.persistent = persistent
+        self.lru = OrderedDict()
+        self.conn = None
+        self.hits_batch = 0  # repeats within one encode call
+        self.hits_memory = 0
+        self.hits_persistent = 0
+        self.misses = 0
+
+    @staticmethod
+    def text_hash(text: str) -> bytes:
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+    def _connection(self):
+        # the engine outlives tasks, so reconnect if the connection was dropped in between
+        if self.conn is None or self.conn.closed:
+            self.conn = connect_db()
+            with self.conn.cursor() as cur:
+                cur.execute("""
+                    CREATE TEMP TABLE IF NOT EXISTS embedding_cache_staging (
+                        text_hash bytea,
+                        embedding real[]
+                    ) ON COMMIT DELETE ROWS
+                """)
+            self.conn.commit()
+        return self.conn
+
+    def _remember(self, key: bytes, embedding: np.ndarray):
+        if self.max_entries <= 0:
+            return
+        self.lru[key] = embedding
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.max_entries:
+            self.lru.popitem(last=False)
+
+    def lookup(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        """Return the cached embeddings for the distinct keys given, memory first then the table"""
+        found = {}
+        for key in keys:
+            embedding = self.lru.get(key)
+            if embedding is not None:
+                self.lru.move_to_end(key)
+                found[key] = embedding
+        self.hits_memory += len(found)
+
+        remaining = [key for key in keys if key not in found]
+        if remaining and self.persistent:
+            try:
+                conn = self._connection()
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "SELECT text_hash, embedding FROM embedding_cache WHERE model_name = %s AND text_hash = ANY(%s)",
+                        (self.model_name, [psycopg2.Binary(key) for key in remaining])
+                    )
+                    rows = cur.fetchall()
+                conn.commit()
+            except psycopg2.Error as e:
+                print(f"Embedding cache lookup failed: {e}")
+                self.conn = None
+                rows = []
+            for key, embedding in rows:
+                key = bytes(key)
+                found[key] = np.asarray(embedding, dtype=np.float32)
+                self._remember(key, found[key])
+            self.hits_persistent += len(rows)
+
+        self.misses += len(keys) - len(found)
+        return found
+
+    def store(self, keys: List[bytes], embeddings: np.ndarray):
+        """Add freshly encoded embeddings to both tiers"""
+        for key, embedding in zip(keys, embeddings):
+            self._remember(key, embedding)
+        if not self.persistent or not keys:
+            return
+
+        buf = io.BytesIO()
+        buf.write(PGCOPY_HEADER)
+        for key, array in zip(keys, copy_binary_real_arrays(np.asarray(embeddings, dtype=np.float32))):
+            buf.write(struct.pack('!hi', 2, len(key)))
+            buf.write(key)
+            buf.write(array)
+        buf.write(PGCOPY_TRAILER)
+        buf.seek(0)
+        try:
+            conn = self._connection()
+            with conn.cursor() as cur:
+                cur.copy_expert("COPY embedding_cache_staging (text_hash, embedding) FROM STDIN WITH (FORMAT binary)", buf)
+                cur.execute(
+                    """INSERT INTO embedding_cache (model_name, text_hash, embedding)
+                       SELECT %s, text_hash, embedding FROM embedding_cache_staging
+                       ON CONFLICT DO NOTHING""",
+                    (self.model_name,)
+                )
+            conn.commit()
+        except psycopg2.Error as e:
+            print(f"Embedding cache write failed: {e}")
+            self.conn = None
+
+    def stats(self) -> Dict[str, float]:
+        hits = self.hits_batch + self.hits_memory + self.hits_persistent
+        lookups = hits + self.misses
+        return {
+            'hits_batch': self.hits_batch,
+            'hits_memory': self.hits_memory,
+            'hits_persistent': self.hits_persistent,
+            'misses': self.misses,
+            'hit_rate': hits / lookups if lookups else 0.0
+        }
+
+    def reset_stats(self):
+        self.hits_batch = self.hits_memory = self.hits_persistent = self.misses = 0
+
+class StubEmbeddingModel:
+    """
+    Deterministic stand-in for a SentenceTransformer: signed feature hashing of the lower-cased words,
+    L2 normalised. Similar texts get similar vectors, which is all the benchmark and tests need
+    """
+    TOKEN_PATTERN = re.compile(r"\w+")
+
+    def __init__(self, dimension: int = 384):
+        self.dimension = dimension
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dimension
+
+    def encode(self, texts: List[str], batch_size: int = 32, convert_to_numpy: bool = True,
+               show_progress_bar: bool = False) -> np.ndarray:
+        embeddings = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            hashes = np.array([zlib.crc32(token.encode()) for token in self.TOKEN_PATTERN.findall(text.lower())],
+                              dtype=np.int64)
+            if len(hashes) == 0:
+                continue
+            signs = np.where(hashes & (1 << 31), -1.0, 1.0)
+            embeddings[row] = np.bincount(hashes % self.dimension, weights=signs, minlength=self.dimension)
+            norm = np.linalg.norm(embeddings[row])
+            if norm > 0:
+                embeddings[row] /= norm
+        return embeddings
+
+def load_embedding_model(model_name: str):
+    if model_name == 'stub' or model_name.startswith('stub:'):
+        print(f"Using the hashing stub embedding model {model_name}")
+        return StubEmbeddingModel(int(model_name.split(':', 1)[1]) if ':' in model_name else 384)
+    from sentence_transformers import SentenceTransformer
+    print(f"Loading SentenceTransformer model {model_name}...")
+    return SentenceTransformer(model_name)
+
+class EmbeddingEngine:
+    """Keeps one SentenceTransformer alive and encodes chunks from many documents in packed batches"""
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL_NAME, batch_size: int = EMBED_BATCH_SIZE,
+                 pack_size: int = EMBED_PACK_SIZE):
+        self.model_name = model_name
+        self.model = cached_model(('embedding', model_name), lambda: load_embedding_model(model_name))
+        self.dimension = self.model.get_sentence_embedding_dimension()
+        self.batch_size = batch_size
+        self.pack_size = max(pack_size, batch_size)
+        self.cache = EmbeddingCache(model_name) if (EMBED_CACHE_SIZE > 0 or EMBED_CACHE_PERSIST) else None
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """
+        Encode texts, returns a float32 matrix in input order.
+        Repeated texts are encoded once and cached embeddings are reused when the cache is enabled.
+        """
+        if self.cache is None or not texts:
+            return self.encode_batches(texts)
+
+        keys = [EmbeddingCache.text_hash(t) for t in texts]
+        first_rows = {}
+        for row, key in enumerate(keys):
+            first_rows.setdefault(key, row)
+        self.cache.hits_batch += len(keys) - len(first_rows)
+        cached = self.cache.lookup(list(first_rows))
+
+        missing = [key for key in first_rows if key not in cached]
+        if missing:
+            encoded = self.encode_batches([texts[first_rows[key]] for key in missing])
+            self.cache.store(missing, encoded)
+            cached.update(zip(missing, encoded))
+        return np.stack([cached[key] for key in keys]).astype(np.float32, copy=False)
+
+    def encode_batches(self, texts: List[str]) -> np.ndarray:
+        """Encode texts in fixed-size, length-sorted batches, returns a float32 matrix in input order"""
+        embeddings = np.empty((len(texts), self.dimension), dtype=np.float32)
+        # sorting by length keeps similar sized chunks together so each batch pads to a similar max
+        order = np.argsort([len(t) for t in texts], kind='stable')
+        for start in range(0, len(order), self.batch_size):
+            rows = order[start:start + self.batch_size]
+            embeddings[rows] = self.model.encode(
+                [texts[i] for i in rows],
+                batch_size=self.batch_size,
+                convert_to_numpy=True,
+                show_progress_bar=False
+            )
+        return embeddings
+
+    def iter_chunk_embeddings(self, documents: Iterable[Tuple[int, List[str]]]
+                              ) -> Iterator[Tuple[List[Tuple[int, int]], List[str], np.ndarray]]:
+        """
+        Pack chunks from many documents into groups of pack_size and encode each group.
+        documents: iterable of (document_id, chunks)
+        yields (keys, chunks, embeddings) where keys[i] is the (document_id, sequence_number) of row i
+        """
+        keys, texts = [], []
+        for doc_id, chunks in documents:
+            for seq_num, chunk in enumerate(chunks, 1):
+                keys.append((doc_id, seq_num))
+                texts.append(chunk)
+                if len(texts) >= self.pack_size:
+                    yield keys, texts, self.encode(texts)
+                    keys, texts = [], []
+        if texts:
+            yield keys, texts, self.encode(texts)
+
+def get_embedding_engine(model_name: str = EMBEDDING_MODEL_NAME) -> EmbeddingEngine:
+    """Load the embedding engine once per worker process (and model) and reuse it across tasks"""
+    return cached_model(('embedding_engine', model_name), lambda: EmbeddingEngine(model_name))
+
+class RunningMeans:
+    """Per-document running sums of chunk vectors, a document's mean is released once its last chunk arrives"""
+
+    def __init__(self):
+        self.expected = {}
+        self.counts = {}
+        self.sums = {}
+
+    def expect(self, document_id: int, n_chunks: int):
+        self.expected[document_id] = n_chunks
+        self.counts[document_id] = 0
+
+    def add(self, document_id: int, embeddings: np.ndarray):
+        """Add a block of chunk vectors, returns the document mean if it is now complete, else None"""
+        if document_id in self.sums:
+            self.sums[document_id] += embeddings.sum(axis=0, dtype=np.float64)
+        else:
+            self.sums[document_id] = embeddings.sum(axis=0, dtype=np.float64)
+        self.counts[document_id] += len(embeddings)
+        if self.counts[document_id] < self.expected[document_id]:
+            return None
+        mean = self.sums.pop(document_id) / self.counts.pop(document_id)
+        del self.expected[document_id]
+        return mean.astype(np.float32)
+
+class EmbeddingWriter:
+    """
+    Bulk-writes chunk embeddings and document embeddings with COPY ... FROM STDIN.
+    Rows are buffered and flushed (and committed) every batch_size rows, call close() to flush the tail.
+    copy_format: 'binary' sends real[] in the PostgreSQL binary format, 'text' sends '{...}' literals
+    Committed vectors are also appended to the store and, with ann_delta, to the ANN index delta segments.
+    """
+
+    def __init__(self, conn, batch_size: int = COPY_BATCH_SIZE, copy_format: str = COPY_FORMAT,
+                 store: 'EmbeddingStore' = None, ann_delta: bool = ANN_INDEX_DELTA):
+        if copy_format not in ('binary', 'text'):
+            raise ValueError(f"Unknown COPY format: {copy_format}")
+        self.conn = conn
+        self.batch_size = batch_size
+        self.copy_format = copy_format
+        self.store = store
+        self.chunk_rows = 0
+        self.doc_rows = 0
+        self.chunk_buffer = io.BytesIO()
+        self.doc_buffer = io.BytesIO()
+        self.doc_ids = []
+        self.doc_vectors = []
+        self.ann_delta = ann_delta
+        self.chunk_keys = []
+        self.chunk_vectors = []
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS doc_embedding_updates (
+                    id integer,
+                    embedding real[]
+                ) ON COMMIT DELETE ROWS
+            """)
+        self.conn.commit()
+
+    def _real_arrays(self, embeddings: np.ndarray) -> List[bytes]:
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if embeddings.ndim == 1:
+            embeddings = embeddings[np.newaxis, :]
+        if self.copy_format == 'binary':
+            return copy_binary_real_arrays(embeddings)
+        fmt = '{' + ','.join(['%.9g'] * embeddings.shape[1]) + '}'
+        return [(fmt % tuple(row)).encode('ascii') for row in embeddings.tolist()]
+
+    def add_chunks(self, document_id: int, sequence_numbers: List[int], spans: np.ndarray,
+                   embeddings: np.ndarray):
+        """Buffer chunk rows for chunked_embeddings, spans are the chunks' (start, end) offsets into raw_text"""
+        arrays = self._real_arrays(embeddings)
+        buf = self.chunk_buffer
+        for seq_num, (start, end), array in zip(sequence_numbers, spans.tolist(), arrays):
+            if self.copy_format == 'binary':
+                buf.write(struct.pack('!h', 5))
+                buf.write(array)
+                buf.write(struct.pack('!iiiiiiii', 4, seq_num, 4, document_id, 4, start, 4, end))
+            else:
+                buf.write(array)
+                buf.write(f"\t{seq_num}\t{document_id}\t{start}\t{end}\n".encode('ascii'))
+        self.chunk_rows += len(arrays)
+        if self.ann_delta:
+            self.chunk_keys.extend((document_id, seq_num) for seq_num in sequence_numbers)
+            self.chunk_vectors.append(np.asarray(embeddings, dtype=np.float32))
+        self._maybe_flush()
+
+    def add_document_embedding(self, document_id: int, embedding: np.ndarray):
+        """Buffer an update of documents.embedding"""
+        array = self._real_arrays(embedding)[0]
+        if self.copy_format == 'binary':
+            self.doc_buffer.write(struct.pack('!hii', 2, 4, document_id))
+            self.doc_buffer.write(array)
+        else:
+            self.doc_buffer.write(f"{document_id}\t".encode('ascii') + array + b"\n")
+        self.doc_rows += 1
+        if self.store is not None or self.ann_delta:
+            self.doc_ids.append(document_id)
+            self.doc_vectors.append(np.asarray(embedding, dtype=np.float32))
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if self.chunk_rows + self.doc_rows >= self.batch_size:
+            self.flush()
+
+    def _copy(self, cur, sql: str, buf: io.BytesIO):
+        if self.copy_format == 'binary':
+            data = io.BytesIO(PGCOPY_HEADER + buf.getvalue() + PGCOPY_TRAILER)
+            cur.copy_expert(sql + " WITH (FORMAT binary)", data)
+        else:
+            buf.seek(0)
+            cur.copy_expert(sql, buf)
+
+    def flush(self):
+        """COPY everything buffered so far and commit"""
+        if not self.chunk_rows and not self.doc_rows:
+            return
+        try:
+            with self.conn.cursor() as cur:
+                if self.chunk_rows:
+                    self._copy(cur, "COPY chunked_embeddings (embedding, sequence_number, document_id, start_offset, end_offset) FROM STDIN",
+                               self.chunk_buffer)
+                if self.doc_rows:
+                    self._copy(cur, "COPY doc_embedding_updates (id, embedding) FROM STDIN", self.doc_buffer)
+                    cur.execute("""
+                        UPDATE documents d SET embedding = u.embedding
+                        FROM doc_embedding_updates u
+                        WHERE d.id = u.id
+                    """)
+            self.conn.commit()
+            print(f"Wrote {self.chunk_rows} chunks and {self.doc_rows} document embeddings")
+        except Exception as e:
+            self.conn.rollback()
+            print(f"Error writing embeddings: {e}")
+            raise
+        finally:
+            self.chunk_rows = self.doc_rows = 0
+            self.chunk_buffer = io.BytesIO()
+            self.doc_buffer = io.BytesIO()
+            doc_ids, doc_vectors = self.doc_ids, self.doc_vectors
+            self.doc_ids, self.doc_vectors = [], []
+            chunk_keys, chunk_vectors = self.chunk_keys, self.chunk_vectors
+            self.chunk_keys, self.chunk_vectors = [], []
+        # only committed vectors go to the on-disk matrix and the index deltas
+        if doc_ids and self.store is not None:
+            self.store.append(doc_ids, np.vstack(doc_vectors))
+        if self.ann_delta:
+            from ann import append_delta, chunk_keys as pack_chunk_keys
+            model_name = self.store.model_name if self.store is not None else EMBEDDING_MODEL_NAME
+            if doc_ids:
+                append_delta('documents', doc_ids, np.vstack(doc_vectors), model_name)
+            if chunk_keys:
+                documents, sequence_numbers = zip(*chunk_keys)
+                append_delta('chunks', pack_chunk_keys(documents, sequence_numbers), np.vstack(chunk_vectors),
+                             model_name)
+
+    def close(self):
+        self.flush()
+
+class EmbeddingStore:
+    """
+    Append-only float32 document embedding matrix on disk (vectors.f32) with its document id index (ids.i64).
+    The embed stage appends every committed document vector and umap() memory-maps the file instead of
+    parsing real[] values out of PostgreSQL. A document embedded twice keeps its last row.
+    """
+
+    def __init__(self, path: str = EMBEDDING_STORE_DIR, model_name: str = EMBEDDING_MODEL_NAME):
+        self.path = path
+        self.model_name = model_name
+        self.vectors_path = os.path.join(path, 'vectors.f32')
+        self.ids_path = os.path.join(path, 'ids.i64')
+        self.meta_path = os.path.join(path, 'meta.json')
+
+    @contextmanager
+    def _locked(self):
+        # several workers may append to the same volume
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_meta(self) -> Optional[dict]:
+        try:
+            with open(self.meta_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, dimension: int):
+        with open(self.meta_path, 'w') as f:
+            json.dump({'model': self.model_name, 'dimension': dimension}, f)
+
+    def _n_rows(self, dimension: int) -> int:
+        """Rows present in both files, an interrupted append can leave one file longer than the other"""
+        if not os.path.exists(self.ids_path) or not os.path.exists(self.vectors_path):
+            return 0
+        return min(os.path.getsize(self.ids_path) // 8, os.path.getsize(self.vectors_path) // (4 * dimension))
+
+    def append(self, ids: List[int], vectors: np.ndarray):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        dimension = vectors.shape[1]
+        with self._locked():
+            meta = self._read_meta()
+            if meta is None or meta['dimension'] != dimension or meta['model'] != self.model_name:
+                # no store yet or a different model, start a new one
+                n_rows = 0
+                self._write_meta(dimension)
+            else:
+                n_rows = self._n_rows(dimension)
+            with open(self.ids_path, 'ab') as f:
+                f.truncate(n_rows * 8)
+                np.asarray(ids, dtype=np.int64).tofile(f)
+            with open(self.vectors_path, 'ab') as f:
+                f.truncate(n_rows * 4 * dimension)
+                vectors.tofile(f)
+
+    def dimension(self) -> Optional[int]:
+        """Vector dimension of the store, None without one for this model"""
+        meta = self._read_meta()
+        return meta['dimension'] if meta is not None and meta['model'] == self.model_name else None
+
+    def n_rows(self) -> int:
+        with self._locked():
+            meta = self._read_meta()
+            return self._n_rows(meta['dimension']) if meta is not None else 0
+
+    def discard_head(self, n_discard: int):
+        """Drop the first n_discard rows, keeping whatever was appended after them"""
+        with self._locked():
+            meta = self._read_meta()
+            if meta is None or n_discard <= 0:
+                return
+            dimension = meta['dimension']
+            n_rows = self._n_rows(dimension)
+            ids = np.fromfile(self.ids_path, dtype=np.int64, count=n_rows)[n_discard:]
+            vectors = np.fromfile(self.vectors_path, dtype=np.float32, count=n_rows * dimension)[n_discard * dimension:]
+            ids.tofile(self.ids_path + '.tmp')
+            vectors.tofile(self.vectors_path + '.tmp')
+            os.replace(self.ids_path + '.tmp', self.ids_path)
+            os.replace(self.vectors_path + '.tmp', self.vectors_path)
+
+    def open(self) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+        """Memory-map the store read-only, returns (ids, vectors) or (None, None) if it is missing or empty"""
+        with self._locked():
+            meta = self._read_meta()
+            if meta is None:
+                return None, None
+            dimension = meta['dimension']
+            n_rows = self._n_rows(dimension)
+            if n_rows == 0:
+                return None, None
+            ids = np.fromfile(self.ids_path, dtype=np.int64, count=n_rows)
+            vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(n_rows, dimension))
+        return ids, vectors
+
+    def rebuild(self, conn) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+        """Rewrite the store from documents.embedding with one binary COPY, then memory-map it"""
+        with self._locked():
+            with tempfile.NamedTemporaryFile(dir=self.path, suffix='.copy') as copy_file:
+                with conn.cursor() as cur:
+                    cur.copy_expert(
+                        """COPY (SELECT id, embedding FROM documents WHERE embedding IS NOT NULL ORDER BY id)
+                           TO STDOUT WITH (FORMAT binary)""",
+                        copy_file
+                    )
+                conn.commit()
+                copy_file.flush()
+                with open(self.ids_path + '.tmp', 'wb') as ids_out, open(self.vectors_path + '.tmp', 'wb') as vectors_out:
+                    dimension = parse_copy_embeddings(copy_file.name, ids_out, vectors_out)
+            if not dimension:
+                # nothing is embedded, an empty store
+                for path in (self.ids_path + '.tmp', self.vectors_path + '.tmp', self.meta_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                return None, None
+            os.replace(self.ids_path + '.tmp', self.ids_path)
+            os.replace(self.vectors_path + '.tmp', self.vectors_path)
+            self._write_meta(dimension)
+        return self.open()
+
+def parse_copy_embeddings(copy_path: str, ids_out, vectors_out, block_rows: int = 65536) -> int:
+    """
+    Convert a binary COPY of (id integer or bigint, embedding real[]) into raw int64 ids and float32 vectors.
+    Every row must have the same dimension so the file can be read as a fixed-size record array.
+    Returns the dimension, 0 if there were no rows
+    """
+    with open(copy_path, 'rb') as f:
+        header = f.read(19)
+        if header[:11] != PGCOPY_HEADER[:11]:
+            raise ValueError("not a binary COPY file")
+        offset = 19 + struct.unpack('!i', header[15:19])[0]
+        f.seek(offset)
+        first = f.read(38)
+    if len(first) < 6:
+        return 0
+    # nfields, id length, id, array length, ndim, has_nulls, element type, dimension
+    id_size = struct.unpack('!i', first[2:6])[0]
+    if id_size not in (4, 8) or len(first) < 30 + id_size - 4:
+        raise ValueError("unexpected row layout in embedding COPY")
+    dimension = struct.unpack('!i', first[22 + id_size:26 + id_size])[0]
+    row_dtype = np.dtype([
+        ('nfields', '>i2'), ('id_len', '>i4'), ('id', f'>i{id_size}'), ('array_len', '>i4'),
+        ('ndim', '>i4'), ('has_nulls', '>i4'), ('elem_oid', '>i4'), ('dim', '>i4'), ('lbound', '>i4'),
+        ('cells', [('len', '>i4'), ('val', '>f4')], (dimension,))
+    ])
+    body = os.path.getsize(copy_path) - offset - len(PGCOPY_TRAILER)
+    if body % row_dtype.itemsize:
+        raise ValueError("embeddings do not all have the same dimension")
+    rows = np.memmap(copy_path, dtype=row_dtype, mode='r', offset=offset, shape=(body // row_dtype.itemsize,))
+    for start in range(0, len(rows), block_rows):
+        block = rows[start:start + block_rows]
+        if ((block['nfields'] != 2) | (block['dim'] != dimension) | (block['has_nulls'] != 0)).any():
+            raise ValueError("unexpected row layout in embedding COPY")
+        block['id'].astype(np.int64).tofile(ids_out)
+        block['cells']['val'].astype(np.float32).tofile(vectors_out)
+    return dimension
+
+def latest_rows(ids: np.ndarray, wanted_ids: np.ndarray) -> Optional[np.ndarray]:
+    """Row of the last occurrence of each wanted id in ids, None if any wanted id is missing"""
+    if len(ids) == 0:
+        return None if len(wanted_ids) else np.empty(0, dtype=np.int64)
+    unique_ids, first_in_reversed = np.unique(ids[::-1], return_index=True)
+    last_rows = len(ids) - 1 - first_in_reversed
+    positions = np.minimum(np.searchsorted(unique_ids, wanted_ids), len(unique_ids) - 1)
+    if not np.array_equal(unique_ids[positions], wanted_ids):
+        return None
+    return last_rows[positions]
+
+def open_embedding_rows(conn, doc_ids: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    The memory-mapped embedding store and the row holding each of doc_ids, rows is None when the store holds
+    exactly these ids. The store is rebuilt with a binary COPY when it is stale
+    """
+    store = EmbeddingStore()
+    ids, vectors = store.open()
+    if ids is not None:
+        if np.array_equal(ids, doc_ids):
+            print("Using memory-mapped embedding store")
+            return vectors, None
+        rows = latest_rows(ids, doc_ids)
+        if rows is not None:
+            print("Using embedding store rows for the current documents")
+            return vectors, rows
+
+    print("Embedding store is missing or stale, rebuilding it with a binary COPY")
+    ids, vectors = store.rebuild(conn)
+    if ids is None:
+        return np.empty((0, 0), dtype=np.float32), None
+    if np.array_equal(ids, doc_ids):
+        return vectors, None
+    rows = latest_rows(ids, doc_ids)
+    if rows is None:
+        raise ValueError("document embeddings changed while loading them")
+    return vectors, rows
+
+def load_embedding_matrix(conn, doc_ids: np.ndarray) -> np.ndarray:
+    """Embedding matrix for doc_ids (in that order) from the on-disk store, zero-copy when it holds exactly these ids"""
+    vectors, rows = open_embedding_rows(conn, doc_ids)
+    return vectors if rows is None else vectors[rows]
+
+def embed_pdfs(document_ids: Optional[List[int]] = None, chunk_strategy: str = CHUNK_STRATEGY,
+               chunk_size: Optional[int] = None, chunk_overlap: Optional[int] = None,
+               batch_size: int = EMBED_BATCH_SIZE):
+    """
+    Embed every document without an embedding, or only those of document_ids (a job queue sub-task).
+    chunk_strategy, chunk_size and chunk_overlap as in chunking.get_chunker, batch_size chunks per model.encode call
+    """
+    engine = get_embedding_engine()
+    chunker = get_chunker(chunk_strategy, engine.model, chunk_size, chunk_overlap)
+    
+    read_conn = connect_db()
+    conn = connect_db()
+    scope, params = "", None
+    if document_ids is not None:
+        scope, params = " AND d.id = ANY(%s)", (list(document_ids),)
+    
+    # Chunks of a document whose embedding never got written belong to an interrupted run, start it over. The
+    # writer commits chunk rows before the document embedding, so an unscoped run only cleans up when no other
+    # run holds the lock; the session locks span the commits and go away with the connection
+    leftover = []
+    with conn.cursor() as cur:
+        if document_ids is not None:
+            cur.execute("SELECT pg_advisory_lock_shared(%s)", (EMBED_LOCK_ID,))
+            clean_up = True
+        else:
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (EMBED_LOCK_ID,))
+            clean_up = cur.fetchone()[0]
+        if clean_up:
+            cur.execute("""
+                DELETE FROM chunked_embeddings ce USING documents d
+                WHERE ce.document_id = d.id AND d.embedding IS NULL
+            """ + scope + " RETURNING ce.document_id, ce.sequence_number", params)
+            leftover = cur.fetchall()
+        else:
+            print("Another embed_pdfs run is active, keeping chunks of documents without an embedding")
+        conn.commit()
+        if document_ids is None:
+            cur.execute("SELECT pg_advisory_lock_shared(%s)", (EMBED_LOCK_ID,))
+            if clean_up:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (EMBED_LOCK_ID,))
+        conn.commit()
+    if leftover:
+        print(f"Removed {len(leftover)} chunks left over from an interrupted run")
+        if ANN_INDEX_DELTA:
+            # their vectors may already be in the chunk index delta
+            from ann import append_tombstones, chunk_keys as pack_chunk_keys
+            append_tombstones('chunks', pack_chunk_keys(*zip(*leftover)), engine.model_name)
+    
+    writer = EmbeddingWriter(conn, store=EmbeddingStore(model_name=engine.model_name))
+    means = RunningMeans()
+    documents = iter_documents(
+        read_conn,
+        "SELECT id, raw_text FROM documents d WHERE d.embedding IS NULL" + scope + " ORDER BY id",
+        params,
+        name='embed_documents'
+    )
+    
+    # chunk offsets of the documents being encoded, until their chunk rows are written
+    spans_by_doc = {}
+    
+    def chunk_batch(batch):
+        for (doc_id, raw_text), spans in zip(batch, chunker.spans_many([text for _, text in batch])):
+            if len(spans) == 0:
+                # nothing but whitespace, keep the whole text as one chunk so the document still gets a vector
+                spans = np.array([[0, len(raw_text)]], dtype=np.int64)
+            chunks = [raw_text[start:end] for start, end in spans.tolist()]
+            print(f"Document {doc_id}: created {len(chunks)} chunks")
+            means.expect(doc_id, len(chunks))
+            spans_by_doc[doc_id] = spans
+            yield doc_id, chunks
+    
+    def chunked_documents():
+        batch = []
+        for doc_id, raw_text in documents:
+            # Skip if raw_text is None or empty
+            if not raw_text:
+                print(f"Skipping document {doc_id} - no text content")
+                continue
+            batch.append((doc_id, raw_text))
+            if len(batch) >= CHUNK_BATCH_DOCS:
+                yield from chunk_batch(batch)
+                batch = []
+        if batch:
+            yield from chunk_batch(batch)
+    
+    # Encode chunks packed across documents, map the vectors back to their documents and
+    # write each document vector as soon as its last chunk has been encoded
+    n_docs = 0
+    default_batch_size, engine.batch_size = engine.batch_size, batch_size
+    try:
+        for keys, chunks, embeddings in engine.iter_chunk_embeddings(chunked_documents()):
+            doc_rows = defaultdict(list)
+            for row, (doc_id, _) in enumerate(keys):
+                doc_rows[doc_id].append(row)
+            
+            for doc_id, rows in doc_rows.items():
+                sequence_numbers = [keys[i][1] for i in rows]
+                writer.add_chunks(
+                    doc_id,
+                    sequence_numbers,
+                    spans_by_doc[doc_id][np.array(sequence_numbers) - 1],
+                    embeddings[rows]
+                )
+                record_progress(chunks=len(rows))
+                doc_embedding = means.add(doc_id, embeddings[rows])
+                if doc_embedding is not None:
+                    del spans_by_doc[doc_id]
+                    writer.add_document_embedding(doc_id, doc_embedding)
+                    record_progress(documents=1)
+                    n_docs += 1
+        writer.close()
+    finally:
+        engine.batch_size = default_batch_size
+        read_conn.close()
+        conn.close()
+    print(f"\nAll {n_docs} documents processed successfully!")
+    if engine.cache is not None:
+        print(f"Embedding cache: {engine.cache.stats()}")
+        engine.cache.reset_stats()
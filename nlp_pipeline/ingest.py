@@ -0,0 +1,393 @@
+"""process_pdfs stage: parallel PDF text extraction and change detection for the data folder"""
+import os
+import re
+import time
+import hashlib
+import multiprocessing
+import multiprocessing.connection
+from typing import List, Tuple, Dict, Iterable, Iterator
+from collections import Counter, deque
+from psycopg2.extras import execute_values
+
+from config import (DATA_FOLDER, MAX_BYTES, PAGE_BREAK, PDF_WORKERS, PDF_TIMEOUT, PDF_MAX_PAGES,
+                    PDF_INSERT_BATCH, ANN_INDEX_DELTA)
+from db import connect_db, bump_pipeline_version
+from metrics import record_progress
+
+def clean_text_for_postgres(text):
+    if not text: return ""
+    text = text.replace('\x00', '')
+    text = re.sub(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]', '', text)
+    return text.strip()
+
+def clip_to_byte_limit(s, byte_limit):
+    s_bytes = s.encode('utf-8')
+    if len(s_bytes) <= byte_limit:
+        return s
+    return s_bytes[:byte_limit].decode('utf-8', errors='ignore')
+
+def extract_pdf_text(path: str, max_pages: int = PDF_MAX_PAGES) -> Tuple[str, int]:
+    """
+    Extract the text of the first max_pages pages, each page followed by a page break marker.
+    Returns (text, number of pages in the file)
+    """
+    import pdfplumber
+    pages = []
+    n_chars = 0
+    with pdfplumber.open(path) as pdf:
+        page_count = len(pdf.pages)
+        for page in pdf.pages[:max_pages]:
+            page_text = page.extract_text()
+            page.close()
+            if page_text:
+                # Encode/Decode to strip non-ascii as per your original script
+                clean_page = page_text.encode('ascii', errors='ignore').decode('ascii')
+                pages.append(clean_page)
+                n_chars += len(clean_page) + len(PAGE_BREAK)
+                # the text gets clipped to MAX_BYTES, stop once well past that (ascii, so chars == bytes)
+                if n_chars > 2 * MAX_BYTES:
+                    break
+    return ''.join(page + PAGE_BREAK for page in pages), page_count
+
+def _extract_pdf_child(path: str, result_conn, max_pages: int = PDF_MAX_PAGES):
+    """Runs in a child process, sends ('ok', (text, page count)) or ('error', message) back through the pipe"""
+    try:
+        result_conn.send(('ok', extract_pdf_text(path, max_pages)))
+    except Exception as e:
+        result_conn.send(('error', str(e)))
+    finally:
+        result_conn.close()
+
+def iter_extracted_pdfs(paths: Iterable[str], workers: int = PDF_WORKERS, timeout: float = PDF_TIMEOUT,
+                        max_pages: int = PDF_MAX_PAGES) -> Iterator[Tuple[str, str, object]]:
+    """
+    Extract PDFs on up to `workers` child processes, one process per file so a stuck file can be killed.
+    yields (path, status, payload): status 'ok' with (text, page count), or 'error' / 'timeout' / 'crash' with a reason
+    """
+    ctx = multiprocessing.get_context('fork')
+    pending = deque(paths)
+    running = {}  # result pipe -> (process, path, start time)
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                path = pending.popleft()
+                reader, writer = ctx.Pipe(duplex=False)
+                proc = ctx.Process(target=_extract_pdf_child, args=(path, writer, max_pages), daemon=True)
+                proc.start()
+                writer.close()
+                running[reader] = (proc, path, time.monotonic())
+            
+            for reader in multiprocessing.connection.wait(list(running), timeout=1.0):
+                proc, path, _ = running.pop(reader)
+                try:
+                    status, payload = reader.recv()
+                except EOFError:
+                    status, payload = 'crash', None
+                reader.close()
+                proc.join()
+                if status == 'crash':
+                    payload = f"extraction process exited with code {proc.exitcode}"
+                yield path, status, payload
+            
+            now = time.monotonic()
+            for reader, (proc, path, started) in list(running.items()):
+                if now - started > timeout:
+                    proc.kill()
+                    proc.join()
+                    reader.close()
+                    del running[reader]
+                    yield path, 'timeout', f"no result after {timeout:.0f}s"
+    finally:
+        for reader, (proc, _, _) in running.items():
+            proc.kill()
+            proc.join()
+            reader.close()
+
+def hash_file(path: str) -> str:
+    """sha256 of the file contents"""
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+def scan_pdf_changes(cur) -> Tuple[Dict[str, tuple], List[tuple]]:
+    """
+    Compare the PDFs in DATA_FOLDER with the fingerprints stored on documents.
+    Size and mtime are checked first, a file is only hashed when they differ or are unknown. The fingerprints
+    of quarantined and duplicate files are recorded too, so later scans skip those unchanged files the same way.
+    Returns (to_extract, metadata_updates)
+      to_extract: {path: (document_id, content_hash, file_size, file_mtime)}, document_id is None for new content
+      metadata_updates: [(document_id, file_path, content_hash, file_size, file_mtime)] for renamed,
+                        touched or not yet fingerprinted files whose content is already loaded
+    """
+    cur.execute('SELECT id, file_path, content_hash, file_size, file_mtime FROM public.documents')
+    by_path, by_hash = {}, {}
+    for doc_id, path, content_hash, size, mtime in cur.fetchall():
+        by_path[path] = (doc_id, content_hash, size, mtime)
+        if content_hash:
+            by_hash.setdefault(content_hash, (doc_id, path))
+    cur.execute('SELECT file_path, content_hash, file_size, file_mtime FROM public.quarantined_files')
+    quarantined = {path: (content_hash, size, mtime) for path, content_hash, size, mtime in cur.fetchall()}
+    quarantined_hashes = set(h for h, _, _ in quarantined.values() if h)
+    cur.execute('SELECT file_path, content_hash, file_size, file_mtime FROM public.duplicate_files')
+    duplicates = {path: (content_hash, size, mtime) for path, content_hash, size, mtime in cur.fetchall()}
+    print(f"Known files in DB: {len(by_path)}, quarantined: {len(quarantined)}, duplicates: {len(duplicates)}")
+
+    to_extract, metadata_updates = {}, []
+    # (file_path, content_hash, file_size, file_mtime) of skipped files to record
+    quarantine_fingerprints, duplicate_fingerprints = [], []
+    claimed_hashes = set()  # content already taken by a new file or a rename during this scan
+    counts = Counter()
+    for root, dirs, files in os.walk(DATA_FOLDER):
+        for filename in files:
+            if not filename.endswith(".pdf") or filename.startswith("."):
+                continue
+            path = os.path.join(root, filename)
+            stat = os.stat(path)
+            fingerprint = (stat.st_size, stat.st_mtime)
+
+            known = by_path.get(path)
+            if known and known[1] and (known[2], known[3]) == fingerprint:
+                counts['unchanged'] += 1
+                continue
+            if path in quarantined and quarantined[path][0] and quarantined[path][1:] == fingerprint:
+                counts['quarantined'] += 1
+                continue
+            if not known and path in duplicates and duplicates[path][1:] == fingerprint:
+                # still a duplicate while the document holding its content keeps its file
+                original = by_hash.get(duplicates[path][0])
+                if original and os.path.exists(original[1]):
+                    counts['duplicate'] += 1
+                    continue
+
+            content_hash = hash_file(path)
+            if path in quarantined:
+                # an edited quarantined file gets another try
+                is_quarantined = quarantined[path][0] in (None, content_hash)
+            else:
+                is_quarantined = content_hash in quarantined_hashes
+
+            if is_quarantined:
+                quarantine_fingerprints.append((path, content_hash) + fingerprint)
+                counts['quarantined'] += 1
+            elif known:
+                doc_id, known_hash = known[0], known[1]
+                if known_hash in (None, content_hash):
+                    # same content (or a row loaded before fingerprints existed), just record the fingerprint
+                    metadata_updates.append((doc_id, path, content_hash) + fingerprint)
+                    counts['unchanged'] += 1
+                else:
+                    to_extract[path] = (doc_id, content_hash) + fingerprint
+                    counts['changed'] += 1
+            elif content_hash in claimed_hashes:
+                duplicate_fingerprints.append((path, content_hash) + fingerprint)
+                counts['duplicate'] += 1
+            elif content_hash in by_hash:
+                doc_id, old_path = by_hash[content_hash]
+                claimed_hashes.add(content_hash)
+                if os.path.exists(old_path):
+                    duplicate_fingerprints.append((path, content_hash) + fingerprint)
+                    counts['duplicate'] += 1
+                else:
+                    # the file was moved or renamed, keep the document with its embeddings and terms
+                    metadata_updates.append((doc_id, path, content_hash) + fingerprint)
+                    counts['renamed'] += 1
+            else:
+                claimed_hashes.add(content_hash)
+                to_extract[path] = (None, content_hash) + fingerprint
+                counts['new'] += 1
+
+    if quarantine_fingerprints:
+        # a file with the content of a quarantined one is quarantined under its own path as well
+        execute_values(
+            cur,
+            """INSERT INTO public.quarantined_files (file_path, reason, content_hash, file_size, file_mtime)
+               SELECT v.file_path, 'same content as a quarantined file', v.content_hash, v.file_size, v.file_mtime
+               FROM (VALUES %s) AS v(file_path, content_hash, file_size, file_mtime)
+               ON CONFLICT (file_path) DO UPDATE
+               SET content_hash = EXCLUDED.content_hash, file_size = EXCLUDED.file_size,
+                   file_mtime = EXCLUDED.file_mtime""",
+            quarantine_fingerprints,
+            template="(%s, %s, %s::bigint, %s::double precision)"
+        )
+    if duplicate_fingerprints:
+        execute_values(
+            cur,
+            """INSERT INTO public.duplicate_files (file_path, content_hash, file_size, file_mtime) VALUES %s
+               ON CONFLICT (file_path) DO UPDATE
+               SET content_hash = EXCLUDED.content_hash, file_size = EXCLUDED.file_size,
+                   file_mtime = EXCLUDED.file_mtime""",
+            duplicate_fingerprints
+        )
+    print("Scan result: " + ", ".join(f"{k}: {v}" for k, v in sorted(counts.items())))
+    return to_extract, metadata_updates
+
+def save_documents(cur, rows: List[tuple]) -> Tuple[List[int], List[Tuple[int, int]]]:
+    """
+    Insert new documents and replace the text of changed ones.
+    rows: [(document_id or None, file_path, raw_text, content_hash, file_size, file_mtime, page_count)]
+    char_length, byte_size and preview are filled in from raw_text by the documents_text_metadata trigger.
+    Returns the changed document ids and the (document id, sequence number) of the chunks they lost, for
+    remove_from_search once committed
+    """
+    # title None: the documents_text_metadata trigger names the document after its file
+    new = [(path, text, None, h, size, mtime, pages)
+           for doc_id, path, text, h, size, mtime, pages in rows if doc_id is None]
+    changed = [(doc_id, text, h, size, mtime, pages)
+               for doc_id, path, text, h, size, mtime, pages in rows if doc_id is not None]
+    if new:
+        execute_values(
+            cur,
+            """INSERT INTO public.documents (file_path, raw_text, title, content_hash, file_size, file_mtime,
+                                             page_count)
+               VALUES %s""",
+            new
+        )
+    if changed:
+        # an edited file starts over, clearing its embedding, chunks, terms, coordinates and topic makes the
+        # embed, terms and umap_incremental stages pick it up again
+        execute_values(
+            cur,
+            """UPDATE public.documents d
+               SET raw_text = v.raw_text, content_hash = v.content_hash,
+                   file_size = v.file_size, file_mtime = v.file_mtime, page_count = v.page_count, embedding = NULL
+               FROM (VALUES %s) AS v(id, raw_text, content_hash, file_size, file_mtime, page_count)
+               WHERE d.id = v.id""",
+            changed,
+            template="(%s, %s, %s, %s::bigint, %s::double precision, %s::integer)"
+        )
+        changed_ids = [row[0] for row in changed]
+        cur.execute("DELETE FROM chunked_embeddings WHERE document_id = ANY(%s) RETURNING document_id, sequence_number",
+                    (changed_ids,))
+        removed_chunks = cur.fetchall()
+        cur.execute("DELETE FROM document_terms WHERE document_id = ANY(%s)", (changed_ids,))
+        cur.execute("DELETE FROM doc_coords WHERE document_id = ANY(%s)", (changed_ids,))
+        cur.execute("DELETE FROM document_topics WHERE document_id = ANY(%s)", (changed_ids,))
+    print(f"Saved {len(new)} new and {len(changed)} changed documents")
+    return ([row[0] for row in changed], removed_chunks) if changed else ([], [])
+
+def remove_from_search(document_ids: List[int], chunks: List[Tuple[int, int]]):
+    """Hide the vectors of changed documents and their old chunks from the ANN indexes until re-embedded"""
+    if not ANN_INDEX_DELTA or not document_ids:
+        return
+    from ann import append_tombstones, chunk_keys
+    append_tombstones('documents', document_ids)
+    if chunks:
+        append_tombstones('chunks', chunk_keys(*zip(*chunks)))
+
+def process_pdfs(workers: int = PDF_WORKERS, timeout: float = PDF_TIMEOUT, max_pages: int = PDF_MAX_PAGES,
+                 insert_batch: int = PDF_INSERT_BATCH):
+    """
+    The logic from your script integrated as a task: extract new and changed PDFs on workers processes
+    (timeout seconds and max_pages pages per file) and save them insert_batch rows at a time
+    """
+    print(f"Starting PDF scan in {DATA_FOLDER} with {workers} extraction processes...")
+    
+    try:
+        conn = connect_db()
+        cur = conn.cursor()
+
+        # 1. Compare the folder with the stored fingerprints
+        to_extract, metadata_updates = scan_pdf_changes(cur)
+        # the fingerprints of skipped files the scan recorded
+        conn.commit()
+        if metadata_updates:
+            execute_values(
+                cur,
+                """UPDATE public.documents d
+                   SET file_path = v.file_path,
+                       title = CASE WHEN d.title = document_title(d.file_path) THEN document_title(v.file_path)
+                                    ELSE d.title END,
+                       content_hash = v.content_hash, file_size = v.file_size, file_mtime = v.file_mtime
+                   FROM (VALUES %s) AS v(id, file_path, content_hash, file_size, file_mtime)
+                   WHERE d.id = v.id""",
+                metadata_updates,
+                template="(%s, %s, %s, %s::bigint, %s::double precision)"
+            )
+            conn.commit()
+            print(f"Updated fingerprints of {len(metadata_updates)} documents")
+
+        # 2. Extract new and changed files in parallel, clean and save in batches
+        documents, failures = [], []
+
+        def flush():
+            # changed documents and their old chunks, hidden from search once their rows are committed
+            changed_ids, removed_chunks = [], []
+            if documents:
+                try:
+                    ids, chunks = save_documents(cur, documents)
+                    conn.commit()
+                    changed_ids += ids
+                    removed_chunks += chunks
+                    record_progress(documents=len(documents))
+                except Exception as e:
+                    # one bad row fails the whole batch, save this batch one row at a time instead
+                    print(f"Batch insert failed ({e}), retrying row by row")
+                    conn.rollback()
+                    for row in documents:
+                        try:
+                            ids, chunks = save_documents(cur, [row])
+                            conn.commit()
+                            changed_ids += ids
+                            removed_chunks += chunks
+                            record_progress(documents=1)
+                        except Exception as e:
+                            print(f"Error saving {row[1]}: {e}")
+                            conn.rollback()
+                remove_from_search(changed_ids, removed_chunks)
+            if failures:
+                execute_values(
+                    cur,
+                    """INSERT INTO public.quarantined_files (file_path, reason, content_hash, file_size, file_mtime)
+                       VALUES %s
+                       ON CONFLICT (file_path) DO UPDATE
+                       SET reason = EXCLUDED.reason, content_hash = EXCLUDED.content_hash,
+                           file_size = EXCLUDED.file_size, file_mtime = EXCLUDED.file_mtime, created_at = now()""",
+                    failures
+                )
+            conn.commit()
+            documents.clear()
+            failures.clear()
+
+        for path, status, payload in iter_extracted_pdfs(list(to_extract), workers, timeout, max_pages):
+            doc_id, content_hash, file_size, file_mtime = to_extract[path]
+            if status != 'ok':
+                print(f"Quarantining {path} ({status}): {payload}")
+                failures.append((path, f"{status}: {payload}", content_hash, file_size, file_mtime))
+            elif not payload[0].strip():
+                # quarantined too, so it is not extracted again until the file changes
+                print(f"Skipping {path}: No text found.")
+                failures.append((path, "empty: no text found", content_hash, file_size, file_mtime))
+            else:
+                text, page_count = payload
+                cleaned = clean_text_for_postgres(text)
+                clipped = clip_to_byte_limit(cleaned, MAX_BYTES - 1)
+                documents.append((doc_id, path, clipped, content_hash, file_size, file_mtime, page_count))
+
+            if len(documents) + len(failures) >= insert_batch:
+                flush()
+        flush()
+        bump_pipeline_version(cur)
+        conn.commit()
+
+        cur.close()
+        conn.close()
+    except Exception as e:
+        print(f"Error while loading PDFs: {e}")
+        # let the job queue retry the job or dead-letter it, the stages after it must not start on partial data
+        raise
+    # # go ahead and do the code inside of the title_documents.py
+    # conn2 = psycopg2.connect(**DB_CONFIG)
+    # cur2 = conn2.cursor()
+    # cur2.execute( 'select d.id, d.file_path from documents d  where d.title is null ')
+    # list = cur2.fetchall()
+
+    # my_mapped_data = {}
+    # for row in list:
+    #     doc_id = row[0]
+    #     file_path = row[1]
+    #     title = f"{file_path.split('/')[-1]}_{doc_id}"
+        
+    #     cur2.execute( ' update documents set title = %s where id = %s ', ( title, doc_id ) )
+    #     print( f"Updated document ID {doc_id} with title: {title}" )
+
+    # conn2.commit()
+    # cur2.close()
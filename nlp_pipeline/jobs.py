@@ -0,0 +1,513 @@
+"""Redis job queue, pipeline DAG and the worker loop; stage modules are imported when a task first needs them"""
+import json
+import time
+import uuid
+import typing
+import inspect
+import threading
+import importlib
+import itertools
+import redis
+from typing import List, Tuple, Dict, Set, Optional, Callable, Union
+
+from config import (REDIS_URL, JOB_QUEUE, JOB_MAX_ATTEMPTS, JOB_DOCS_PER_TASK, WORKER_HEARTBEAT_TTL, WORKER_ID,
+                    PIPELINE_TTL, PIPELINE_STAGES, SWEEP_MAX_VARIANTS)
+from db import connect_db
+from metrics import StageMetrics
+
+class JobQueue:
+    """
+    Reliable job queue on a Redis list. Producers LPUSH JSON jobs
+    {"id", "task", "params", "attempts", "run_id", "stage", "subtask"}, only "task" is required.
+    A worker BLMOVEs a job into its own processing list and removes it from there once the task returned (ack).
+    A failed job goes back on the queue until it has been tried max_attempts times, then to the dead letter list.
+    Jobs left in the processing list of a worker whose heartbeat expired are re-queued the same way.
+    """
+
+    def __init__(self, r, name: str = JOB_QUEUE, worker_id: str = WORKER_ID, max_attempts: int = JOB_MAX_ATTEMPTS):
+        self.r = r
+        self.name = name
+        self.worker_id = worker_id
+        self.max_attempts = max_attempts
+        self.processing = self.processing_key(worker_id)
+        self.dead_letters = f"{name}:dead"
+
+    def processing_key(self, worker_id: str) -> str:
+        return f"{self.name}:processing:{worker_id}"
+
+    def heartbeat_key(self, worker_id: str) -> str:
+        return f"{self.name}:worker:{worker_id}"
+
+    @staticmethod
+    def make_job(task: str, params: dict = None, **fields) -> dict:
+        job = {'id': uuid.uuid4().hex, 'task': task, 'params': params or {}, 'attempts': 0}
+        job.update({key: value for key, value in fields.items() if value is not None})
+        return job
+
+    def push(self, *jobs: dict, pipe=None):
+        """Queue jobs, on pipe when given so the push is part of a caller's transaction"""
+        (pipe if pipe is not None else self.r).lpush(self.name, *[json.dumps(job) for job in jobs])
+
+    def reserve(self, timeout: float = 0) -> Optional[Tuple[bytes, dict]]:
+        """Move the oldest job into this worker's processing list, None on timeout"""
+        raw = self.r.blmove(self.name, self.processing, timeout, 'RIGHT', 'LEFT')
+        if raw is None:
+            return None
+        try:
+            job = json.loads(raw)
+            if not isinstance(job, dict) or 'task' not in job:
+                raise ValueError("job has no task")
+            if not isinstance(job.get('params') or {}, dict):
+                raise ValueError("job params are not an object")
+        except ValueError as e:
+            print(f"Dropping malformed job {raw!r}: {e}")
+            with self.r.pipeline() as pipe:
+                pipe.lrem(self.processing, 1, raw)
+                pipe.lpush(self.dead_letters, json.dumps({'raw': raw.decode(errors='replace'), 'error': str(e)}))
+                pipe.execute()
+            return None
+        job.setdefault('id', uuid.uuid4().hex)
+        # an explicit "params": null means no params
+        job['params'] = job.get('params') or {}
+        job.setdefault('attempts', 0)
+        return raw, job
+
+    def ack(self, raw: bytes):
+        self.r.lrem(self.processing, 1, raw)
+
+    def fail(self, raw: bytes, job: dict, error, retry: bool = True) -> bool:
+        """
+        Put a failed job back on the queue, or on the dead letter list once out of attempts (or right away without
+        retry). False if dead
+        """
+        job = dict(job, attempts=job['attempts'] + 1, error=str(error))
+        retry = retry and job['attempts'] < self.max_attempts
+        with self.r.pipeline() as pipe:
+            pipe.lrem(self.processing, 1, raw)
+            pipe.lpush(self.name if retry else self.dead_letters, json.dumps(job))
+            pipe.execute()
+        return retry
+
+    def start_heartbeat(self):
+        def beat():
+            while True:
+                try:
+                    self.r.set(self.heartbeat_key(self.worker_id), time.time(), ex=WORKER_HEARTBEAT_TTL)
+                except redis.RedisError as e:
+                    print(f"Heartbeat failed: {e}")
+                time.sleep(WORKER_HEARTBEAT_TTL / 3)
+        threading.Thread(target=beat, name='heartbeat', daemon=True).start()
+
+    def recover(self, include_own: bool = False) -> List[dict]:
+        """
+        Re-queue the jobs reserved by workers whose heartbeat expired (and this worker's own leftovers from
+        before a restart when include_own), counting the interrupted run as an attempt.
+        Returns the jobs that ran out of attempts and went to the dead letter list
+        """
+        dead = []
+        for key in self.r.scan_iter(match=self.processing_key('*')):
+            key = key.decode()
+            worker_id = key[len(self.processing_key('')):]
+            if worker_id == self.worker_id:
+                if not include_own:
+                    continue
+            elif self.r.exists(self.heartbeat_key(worker_id)):
+                continue
+            # one recovering worker per dead worker
+            lock = f"{self.name}:recovering:{worker_id}"
+            if not self.r.set(lock, self.worker_id, nx=True, ex=WORKER_HEARTBEAT_TTL):
+                continue
+            try:
+                while True:
+                    raw = self.r.lindex(key, -1)
+                    if raw is None:
+                        break
+                    try:
+                        job = json.loads(raw)
+                    except ValueError:
+                        job = {'raw': raw.decode(errors='replace')}
+                    job['attempts'] = job.get('attempts', 0) + 1
+                    job['error'] = f"worker {worker_id} stopped while running the job"
+                    retry = 'task' in job and job['attempts'] < self.max_attempts
+                    with self.r.pipeline() as pipe:
+                        pipe.rpop(key)
+                        pipe.lpush(self.name if retry else self.dead_letters, json.dumps(job))
+                        pipe.execute()
+                    print(f"Recovered job {job.get('task')} from worker {worker_id}" + ("" if retry else " as dead"))
+                    if not retry:
+                        dead.append(job)
+            finally:
+                self.r.delete(lock)
+        return dead
+
+# Count a finished sub-task once, even when its job is retried after the count.
+# KEYS: pipeline hash, set of finished sub-task ids. ARGV: job id, pending field, ttl. Returns the sub-tasks left
+SUBTASK_DONE_SCRIPT = """
+if redis.call('SADD', KEYS[2], ARGV[1]) == 1 then
+    redis.call('EXPIRE', KEYS[2], ARGV[3])
+    return redis.call('HINCRBY', KEYS[1], ARGV[2], -1)
+end
+return tonumber(redis.call('HGET', KEYS[1], ARGV[2]) or '0')
+"""
+
+class Pipeline:
+    """
+    One run of the PIPELINE_STAGES DAG, kept in the Redis hash pipeline:<run_id>.
+    Fields: status (running / done / failed), stages, stage_params, stage:<name> (waiting / queued / running /
+    done / failed) and pending:<name> for the sub-tasks a fanned out stage still waits for.
+    A stage is queued as soon as every selected stage it depends on is done.
+    """
+
+    def __init__(self, queue: JobQueue, run_id: str):
+        self.queue = queue
+        self.r = queue.r
+        self.run_id = run_id
+        self.key = f"pipeline:{run_id}"
+
+    @classmethod
+    def create(cls, queue: JobQueue, stages: List[str] = None, stage_params: Dict[str, dict] = None) -> 'Pipeline':
+        stages = stages or list(PIPELINE_STAGES)
+        unknown = set(stages) - set(PIPELINE_STAGES)
+        if unknown:
+            raise ValueError(f"Unknown pipeline stages: {', '.join(sorted(unknown))}")
+        stages = [stage for stage in PIPELINE_STAGES if stage in stages]
+        run = cls(queue, uuid.uuid4().hex)
+        with run.r.pipeline() as pipe:
+            pipe.hset(run.key, mapping={
+                'status': 'running',
+                'created_at': time.time(),
+                'stages': json.dumps(stages),
+                'stage_params': json.dumps(stage_params or {}),
+                **{f'stage:{stage}': 'waiting' for stage in stages}
+            })
+            pipe.expire(run.key, PIPELINE_TTL)
+            pipe.zadd('pipelines', {run.run_id: time.time()})
+            pipe.execute()
+        return run
+
+    @staticmethod
+    def dependencies(stage: str, selected: List[str]) -> Set[str]:
+        """Nearest selected stages stage depends on, through stages that are not part of the run"""
+        dependencies = set()
+        for dependency in PIPELINE_STAGES[stage]:
+            if dependency in selected:
+                dependencies.add(dependency)
+            else:
+                dependencies |= Pipeline.dependencies(dependency, selected)
+        return dependencies
+
+    def state(self, client=None) -> Dict[str, str]:
+        return {key.decode(): value.decode() for key, value in (client or self.r).hgetall(self.key).items()}
+
+    def stages(self) -> List[str]:
+        return json.loads(self.r.hget(self.key, 'stages') or '[]')
+
+    def stage_status(self, stage: str) -> Optional[str]:
+        status = self.r.hget(self.key, f'stage:{stage}')
+        return status.decode() if status is not None else None
+
+    def set_stage(self, stage: str, status: str):
+        self.r.hset(self.key, f'stage:{stage}', status)
+
+    def start_ready_stages(self):
+        """Queue every waiting stage whose dependencies are done, atomically with marking it queued"""
+        while True:
+            with self.r.pipeline() as pipe:
+                try:
+                    pipe.watch(self.key)
+                    state = self.state(pipe)
+                    if state.get('status') != 'running':
+                        return
+                    stages = json.loads(state['stages'])
+                    stage_params = json.loads(state.get('stage_params') or '{}')
+                    ready = [
+                        stage for stage in stages
+                        if state.get(f'stage:{stage}') == 'waiting'
+                        and all(state.get(f'stage:{dep}') == 'done' for dep in self.dependencies(stage, stages))
+                    ]
+                    if not ready:
+                        return
+                    pipe.multi()
+                    for stage in ready:
+                        pipe.hset(self.key, f'stage:{stage}', 'queued')
+                        self.queue.push(
+                            JobQueue.make_job(stage, stage_params.get(stage), run_id=self.run_id, stage=stage),
+                            pipe=pipe
+                        )
+                    pipe.execute()
+                    print(f"Pipeline {self.run_id}: queued {', '.join(ready)}")
+                    return
+                except redis.WatchError:
+                    continue
+
+    def complete_stage(self, stage: str):
+        self.set_stage(stage, 'done')
+        state = self.state()
+        if all(state.get(f'stage:{s}') == 'done' for s in json.loads(state['stages'])):
+            self.r.hset(self.key, mapping={'status': 'done', 'finished_at': time.time()})
+            print(f"Pipeline {self.run_id} finished")
+        else:
+            self.start_ready_stages()
+
+    def fail_stage(self, stage: str, error):
+        self.r.hset(self.key, mapping={
+            f'stage:{stage}': 'failed', 'status': 'failed', 'error': f"{stage}: {error}", 'finished_at': time.time()
+        })
+        print(f"Pipeline {self.run_id} failed in {stage}: {error}")
+
+    def fan_out(self, stage: str, document_ids: List[int], params: dict):
+        """Split a stage into sub-tasks of JOB_DOCS_PER_TASK documents, it is done when the last one is"""
+        batches = [document_ids[i:i + JOB_DOCS_PER_TASK] for i in range(0, len(document_ids), JOB_DOCS_PER_TASK)]
+        while True:
+            with self.r.pipeline() as pipe:
+                try:
+                    pipe.watch(self.key)
+                    # a retried fan-out job finds the sub-tasks of its earlier attempt already queued
+                    if pipe.hexists(self.key, f'pending:{stage}'):
+                        break
+                    pipe.multi()
+                    pipe.hset(self.key, f'pending:{stage}', len(batches))
+                    for batch in batches:
+                        self.queue.push(JobQueue.make_job(
+                            stage, dict(params, document_ids=batch), run_id=self.run_id, stage=stage, subtask=True
+                        ), pipe=pipe)
+                    pipe.execute()
+                    print(f"Pipeline {self.run_id}: split {stage} into {len(batches)} tasks for {len(document_ids)} documents")
+                    break
+                except redis.WatchError:
+                    continue
+        if int(self.r.hget(self.key, f'pending:{stage}')) == 0:
+            self.complete_stage(stage)
+
+    def subtask_done(self, stage: str, job_id: str):
+        remaining = self.r.eval(
+            SUBTASK_DONE_SCRIPT, 2, self.key, f"{self.key}:done", job_id, f'pending:{stage}', PIPELINE_TTL
+        )
+        if remaining == 0:
+            self.complete_stage(stage)
+
+# task -> (module, function); a stage module and its libraries are imported the first time one of its tasks runs
+TASKS = {
+    'process_pdfs': ('ingest', 'process_pdfs'),
+    'embed_pdfs': ('embedding', 'embed_pdfs'),
+    'umap': ('clustering', 'umap'),
+    'umap_incremental': ('clustering', 'umap_incremental'),
+    'topics': ('clustering', 'topics'),
+    'render_map': ('plotting', 'render_map'),
+    'ann_index': ('ann', 'ann_index'),
+    'terms': ('terms', 'terms'),
+    'tf_idf': ('tfidf', 'tf_idf'),
+    'evaluate_umap': ('sweep', 'evaluate_umap'),
+    'evaluate_chunking': ('sweep', 'evaluate_chunking'),
+}
+_task_functions: Dict[str, Callable] = {}
+
+def get_task(task: str) -> Callable:
+    if task not in _task_functions:
+        module, function = TASKS[task]
+        _task_functions[task] = getattr(importlib.import_module(module), function)
+    return _task_functions[task]
+
+class InvalidParams(ValueError):
+    """Job params that do not fit the task, the job goes to the dead letter list without a retry"""
+
+def coerce_param(name: str, value, annotation):
+    """value converted to the annotated type of a task parameter, from JSON values or query strings alike"""
+    if typing.get_origin(annotation) is Union:
+        types = [arg for arg in typing.get_args(annotation) if arg is not type(None)]
+        if value is None and len(types) < len(typing.get_args(annotation)):
+            return None
+        return coerce_param(name, value, types[0])
+    if typing.get_origin(annotation) is list:
+        items = value.split(',') if isinstance(value, str) else value
+        if not isinstance(items, list):
+            raise InvalidParams(f"{name} must be a list, got {value!r}")
+        item_type = (typing.get_args(annotation) or (str,))[0]
+        return [coerce_param(name, item, item_type) for item in items]
+    if annotation is bool:
+        if isinstance(value, bool):
+            return value
+        if str(value).lower() in ('1', 'true', 'yes'):
+            return True
+        if str(value).lower() in ('0', 'false', 'no'):
+            return False
+        raise InvalidParams(f"{name} must be true or false, got {value!r}")
+    if annotation in (int, float, str):
+        if isinstance(value, (bool, list, dict)) or value is None:
+            raise InvalidParams(f"{name} must be {annotation.__name__}, got {value!r}")
+        try:
+            if annotation is int and isinstance(value, float) and not value.is_integer():
+                raise ValueError
+            return annotation(value)
+        except ValueError:
+            raise InvalidParams(f"{name} must be {annotation.__name__}, got {value!r}") from None
+    return value
+
+def task_params(task: str, params: Optional[dict]) -> dict:
+    """
+    The params of a job checked against the keyword parameters of its task function and converted to their
+    annotated types; the function signature is the parameter schema, its defaults come from config.py
+    """
+    if params is None:
+        return {}
+    if not isinstance(params, dict):
+        raise InvalidParams(f"{task} params must be an object, got {params!r}")
+    function = get_task(task)
+    parameters = inspect.signature(function).parameters
+    unknown = set(params) - set(parameters)
+    if unknown:
+        raise InvalidParams(f"{task} has no parameter {', '.join(sorted(unknown))}")
+    hints = typing.get_type_hints(function)
+    checked = {}
+    for name, value in params.items():
+        default = parameters[name].default
+        annotation = hints.get(name, type(default) if default not in (None, inspect.Parameter.empty) else None)
+        checked[name] = coerce_param(f"{task}.{name}", value, annotation)
+    return checked
+
+# tasks a sweep fans its variants out to, each gets the grid parameters its function takes
+SWEEP_TASKS = ('evaluate_umap', 'evaluate_chunking')
+
+def sweep_variants(grid: dict) -> List[Tuple[str, dict]]:
+    """
+    (task, params) for every combination of the grid values, per SWEEP_TASKS task taking some of the grid.
+    grid maps a parameter to a list of values (or a comma separated string, or a single value)
+    """
+    if not isinstance(grid, dict) or not grid:
+        raise InvalidParams("a sweep needs a grid of parameter values")
+    grid = {name: values.split(',') if isinstance(values, str) else values if isinstance(values, list) else [values]
+            for name, values in grid.items()}
+    variants, used = [], set()
+    for task in SWEEP_TASKS:
+        names = [name for name in grid if name in inspect.signature(get_task(task)).parameters]
+        used.update(names)
+        if names:
+            for values in itertools.product(*(grid[name] for name in names)):
+                variants.append((task, task_params(task, dict(zip(names, values)))))
+    unknown = set(grid) - used
+    if unknown:
+        raise InvalidParams(f"no sweep task takes {', '.join(sorted(unknown))}")
+    if len(variants) > SWEEP_MAX_VARIANTS:
+        raise InvalidParams(f"the grid has {len(variants)} variants, more than SWEEP_MAX_VARIANTS={SWEEP_MAX_VARIANTS}")
+    return variants
+
+def start_sweep(queue: JobQueue, sweep_id: str, params: dict):
+    """Queue one job per sweep variant, any worker picks them up; pipeline_runs rows of run_id sweep_id hold results"""
+    variants = sweep_variants(params.get('grid'))
+    queue.push(*[JobQueue.make_job(task, variant, run_id=sweep_id) for task, variant in variants])
+    print(f"Sweep {sweep_id}: queued {len(variants)} variants")
+
+# stages split into per-document sub-tasks, and the documents they still have to process
+FANOUT_QUERIES = {
+    'embed_pdfs': "SELECT id FROM documents WHERE embedding IS NULL AND raw_text IS NOT NULL ORDER BY id",
+    'terms': "SELECT id FROM documents WHERE id NOT IN (SELECT DISTINCT document_id FROM document_terms) ORDER BY id",
+}
+
+def pending_document_ids(stage: str) -> List[int]:
+    conn = connect_db()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(FANOUT_QUERIES[stage])
+            return [row[0] for row in cur.fetchall()]
+    finally:
+        conn.close()
+
+def run_job(queue: JobQueue, job: dict):
+    """Run one job; pipeline stages record their progress and queue the stages that were waiting on them"""
+    task, params = job['task'], job['params']
+    if task == 'pipeline':
+        stage_params = params.get('stage_params') or {}
+        if not isinstance(stage_params, dict):
+            raise InvalidParams(f"stage_params must map stages to their params, got {stage_params!r}")
+        unknown = set(stage_params) - set(PIPELINE_STAGES)
+        if unknown:
+            raise InvalidParams(f"Unknown pipeline stages: {', '.join(sorted(unknown))}")
+        stage_params = {stage: task_params(stage, values) for stage, values in stage_params.items()}
+        run = Pipeline.create(queue, params.get('stages'), stage_params)
+        print(f"Started pipeline {run.run_id}: {', '.join(run.stages())}")
+        run.start_ready_stages()
+        return
+    if task == 'sweep':
+        start_sweep(queue, job['id'], params)
+        return
+    if task not in TASKS:
+        print(f"Unknown task type: {task}")
+        return
+    params = task_params(task, params)
+    if task not in PIPELINE_STAGES:
+        with StageMetrics(task, queue.r, job.get('run_id'), params):
+            get_task(task)(**params)
+        return
+
+    # a stage published on its own (e.g. by /embed_docs) runs as a single stage pipeline
+    if not job.get('run_id'):
+        job['run_id'] = Pipeline.create(queue, [task]).run_id
+    run = Pipeline(queue, job['run_id'])
+    if job.get('subtask'):
+        # the document ids themselves are not worth keeping in pipeline_runs
+        recorded = {key: value for key, value in params.items() if key != 'document_ids'}
+        with StageMetrics(task, queue.r, run.run_id, recorded):
+            get_task(task)(**params)
+        run.subtask_done(task, job['id'])
+        return
+    if run.stage_status(task) == 'done':
+        # retried after it had already finished
+        return
+    run.set_stage(task, 'running')
+    if task in FANOUT_QUERIES and JOB_DOCS_PER_TASK > 0:
+        run.fan_out(task, pending_document_ids(task), params)
+        return
+    with StageMetrics(task, queue.r, run.run_id, params):
+        get_task(task)(**params)
+    run.complete_stage(task)
+
+def fail_pipeline(queue: JobQueue, job: dict, error):
+    """Mark the pipeline stage of a job that will not be retried as failed"""
+    if job.get('run_id') and job.get('task') in PIPELINE_STAGES:
+        Pipeline(queue, job['run_id']).fail_stage(job['task'], error)
+
+def run_worker():
+    r = redis.from_url(REDIS_URL)
+    queue = JobQueue(r)
+    for job in queue.recover(include_own=True):
+        fail_pipeline(queue, job, job['error'])
+    queue.start_heartbeat()
+    print(f"Python Worker {WORKER_ID} is alive and listening for tasks...")
+
+    last_recovery = time.time()
+    while True:
+        try:
+            if time.time() - last_recovery > WORKER_HEARTBEAT_TTL:
+                for job in queue.recover():
+                    fail_pipeline(queue, job, job['error'])
+                last_recovery = time.time()
+
+            # Block until a task arrives, waking up now and then to look for dead workers
+            reserved = queue.reserve(timeout=WORKER_HEARTBEAT_TTL)
+            if reserved is None:
+                continue
+            raw, job = reserved
+            print(f"--- Received Task: {job['task']} (attempt {job['attempts'] + 1}) ---**********")
+
+            try:
+                run_job(queue, job)
+            except InvalidParams as e:
+                print(f"Task {job['task']} has invalid params: {e}")
+                queue.fail(raw, job, e, retry=False)
+                fail_pipeline(queue, job, e)
+                continue
+            except Exception as e:
+                print(f"Task {job['task']} failed: {e}")
+                if queue.fail(raw, job, e):
+                    print("--- Task re-queued ---")
+                else:
+                    print(f"--- Task moved to {queue.dead_letters} ---")
+                    fail_pipeline(queue, job, e)
+                continue
+
+            queue.ack(raw)
+            print("--- Task Complete ---")
+
+        except redis.RedisError as e:
+            print(f"Worker Loop Error: {e}")
+            time.sleep(5) # Prevent rapid fire looping on error
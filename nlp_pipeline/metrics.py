@@ -0,0 +1,161 @@
+"""Stage instrumentation: wall, DB and compute time, throughput and peak RSS of every task"""
+import os
+import json
+import time
+import threading
+import resource
+import redis
+import psycopg2
+from typing import Optional
+from contextlib import contextmanager
+
+from config import DB_CONFIG, WORKER_ID, STATUS_KEY, METRICS_PUBLISH_INTERVAL
+
+_active_metrics: Optional['StageMetrics'] = None
+
+@contextmanager
+def db_timer():
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if _active_metrics is not None:
+            _active_metrics.db_seconds += time.perf_counter() - start
+
+def record_progress(documents: int = 0, chunks: int = 0):
+    """Count processed documents / chunks towards the running StageMetrics, a no-op outside of one"""
+    if _active_metrics is not None:
+        _active_metrics.documents += documents
+        _active_metrics.chunks += chunks
+
+def record_quality(**values):
+    """Quality measures of the running task (a sweep evaluation), saved with its timing in pipeline_runs"""
+    if _active_metrics is not None:
+        _active_metrics.quality.update(values)
+
+def current_rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        # lifetime peak, in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class StageMetrics:
+    """
+    Instruments one task: wall time, time in the database (TimedConnection / TimedCursor calls) against the
+    rest as compute, documents and chunks processed (record_progress) and peak RSS sampled while it runs.
+    Progress is published to the Redis hash STATUS_KEY while the task runs, the totals (and any record_quality
+    values) go to pipeline_runs.
+    """
+
+    def __init__(self, stage: str, r=None, run_id: str = None, params: dict = None, worker_id: str = WORKER_ID):
+        self.stage = stage
+        self.r = r
+        self.run_id = run_id
+        self.params = params or {}
+        self.worker_id = worker_id
+        self.db_seconds = 0.0
+        self.documents = 0
+        self.chunks = 0
+        self.quality = {}
+        self.peak_rss_mb = 0.0
+        self.status = 'running'
+        self.error = None
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        global _active_metrics
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.peak_rss_mb = current_rss_mb()
+        _active_metrics = self
+        self._sampler = threading.Thread(target=self._sample, name='metrics', daemon=True)
+        self._sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        global _active_metrics
+        self._stop.set()
+        self._sampler.join()
+        self.wall_seconds = time.perf_counter() - self._start
+        self.peak_rss_mb = max(self.peak_rss_mb, current_rss_mb())
+        _active_metrics = None
+        if exc is not None:
+            self.status, self.error = 'failed', str(exc)
+        else:
+            self.status = 'done'
+        summary = self.summary()
+        print(f"[metrics] {self.stage} {self.status} in {summary['wall_seconds']:.1f}s "
+              f"(db {summary['db_seconds']:.1f}s, compute {summary['compute_seconds']:.1f}s), "
+              f"{self.documents} docs, {self.chunks} chunks, peak RSS {self.peak_rss_mb:.0f} MB")
+        self._publish(final=True)
+        self._save(summary)
+        return False
+
+    def _sample(self):
+        last_publish = 0.0
+        while not self._stop.wait(0.5):
+            self.peak_rss_mb = max(self.peak_rss_mb, current_rss_mb())
+            if time.time() - last_publish >= METRICS_PUBLISH_INTERVAL:
+                self._publish()
+                last_publish = time.time()
+
+    def summary(self) -> dict:
+        wall = getattr(self, 'wall_seconds', None)
+        if wall is None:
+            wall = time.perf_counter() - self._start
+        return {
+            'stage': self.stage,
+            'run_id': self.run_id,
+            'worker_id': self.worker_id,
+            'status': self.status,
+            'started_at': self.started_at,
+            'wall_seconds': wall,
+            'db_seconds': self.db_seconds,
+            'compute_seconds': max(wall - self.db_seconds, 0.0),
+            'documents': self.documents,
+            'chunks': self.chunks,
+            'docs_per_second': self.documents / wall if wall > 0 else None,
+            'chunks_per_second': self.chunks / wall if wall > 0 else None,
+            'peak_rss_mb': self.peak_rss_mb,
+            # lifetime peak of finished child processes (pdf extraction, spaCy pool)
+            'children_peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+            'quality': self.quality or None,
+            'error': self.error,
+        }
+
+    def _publish(self, final: bool = False):
+        if self.r is None:
+            return
+        try:
+            if final:
+                self.r.hdel(STATUS_KEY, self.worker_id)
+            else:
+                self.r.hset(STATUS_KEY, self.worker_id, json.dumps(dict(self.summary(), updated_at=time.time())))
+        except redis.RedisError as e:
+            print(f"Could not publish progress: {e}")
+
+    def _save(self, summary: dict):
+        try:
+            conn = psycopg2.connect(**DB_CONFIG)
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """INSERT INTO pipeline_runs
+                               (run_id, stage, worker_id, status, started_at, finished_at, wall_seconds, db_seconds,
+                                compute_seconds, documents, chunks, docs_per_second, chunks_per_second, peak_rss_mb,
+                                children_peak_rss_mb, params, quality, error)
+                           VALUES (%s, %s, %s, %s, to_timestamp(%s), now(), %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+                        (summary['run_id'], summary['stage'], summary['worker_id'], summary['status'],
+                         summary['started_at'], summary['wall_seconds'], summary['db_seconds'],
+                         summary['compute_seconds'], summary['documents'], summary['chunks'],
+                         summary['docs_per_second'], summary['chunks_per_second'], summary['peak_rss_mb'],
+                         summary['children_peak_rss_mb'], json.dumps(self.params, default=str),
+                         json.dumps(summary['quality']) if summary['quality'] else None, summary['error'])
+                    )
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception as e:
+            print(f"Could not save stage metrics: {e}")
@@ -0,0 +1,23 @@
+"""Models loaded once per worker process and reused by every task that needs them"""
+import threading
+from typing import Callable, Hashable
+
+_models = {}
+# reentrant: a loader may itself load what it wraps through cached_model (the embedding engine its model)
+_lock = threading.RLock()
+
+def cached_model(key: Hashable, loader: Callable, version=None):
+    """
+    Return the model cached under key, calling loader() the first time it is asked for
+    or when version (e.g. a file mtime) no longer matches the one it was loaded with
+    """
+    with _lock:
+        entry = _models.get(key)
+        if entry is None or entry[0] != version:
+            entry = (version, loader())
+            _models[key] = entry
+        return entry[1]
+
+def evict_model(key: Hashable):
+    with _lock:
+        _models.pop(key, None)
@@ -0,0 +1,86 @@
+"""Headless topic map rendering"""
+import numpy as np
+from typing import List, Optional, Tuple
+
+from config import TOPIC_MAP_PATH, TOPIC_MAP_DPI, TOPIC_MAP_DENSITY_THRESHOLD, TOPIC_MAP_MAX_LABELS
+from db import connect_db
+from metrics import record_progress
+
+def fetch_map_points(conn) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[str]]:
+    """(document ids, coordinates, cluster labels, titles) of every placed document, -1 when it has no topic"""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT dc.document_id, dc.x, dc.y, COALESCE(t.cluster_label, -1), COALESCE(d.title, d.file_path, '')
+            FROM doc_coords dc
+            JOIN documents d ON d.id = dc.document_id
+            LEFT JOIN document_topics dt ON dt.document_id = dc.document_id
+            LEFT JOIN topics t ON t.id = dt.topic_id
+            ORDER BY dc.document_id
+        """)
+        rows = cur.fetchall()
+    conn.commit()
+    doc_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    coords = np.array([(row[1], row[2]) for row in rows], dtype=np.float64).reshape(-1, 2)
+    labels = np.array([row[3] for row in rows], dtype=np.int64)
+    return doc_ids, coords, labels, [row[4] for row in rows]
+
+def plot_topic_map(embedding_2d, cluster_labels, titles: Optional[List[str]] = None,
+                   save_path: str = TOPIC_MAP_PATH, dpi: int = TOPIC_MAP_DPI,
+                   density_threshold: int = TOPIC_MAP_DENSITY_THRESHOLD, max_labels: int = TOPIC_MAP_MAX_LABELS,
+                   random_state: int = 42):
+    """
+    Render the topic map to save_path with the Agg backend (no display needed).
+    Up to density_threshold documents are drawn with one scatter call colored by topic, beyond that as a
+    log-scaled hexbin density with the topics marked at their centroids. At most max_labels titles are drawn,
+    for a random sample of the documents seeded with random_state.
+    """
+    from matplotlib import colormaps
+    from matplotlib.figure import Figure
+
+    embedding_2d = np.asarray(embedding_2d)
+    cluster_labels = np.asarray(cluster_labels)
+    x, y = embedding_2d[:, 0], embedding_2d[:, 1]
+    topics = np.unique(cluster_labels[cluster_labels != -1])
+
+    fig = Figure(figsize=(12, 8))
+    ax = fig.add_subplot()
+    if len(cluster_labels) > density_threshold:
+        image = ax.hexbin(x, y, gridsize=200, bins='log', cmap='viridis', mincnt=1, linewidths=0)
+        fig.colorbar(image, ax=ax, label='documents (log)')
+        for topic in topics:
+            mask = cluster_labels == topic
+            ax.annotate(str(topic), (np.median(x[mask]), np.median(y[mask])), fontsize=7, ha='center',
+                        color='white', weight='bold')
+    else:
+        colors = colormaps['tab20'](np.searchsorted(topics, cluster_labels) % 20)
+        colors[cluster_labels == -1] = (0, 0, 0, 1)
+        size = max(2.0, min(60.0, 20000.0 / max(len(cluster_labels), 1)))
+        ax.scatter(x, y, c=colors, s=size, alpha=0.7, linewidths=0, rasterized=True)
+
+    if titles is not None and max_labels > 0 and len(titles):
+        rng = np.random.default_rng(random_state)
+        sample = rng.choice(len(titles), size=min(max_labels, len(titles)), replace=False)
+        for i in sample.tolist():
+            title = titles[i]
+            ax.annotate(title[:20] + ('...' if len(title) > 20 else ''), (x[i], y[i]),
+                        xytext=(5, 5), textcoords='offset points', fontsize=6, alpha=0.7)
+
+    ax.set_title(f'Document Topic Map (UMAP + HDBSCAN): {len(cluster_labels)} documents, {len(topics)} topics')
+    ax.set_xlabel('UMAP Dimension 1')
+    ax.set_ylabel('UMAP Dimension 2')
+    fig.savefig(save_path, dpi=dpi, bbox_inches='tight')
+    print(f"Saved topic map to {save_path}")
+
+def render_map(save_path: str = TOPIC_MAP_PATH, dpi: int = TOPIC_MAP_DPI,
+               density_threshold: int = TOPIC_MAP_DENSITY_THRESHOLD, max_labels: int = TOPIC_MAP_MAX_LABELS):
+    """Render the topic map from the stored coordinates and topics, independent of the umap run"""
+    conn = connect_db()
+    try:
+        doc_ids, coords, labels, titles = fetch_map_points(conn)
+    finally:
+        conn.close()
+    if len(doc_ids) == 0:
+        print("No document coordinates yet, run umap first")
+        return
+    record_progress(documents=len(doc_ids))
+    plot_topic_map(coords, labels, titles, save_path, int(dpi), int(density_threshold), int(max_labels))
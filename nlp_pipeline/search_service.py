@@ -0,0 +1,85 @@
+"""
+Similarity search over the ANN indexes, served as JSON for the web apps:
+
+  GET /similar/<document id>?k=10                    documents closest to a document
+  GET /search?q=<text>&k=10&scope=chunks|documents   chunks (or documents) closest to a text query
+
+Answers carry ids and cosine scores only; the callers look the titles and chunk texts up themselves.
+"""
+import json
+import threading
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from ann import get_index, split_chunk_keys
+from config import EMBEDDING_MODEL_NAME, ANN_NPROBE, SEARCH_PORT
+from embedding import load_embedding_model
+from models import cached_model
+
+MAX_RESULTS = 100
+_encode_lock = threading.Lock()
+
+def encode_query(text: str) -> np.ndarray:
+    model = cached_model(('embedding', EMBEDDING_MODEL_NAME), lambda: load_embedding_model(EMBEDDING_MODEL_NAME))
+    # the model is shared by the request threads
+    with _encode_lock:
+        return model.encode([text], batch_size=1, convert_to_numpy=True, show_progress_bar=False)[0]
+
+def similar_documents(document_id: int, k: int = 10, nprobe: int = ANN_NPROBE) -> list:
+    index = get_index('documents')
+    vector = index.vector(document_id)
+    if vector is None:
+        raise KeyError(f"document {document_id} is not indexed")
+    ids, scores = index.search(vector, k + 1, nprobe)
+    return [{'document_id': int(i), 'score': float(s)} for i, s in zip(ids, scores) if i != document_id][:k]
+
+def search(text: str, k: int = 10, scope: str = 'chunks', nprobe: int = ANN_NPROBE) -> list:
+    if scope not in ('chunks', 'documents'):
+        raise ValueError(f"Unknown search scope: {scope}")
+    ids, scores = get_index(scope).search(encode_query(text), k, nprobe)
+    if scope == 'documents':
+        return [{'document_id': int(i), 'score': float(s)} for i, s in zip(ids, scores)]
+    document_ids, sequence_numbers = split_chunk_keys(ids)
+    return [{'document_id': int(d), 'sequence_number': int(n), 'score': float(s)}
+            for d, n, s in zip(document_ids, sequence_numbers, scores)]
+
+class SearchHandler(BaseHTTPRequestHandler):
+
+    def _reply(self, status: int, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split('/') if part]
+        try:
+            k = min(max(int(query.get('k', 10)), 1), MAX_RESULTS)
+            nprobe = int(query.get('nprobe', ANN_NPROBE))
+            if len(parts) == 2 and parts[0] == 'similar':
+                self._reply(200, {'document_id': int(parts[1]),
+                                  'results': similar_documents(int(parts[1]), k, nprobe)})
+            elif parts == ['search'] and query.get('q'):
+                self._reply(200, {'query': query['q'],
+                                  'results': search(query['q'], k, query.get('scope', 'chunks'), nprobe)})
+            elif parts == ['health']:
+                self._reply(200, {name: len(get_index(name)) for name in ('documents', 'chunks')})
+            else:
+                self._reply(404, {'error': 'unknown route'})
+        except KeyError as e:
+            self._reply(404, {'error': str(e.args[0])})
+        except ValueError as e:
+            self._reply(400, {'error': str(e)})
+
+def run_search_service(port: int = SEARCH_PORT):
+    server = ThreadingHTTPServer(('0.0.0.0', port), SearchHandler)
+    print(f"Search service listening on port {port}")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    run_search_service()
@@ -0,0 +1,6 @@
+-- PDFs the loader gave up on (timeout, crash or extraction error), skipped by later scans
+CREATE TABLE IF NOT EXISTS public.quarantined_files (
+    file_path text PRIMARY KEY,
+    reason text,
+    created_at timestamp without time zone DEFAULT now()
+);
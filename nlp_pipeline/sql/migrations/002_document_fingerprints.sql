@@ -0,0 +1,9 @@
+-- Content fingerprints used by the loader to skip unchanged files, follow renames and re-process edits
+ALTER TABLE public.documents ADD COLUMN IF NOT EXISTS content_hash text;
+ALTER TABLE public.documents ADD COLUMN IF NOT EXISTS file_size bigint;
+ALTER TABLE public.documents ADD COLUMN IF NOT EXISTS file_mtime double precision;
+
+CREATE INDEX IF NOT EXISTS idx_documents_content_hash ON public.documents USING btree (content_hash);
+CREATE INDEX IF NOT EXISTS idx_documents_file_path ON public.documents USING btree (file_path);
+
+ALTER TABLE public.quarantined_files ADD COLUMN IF NOT EXISTS content_hash text;
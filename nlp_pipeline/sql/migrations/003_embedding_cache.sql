@@ -0,0 +1,8 @@
+-- Persistent tier of the chunk embedding cache, keyed by model and a 16 byte blake2b hash of the chunk text
+CREATE TABLE IF NOT EXISTS public.embedding_cache (
+    model_name text NOT NULL,
+    text_hash bytea NOT NULL,
+    embedding real[] NOT NULL,
+    created_at timestamp without time zone DEFAULT now(),
+    PRIMARY KEY (model_name, text_hash)
+);
@@ -0,0 +1,4 @@
+-- HDBSCAN label each topic was created from, lets incremental runs map predicted labels onto existing topics
+ALTER TABLE public.topics ADD COLUMN IF NOT EXISTS cluster_label integer;
+
+CREATE INDEX IF NOT EXISTS idx_doc_coords_document_id ON public.doc_coords USING btree (document_id);
@@ -0,0 +1,468 @@
+-- Incremental class-based tf-idf
+--
+-- topic_terms, term_tf, term_df, topic_term_tfidf and topic_top_terms become persistent, indexed tables.
+-- Statement-level triggers on document_terms and document_topics queue the documents whose terms or
+-- topic changed, and log the term rows that changed for documents already counted in the aggregates.
+-- refresh_topic_tables_incremental() then applies per (topic, term) deltas for just those documents.
+-- refresh_topic_tables() still rebuilds everything, now into new tables swapped in at the end.
+
+CREATE TABLE IF NOT EXISTS public.topic_terms (
+    term_id integer,
+    topic_id integer,
+    document_count bigint,
+    total_frequency bigint
+);
+
+CREATE TABLE IF NOT EXISTS public.term_tf (
+    topic_id integer,
+    term_id integer,
+    term_frequency numeric
+);
+
+CREATE TABLE IF NOT EXISTS public.term_df (
+    term_id integer,
+    document_frequency bigint
+);
+
+CREATE TABLE IF NOT EXISTS public.topic_term_tfidf (
+    topic_id integer,
+    term_id integer,
+    tf numeric,
+    df bigint,
+    tf_idf double precision
+);
+
+CREATE TABLE IF NOT EXISTS public.topic_top_terms (
+    topic_id integer,
+    term_text text,
+    tf_idf double precision,
+    rank bigint
+);
+
+CREATE OR REPLACE PROCEDURE public.ctfidf_create_indexes()
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    CREATE UNIQUE INDEX IF NOT EXISTS topic_terms_topic_id_term_id_key ON public.topic_terms USING btree (topic_id, term_id);
+    CREATE INDEX IF NOT EXISTS idx_topic_terms_term_id ON public.topic_terms USING btree (term_id);
+    CREATE UNIQUE INDEX IF NOT EXISTS term_tf_topic_id_term_id_key ON public.term_tf USING btree (topic_id, term_id);
+    CREATE UNIQUE INDEX IF NOT EXISTS term_df_term_id_key ON public.term_df USING btree (term_id);
+    CREATE UNIQUE INDEX IF NOT EXISTS topic_term_tfidf_topic_id_term_id_key ON public.topic_term_tfidf USING btree (topic_id, term_id);
+    CREATE INDEX IF NOT EXISTS idx_topic_term_tfidf_term_id ON public.topic_term_tfidf USING btree (term_id);
+    CREATE INDEX IF NOT EXISTS idx_topic_top_terms_topic_id ON public.topic_top_terms USING btree (topic_id);
+END;
+$$;
+
+CALL public.ctfidf_create_indexes();
+
+-- Topic assignments the aggregates were last computed from
+CREATE TABLE IF NOT EXISTS public.ctfidf_document_topics (
+    document_id integer NOT NULL,
+    topic_id integer NOT NULL,
+    PRIMARY KEY (document_id, topic_id)
+);
+
+-- Documents whose terms or topic changed since the last refresh
+CREATE TABLE IF NOT EXISTS public.ctfidf_pending_documents (
+    document_id integer PRIMARY KEY
+);
+
+-- Term row changes of documents in ctfidf_document_topics since the last refresh
+CREATE TABLE IF NOT EXISTS public.ctfidf_term_log (
+    document_id integer NOT NULL,
+    term_id integer NOT NULL,
+    frequency_delta bigint NOT NULL,
+    presence_delta integer NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS public.ctfidf_state (
+    id boolean PRIMARY KEY DEFAULT true CHECK (id),
+    n_topics bigint,
+    refreshed_at timestamp without time zone
+);
+INSERT INTO public.ctfidf_state (id) VALUES (true) ON CONFLICT DO NOTHING;
+-- top_k of the last refresh, the incremental refresh only re-ranks changed topics so a different one needs a rebuild
+ALTER TABLE public.ctfidf_state ADD COLUMN IF NOT EXISTS top_k integer;
+
+-- Trigger functions, new_rows / old_rows are the statement's transition tables
+
+CREATE OR REPLACE FUNCTION public.ctfidf_queue_new_rows() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    INSERT INTO public.ctfidf_pending_documents (document_id)
+    SELECT DISTINCT document_id FROM new_rows WHERE document_id IS NOT NULL
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION public.ctfidf_queue_old_rows() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    INSERT INTO public.ctfidf_pending_documents (document_id)
+    SELECT DISTINCT document_id FROM old_rows WHERE document_id IS NOT NULL
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION public.ctfidf_queue_changed_rows() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    INSERT INTO public.ctfidf_pending_documents (document_id)
+    SELECT document_id FROM old_rows WHERE document_id IS NOT NULL
+    UNION
+    SELECT document_id FROM new_rows WHERE document_id IS NOT NULL
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION public.ctfidf_log_new_terms() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    INSERT INTO public.ctfidf_pending_documents (document_id)
+    SELECT DISTINCT document_id FROM new_rows WHERE document_id IS NOT NULL
+    ON CONFLICT DO NOTHING;
+    -- documents not yet counted have nothing to subtract, their rows are read as they are at refresh time
+    INSERT INTO public.ctfidf_term_log (document_id, term_id, frequency_delta, presence_delta)
+    SELECT n.document_id, n.term_id, n.frequency, 1
+    FROM new_rows n
+    WHERE EXISTS (SELECT 1 FROM public.ctfidf_document_topics s WHERE s.document_id = n.document_id);
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION public.ctfidf_log_old_terms() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    INSERT INTO public.ctfidf_pending_documents (document_id)
+    SELECT DISTINCT document_id FROM old_rows WHERE document_id IS NOT NULL
+    ON CONFLICT DO NOTHING;
+    INSERT INTO public.ctfidf_term_log (document_id, term_id, frequency_delta, presence_delta)
+    SELECT o.document_id, o.term_id, -o.frequency, -1
+    FROM old_rows o
+    WHERE EXISTS (SELECT 1 FROM public.ctfidf_document_topics s WHERE s.document_id = o.document_id);
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION public.ctfidf_log_changed_terms() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    INSERT INTO public.ctfidf_pending_documents (document_id)
+    SELECT document_id FROM old_rows WHERE document_id IS NOT NULL
+    UNION
+    SELECT document_id FROM new_rows WHERE document_id IS NOT NULL
+    ON CONFLICT DO NOTHING;
+    INSERT INTO public.ctfidf_term_log (document_id, term_id, frequency_delta, presence_delta)
+    SELECT o.document_id, o.term_id, -o.frequency, -1
+    FROM old_rows o
+    WHERE EXISTS (SELECT 1 FROM public.ctfidf_document_topics s WHERE s.document_id = o.document_id)
+    UNION ALL
+    SELECT n.document_id, n.term_id, n.frequency, 1
+    FROM new_rows n
+    WHERE EXISTS (SELECT 1 FROM public.ctfidf_document_topics s WHERE s.document_id = n.document_id);
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS document_terms_ctfidf_insert ON public.document_terms;
+CREATE TRIGGER document_terms_ctfidf_insert AFTER INSERT ON public.document_terms
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION public.ctfidf_log_new_terms();
+DROP TRIGGER IF EXISTS document_terms_ctfidf_update ON public.document_terms;
+CREATE TRIGGER document_terms_ctfidf_update AFTER UPDATE ON public.document_terms
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION public.ctfidf_log_changed_terms();
+DROP TRIGGER IF EXISTS document_terms_ctfidf_delete ON public.document_terms;
+CREATE TRIGGER document_terms_ctfidf_delete AFTER DELETE ON public.document_terms
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION public.ctfidf_log_old_terms();
+
+DROP TRIGGER IF EXISTS document_topics_ctfidf_insert ON public.document_topics;
+CREATE TRIGGER document_topics_ctfidf_insert AFTER INSERT ON public.document_topics
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION public.ctfidf_queue_new_rows();
+DROP TRIGGER IF EXISTS document_topics_ctfidf_update ON public.document_topics;
+CREATE TRIGGER document_topics_ctfidf_update AFTER UPDATE ON public.document_topics
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION public.ctfidf_queue_changed_rows();
+DROP TRIGGER IF EXISTS document_topics_ctfidf_delete ON public.document_topics;
+CREATE TRIGGER document_topics_ctfidf_delete AFTER DELETE ON public.document_topics
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION public.ctfidf_queue_old_rows();
+
+-- The procedures take top_k (the number of label terms kept per topic), drop the signatures without it
+-- so CALL is not ambiguous on databases created before
+DROP PROCEDURE IF EXISTS public.refresh_topic_tables();
+DROP PROCEDURE IF EXISTS public.refresh_topic_tables_incremental(double precision);
+
+--
+-- Full rebuild. The new tables are built next to the old ones and swapped in at the end, so readers
+-- only wait for the final drop and rename.
+--
+CREATE OR REPLACE PROCEDURE public.refresh_topic_tables(top_k integer DEFAULT 5)
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    topic_count bigint;
+BEGIN
+    LOCK TABLE ctfidf_state IN EXCLUSIVE MODE;
+
+    -- everything is recomputed, so the queued changes are covered
+    DELETE FROM ctfidf_pending_documents;
+    DELETE FROM ctfidf_term_log;
+
+    SELECT COUNT(id) INTO topic_count FROM topics;
+
+    DROP TABLE IF EXISTS topic_top_terms_new, topic_term_tfidf_new, term_df_new, term_tf_new, topic_terms_new;
+
+    CREATE TABLE topic_terms_new AS
+    SELECT
+        dt.term_id,
+        dot.topic_id,
+        COUNT(DISTINCT dt.document_id) as document_count,
+        SUM(frequency) as total_frequency
+    FROM document_terms dt
+    JOIN document_topics dot ON dt.document_id = dot.document_id
+    GROUP BY dt.term_id, dot.topic_id;
+
+    CREATE TABLE term_tf_new AS
+    SELECT
+        topic_id,
+        term_id,
+        SUM(total_frequency) as term_frequency
+    FROM topic_terms_new
+    GROUP BY topic_id, term_id;
+
+    CREATE TABLE term_df_new AS
+    SELECT
+        term_id,
+        COUNT(DISTINCT topic_id) as document_frequency
+    FROM topic_terms_new
+    GROUP BY term_id;
+
+    CREATE TABLE topic_term_tfidf_new AS
+    SELECT
+        tt.topic_id,
+        tt.term_id,
+        tt.term_frequency as tf,
+        tdf.document_frequency as df,
+        tt.term_frequency * LN( topic_count / GREATEST(tdf.document_frequency, 1)) as tf_idf
+    FROM term_tf_new tt
+    JOIN term_df_new tdf ON tt.term_id = tdf.term_id;
+
+    CREATE TABLE topic_top_terms_new AS
+    WITH ranked_terms AS (
+        SELECT
+            ttf.topic_id,
+            t.term_text,
+            ttf.tf_idf,
+            ROW_NUMBER() OVER (PARTITION BY ttf.topic_id ORDER BY ttf.tf_idf DESC) as rank
+        FROM topic_term_tfidf_new ttf
+        JOIN terms t ON ttf.term_id = t.id
+    )
+    SELECT
+        topic_id,
+        term_text,
+        tf_idf,
+        rank
+    FROM ranked_terms
+    WHERE rank <= top_k
+    ORDER BY topic_id, rank;
+
+    -- Swap the new tables in
+    DROP TABLE IF EXISTS topic_top_terms, topic_term_tfidf, term_df, term_tf, topic_terms;
+    ALTER TABLE topic_terms_new RENAME TO topic_terms;
+    ALTER TABLE term_tf_new RENAME TO term_tf;
+    ALTER TABLE term_df_new RENAME TO term_df;
+    ALTER TABLE topic_term_tfidf_new RENAME TO topic_term_tfidf;
+    ALTER TABLE topic_top_terms_new RENAME TO topic_top_terms;
+    CALL ctfidf_create_indexes();
+
+    DELETE FROM ctfidf_document_topics;
+    INSERT INTO ctfidf_document_topics (document_id, topic_id)
+    SELECT document_id, topic_id FROM document_topics;
+    UPDATE ctfidf_state SET n_topics = topic_count, top_k = refresh_topic_tables.top_k, refreshed_at = now();
+
+    RAISE NOTICE 'All topic tables refreshed successfully';
+   
+EXCEPTION
+    WHEN OTHERS THEN
+        RAISE EXCEPTION 'Error refreshing topic tables: %', SQLERRM;
+END;
+$$;
+
+--
+-- Incremental refresh: applies the changes of the queued documents only. Falls back to the full rebuild
+-- when nothing has been computed yet or more than full_rebuild_ratio of the documents changed.
+--
+CREATE OR REPLACE PROCEDURE public.refresh_topic_tables_incremental(full_rebuild_ratio double precision DEFAULT 0.2,
+                                                                  top_k integer DEFAULT 5)
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    changed_count bigint;
+    document_count bigint;
+    topic_count bigint;
+    previous_topic_count bigint;
+    previous_top_k integer;
+BEGIN
+    LOCK TABLE ctfidf_state IN EXCLUSIVE MODE;
+    SELECT n_topics, ctfidf_state.top_k INTO previous_topic_count, previous_top_k FROM ctfidf_state;
+
+    SELECT COUNT(*) INTO changed_count FROM (
+        SELECT document_id FROM ctfidf_pending_documents
+        UNION
+        SELECT document_id FROM ctfidf_term_log
+    ) c;
+    SELECT COUNT(DISTINCT document_id) INTO document_count FROM document_topics;
+
+    IF previous_top_k IS DISTINCT FROM top_k THEN
+        RAISE NOTICE 'top_k changed from % to %, running a full rebuild', previous_top_k, top_k;
+        CALL refresh_topic_tables(top_k);
+        RETURN;
+    END IF;
+    IF previous_topic_count IS NULL OR changed_count > full_rebuild_ratio * GREATEST(document_count, 1) THEN
+        RAISE NOTICE '% changed documents, running a full rebuild', changed_count;
+        CALL refresh_topic_tables(top_k);
+        RETURN;
+    END IF;
+    IF changed_count = 0 THEN
+        RAISE NOTICE 'No document changed since the last refresh';
+        RETURN;
+    END IF;
+
+    -- Take the queued work
+    CREATE TEMP TABLE ctfidf_changed (document_id integer PRIMARY KEY) ON COMMIT DROP;
+    WITH taken AS (DELETE FROM ctfidf_pending_documents RETURNING document_id)
+    INSERT INTO ctfidf_changed SELECT document_id FROM taken;
+
+    CREATE TEMP TABLE ctfidf_log ON COMMIT DROP AS
+    WITH taken AS (DELETE FROM ctfidf_term_log RETURNING *)
+    SELECT document_id, term_id, SUM(frequency_delta) AS frequency_delta, SUM(presence_delta) AS presence_delta
+    FROM taken
+    GROUP BY document_id, term_id;
+    INSERT INTO ctfidf_changed SELECT DISTINCT document_id FROM ctfidf_log ON CONFLICT DO NOTHING;
+
+    -- Current term rows of the changed documents, and the rows they had at the last refresh
+    -- (current rows with the logged changes undone)
+    CREATE TEMP TABLE ctfidf_doc_terms ON COMMIT DROP AS
+    SELECT
+        COALESCE(cur.document_id, l.document_id) AS document_id,
+        COALESCE(cur.term_id, l.term_id) AS term_id,
+        COALESCE(cur.frequency, 0) AS new_frequency,
+        (cur.document_id IS NOT NULL)::integer AS new_present,
+        COALESCE(cur.frequency, 0) - COALESCE(l.frequency_delta, 0) AS old_frequency,
+        (cur.document_id IS NOT NULL)::integer - COALESCE(l.presence_delta, 0) AS old_present
+    FROM (
+        SELECT dt.document_id, dt.term_id, dt.frequency
+        FROM document_terms dt
+        JOIN ctfidf_changed c ON c.document_id = dt.document_id
+    ) cur
+    FULL OUTER JOIN ctfidf_log l ON l.document_id = cur.document_id AND l.term_id = cur.term_id;
+
+    -- Per (topic, term) change: remove what each document contributed under its old topics,
+    -- add what it contributes now under its current topics
+    CREATE TEMP TABLE ctfidf_deltas ON COMMIT DROP AS
+    SELECT topic_id, term_id, SUM(document_delta) AS document_delta, SUM(frequency_delta) AS frequency_delta
+    FROM (
+        SELECT s.topic_id, t.term_id, -t.old_present AS document_delta, -t.old_frequency AS frequency_delta
+        FROM ctfidf_doc_terms t
+        JOIN ctfidf_document_topics s ON s.document_id = t.document_id
+        WHERE t.old_present > 0
+        UNION ALL
+        SELECT dot.topic_id, t.term_id, t.new_present, t.new_frequency
+        FROM ctfidf_doc_terms t
+        JOIN document_topics dot ON dot.document_id = t.document_id
+        WHERE t.new_present > 0
+    ) d
+    GROUP BY topic_id, term_id
+    HAVING SUM(document_delta) <> 0 OR SUM(frequency_delta) <> 0;
+
+    INSERT INTO topic_terms AS tt (term_id, topic_id, document_count, total_frequency)
+    SELECT term_id, topic_id, document_delta, frequency_delta FROM ctfidf_deltas
+    ON CONFLICT (topic_id, term_id) DO UPDATE
+    SET document_count = tt.document_count + EXCLUDED.document_count,
+        total_frequency = tt.total_frequency + EXCLUDED.total_frequency;
+    DELETE FROM topic_terms tt USING ctfidf_deltas d
+    WHERE tt.topic_id = d.topic_id AND tt.term_id = d.term_id AND tt.document_count <= 0;
+
+    DELETE FROM term_tf tf USING ctfidf_deltas d
+    WHERE tf.topic_id = d.topic_id AND tf.term_id = d.term_id;
+    INSERT INTO term_tf (topic_id, term_id, term_frequency)
+    SELECT tt.topic_id, tt.term_id, tt.total_frequency
+    FROM topic_terms tt
+    JOIN ctfidf_deltas d ON d.topic_id = tt.topic_id AND d.term_id = tt.term_id;
+
+    -- Terms whose df may have changed
+    CREATE TEMP TABLE ctfidf_terms ON COMMIT DROP AS
+    SELECT DISTINCT term_id FROM ctfidf_deltas;
+
+    DELETE FROM term_df WHERE term_id IN (SELECT term_id FROM ctfidf_terms);
+    INSERT INTO term_df (term_id, document_frequency)
+    SELECT tt.term_id, COUNT(DISTINCT tt.topic_id)
+    FROM topic_terms tt
+    JOIN ctfidf_terms c ON c.term_id = tt.term_id
+    GROUP BY tt.term_id;
+
+    -- tf-idf depends on the number of topics, when that changed every row is recomputed
+    -- (from the small aggregate tables, not from document_terms)
+    SELECT COUNT(id) INTO topic_count FROM topics;
+    CREATE TEMP TABLE ctfidf_ranked_topics (topic_id integer PRIMARY KEY) ON COMMIT DROP;
+    IF topic_count <> previous_topic_count THEN
+        DELETE FROM topic_term_tfidf;
+        INSERT INTO topic_term_tfidf (topic_id, term_id, tf, df, tf_idf)
+        SELECT tt.topic_id, tt.term_id, tt.term_frequency, tdf.document_frequency,
+               tt.term_frequency * LN( topic_count / GREATEST(tdf.document_frequency, 1))
+        FROM term_tf tt
+        JOIN term_df tdf ON tt.term_id = tdf.term_id;
+        INSERT INTO ctfidf_ranked_topics SELECT DISTINCT topic_id FROM topic_term_tfidf;
+        DELETE FROM topic_top_terms;
+    ELSE
+        DELETE FROM topic_term_tfidf WHERE term_id IN (SELECT term_id FROM ctfidf_terms);
+        INSERT INTO topic_term_tfidf (topic_id, term_id, tf, df, tf_idf)
+        SELECT tt.topic_id, tt.term_id, tt.term_frequency, tdf.document_frequency,
+               tt.term_frequency * LN( topic_count / GREATEST(tdf.document_frequency, 1))
+        FROM term_tf tt
+        JOIN term_df tdf ON tt.term_id = tdf.term_id
+        WHERE tt.term_id IN (SELECT term_id FROM ctfidf_terms);
+        INSERT INTO ctfidf_ranked_topics
+        SELECT DISTINCT topic_id FROM topic_term_tfidf WHERE term_id IN (SELECT term_id FROM ctfidf_terms)
+        UNION
+        SELECT topic_id FROM ctfidf_deltas;
+        DELETE FROM topic_top_terms
+        WHERE topic_id IN (SELECT topic_id FROM ctfidf_ranked_topics)
+           OR topic_id NOT IN (SELECT id FROM topics);
+    END IF;
+
+    INSERT INTO topic_top_terms (topic_id, term_text, tf_idf, rank)
+    SELECT topic_id, term_text, tf_idf, rank
+    FROM (
+        SELECT
+            ttf.topic_id,
+            t.term_text,
+            ttf.tf_idf,
+            ROW_NUMBER() OVER (PARTITION BY ttf.topic_id ORDER BY ttf.tf_idf DESC) as rank
+        FROM topic_term_tfidf ttf
+        JOIN terms t ON ttf.term_id = t.id
+        WHERE ttf.topic_id IN (SELECT topic_id FROM ctfidf_ranked_topics)
+    ) ranked_terms
+    WHERE rank <= top_k;
+
+    -- Remember the assignments the aggregates now reflect
+    DELETE FROM ctfidf_document_topics WHERE document_id IN (SELECT document_id FROM ctfidf_changed);
+    INSERT INTO ctfidf_document_topics (document_id, topic_id)
+    SELECT dot.document_id, dot.topic_id
+    FROM document_topics dot
+    JOIN ctfidf_changed c ON c.document_id = dot.document_id;
+    UPDATE ctfidf_state SET n_topics = topic_count, refreshed_at = now();
+
+    RAISE NOTICE 'Topic tables updated for % changed documents', changed_count;
+
+EXCEPTION
+    WHEN OTHERS THEN
+        RAISE EXCEPTION 'Error refreshing topic tables: %', SQLERRM;
+END;
+$$;
@@ -0,0 +1,24 @@
+-- One row per finished task (or document sub-task) with its timing, throughput and memory
+CREATE TABLE IF NOT EXISTS public.pipeline_runs (
+    id serial PRIMARY KEY,
+    run_id text,
+    stage text NOT NULL,
+    worker_id text,
+    status text NOT NULL,
+    started_at timestamp with time zone NOT NULL,
+    finished_at timestamp with time zone NOT NULL DEFAULT now(),
+    wall_seconds double precision,
+    db_seconds double precision,
+    compute_seconds double precision,
+    documents integer,
+    chunks integer,
+    docs_per_second double precision,
+    chunks_per_second double precision,
+    peak_rss_mb double precision,
+    children_peak_rss_mb double precision,
+    params jsonb,
+    error text
+);
+
+CREATE INDEX IF NOT EXISTS idx_pipeline_runs_started_at ON public.pipeline_runs USING btree (started_at DESC);
+CREATE INDEX IF NOT EXISTS idx_pipeline_runs_run_id ON public.pipeline_runs USING btree (run_id);
@@ -0,0 +1,9 @@
+-- Version of the data behind the dashboards, bumped by the worker in the transaction that changes documents,
+-- topics, coordinates or topic labels. The web apps cache their payloads until it moves.
+CREATE TABLE IF NOT EXISTS public.pipeline_state (
+    id boolean PRIMARY KEY DEFAULT true CHECK (id),
+    version bigint NOT NULL DEFAULT 0,
+    updated_at timestamp with time zone NOT NULL DEFAULT now()
+);
+
+INSERT INTO public.pipeline_state (id) VALUES (true) ON CONFLICT (id) DO NOTHING;
@@ -0,0 +1,60 @@
+-- Narrow per-document metadata for the dashboards, so listing documents never reads (detoasts) raw_text.
+-- char_length, byte_size and preview follow raw_text through a trigger, page_count is the number of pages of the
+-- PDF as written by the loader (for rows without it, the number of extracted pages in raw_text), and a missing
+-- title is the file name without its directory and .pdf extension.
+
+ALTER TABLE public.documents ADD COLUMN IF NOT EXISTS char_length integer;
+ALTER TABLE public.documents ADD COLUMN IF NOT EXISTS byte_size integer;
+ALTER TABLE public.documents ADD COLUMN IF NOT EXISTS page_count integer;
+ALTER TABLE public.documents ADD COLUMN IF NOT EXISTS preview text;
+
+-- Pages are separated by the page break marker; the loader's strip() cuts the marker after the last page short,
+-- so the pages are one more than the complete markers
+CREATE OR REPLACE FUNCTION public.document_page_count(raw_text text) RETURNS integer
+    LANGUAGE sql IMMUTABLE
+    AS $$
+    SELECT CASE WHEN raw_text IS NULL OR raw_text = '' THEN 0
+                ELSE (octet_length(raw_text) - octet_length(replace(raw_text, E'\n\n<<PAGE_BREAK>>\n\n', '')))
+                     / octet_length(E'\n\n<<PAGE_BREAK>>\n\n') + 1
+           END
+$$;
+
+CREATE OR REPLACE FUNCTION public.document_title(file_path text) RETURNS text
+    LANGUAGE sql IMMUTABLE
+    AS $$
+    SELECT regexp_replace(regexp_replace(file_path, '^.*/', ''), '\.pdf$', '', 'i')
+$$;
+
+CREATE OR REPLACE FUNCTION public.documents_text_metadata() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    NEW.char_length := char_length(NEW.raw_text);
+    NEW.byte_size := octet_length(NEW.raw_text);
+    NEW.preview := left(replace(left(NEW.raw_text, 600), E'\n\n<<PAGE_BREAK>>\n\n', ' '), 500);
+    IF NEW.page_count IS NULL THEN
+        NEW.page_count := document_page_count(NEW.raw_text);
+    END IF;
+    IF NEW.title IS NULL THEN
+        NEW.title := document_title(NEW.file_path);
+    END IF;
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS documents_text_metadata ON public.documents;
+CREATE TRIGGER documents_text_metadata
+    BEFORE INSERT OR UPDATE OF raw_text ON public.documents
+    FOR EACH ROW EXECUTE FUNCTION public.documents_text_metadata();
+
+-- backfill documents loaded before these columns existed
+UPDATE public.documents
+SET char_length = char_length(raw_text),
+    byte_size = octet_length(raw_text),
+    preview = left(replace(left(raw_text, 600), E'\n\n<<PAGE_BREAK>>\n\n', ' '), 500),
+    page_count = COALESCE(page_count, document_page_count(raw_text)),
+    title = COALESCE(title, document_title(file_path))
+WHERE char_length IS NULL AND raw_text IS NOT NULL;
+
+-- titles that are just a copy of the path (the original loader, and earlier versions of this script)
+UPDATE public.documents SET title = document_title(file_path) WHERE title = file_path;
@@ -0,0 +1,3 @@
+-- Search results name chunks by (document_id, sequence_number), the loader and embed stage delete chunks by document
+CREATE INDEX IF NOT EXISTS idx_chunked_embeddings_document_sequence
+    ON public.chunked_embeddings USING btree (document_id, sequence_number);
@@ -0,0 +1,5 @@
+-- Chunks are stored as character offsets into documents.raw_text instead of a copy of their text,
+-- input_text stays filled only for chunks written before this migration
+ALTER TABLE chunked_embeddings
+    ADD COLUMN IF NOT EXISTS start_offset integer,
+    ADD COLUMN IF NOT EXISTS end_offset integer;
@@ -0,0 +1,2 @@
+-- pipeline_runs keeps the quality metrics of sweep evaluations next to their timing
+ALTER TABLE public.pipeline_runs ADD COLUMN IF NOT EXISTS quality jsonb;
@@ -0,0 +1,11 @@
+-- Fingerprints of the files the loader skips, so an unchanged quarantined or duplicate file costs a stat per scan
+ALTER TABLE public.quarantined_files ADD COLUMN IF NOT EXISTS file_size bigint;
+ALTER TABLE public.quarantined_files ADD COLUMN IF NOT EXISTS file_mtime double precision;
+
+-- PDFs whose content is already loaded from another path
+CREATE TABLE IF NOT EXISTS public.duplicate_files (
+    file_path text PRIMARY KEY,
+    content_hash text NOT NULL,
+    file_size bigint,
+    file_mtime double precision
+);
@@ -0,0 +1,144 @@
+"""
+Parameter sweep evaluations: a 'sweep' job fans a grid of settings out as evaluate_umap / evaluate_chunking jobs
+(see jobs.start_sweep). Each evaluation stores nothing but its pipeline_runs row, with the timing and the quality
+measures it records.
+"""
+import time
+import math
+import numpy as np
+from typing import Optional
+
+from ann import normalize
+from chunking import get_chunker
+from clustering import (fetch_documents, fit_pca, reduce_documents, stratified_sample, create_umap_projection,
+                        cluster_documents, MAX_CHUNK_ROWS)
+from config import (UMAP_N_NEIGHBORS, UMAP_MIN_DIST, HDBSCAN_MIN_CLUSTER_SIZE, HDBSCAN_MIN_SAMPLES, UMAP_SAMPLE_SIZE,
+                    UMAP_PCA_COMPONENTS, UMAP_THREADS, CHUNK_STRATEGY, EMBEDDING_MODEL_NAME, EMBED_BATCH_SIZE,
+                    SWEEP_SAMPLE_DOCUMENTS)
+from db import connect_db
+from embedding import open_embedding_rows, get_embedding_engine
+from metrics import record_progress, record_quality
+
+# documents the silhouette is computed on
+SILHOUETTE_SAMPLE = 10000
+
+def finite(value) -> Optional[float]:
+    """float for a JSON (jsonb) value, None for NaN or infinity"""
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+def cluster_quality(vectors: np.ndarray, labels: np.ndarray, clusterer, random_state=42) -> dict:
+    """Cluster count, noise and largest cluster shares, DBCV and the silhouette of the clusters in vectors"""
+    clustered = labels != -1
+    sizes = np.bincount(labels[clustered]) if clustered.any() else np.zeros(0, dtype=np.int64)
+    n_clusters = int(np.count_nonzero(sizes))
+    quality = {
+        'clusters': n_clusters,
+        'noise_share': finite(np.mean(~clustered)),
+        'largest_cluster_share': finite(sizes.max() / len(labels)) if n_clusters else 0.0,
+        'dbcv': finite(clusterer.relative_validity_),
+    }
+    if 2 <= n_clusters < int(clustered.sum()):
+        from sklearn.metrics import silhouette_score
+        quality['silhouette'] = finite(silhouette_score(
+            vectors[clustered], labels[clustered], sample_size=min(SILHOUETTE_SAMPLE, int(clustered.sum())),
+            random_state=random_state
+        ))
+    return quality
+
+def evaluate_umap(n_neighbors: int = UMAP_N_NEIGHBORS, min_dist: float = UMAP_MIN_DIST,
+                  min_cluster_size: int = HDBSCAN_MIN_CLUSTER_SIZE, min_samples: int = HDBSCAN_MIN_SAMPLES,
+                  sample_size: int = UMAP_SAMPLE_SIZE, pca_components: int = UMAP_PCA_COMPONENTS,
+                  threads: int = UMAP_THREADS, random_state: int = 42):
+    """
+    Fit UMAP and HDBSCAN with these settings on the reduced embeddings of (a stratified sample of
+    sample_size) documents, as the large corpus path of umap does, without storing the result
+    """
+    conn = connect_db()
+    try:
+        doc_ids, _, _ = fetch_documents(conn)
+        vectors, rows = open_embedding_rows(conn, np.array(doc_ids, dtype=np.int64))
+    finally:
+        conn.close()
+    n = len(doc_ids)
+    if n == 0:
+        print("No embedded documents to evaluate")
+        return
+
+    pca = fit_pca(vectors, rows, n, pca_components, sample_size or n, random_state)
+    reduced = reduce_documents(vectors, rows, n, pca, threads, MAX_CHUNK_ROWS)
+    if 0 < sample_size < n:
+        reduced = reduced[stratified_sample(reduced, sample_size, random_state=random_state)]
+    coords, _ = create_umap_projection(reduced, n_neighbors, min_dist, random_state, metric='euclidean')
+    labels, clusterer = cluster_documents(coords, min_cluster_size, threads, min_samples, gen_min_span_tree=True)
+    record_progress(documents=len(reduced))
+    quality = cluster_quality(reduced, labels, clusterer, random_state)
+    print(f"Evaluated umap on {len(reduced)} documents: {quality}")
+    record_quality(**quality)
+
+def evaluate_chunking(chunk_strategy: str = CHUNK_STRATEGY, chunk_size: Optional[int] = None,
+                      chunk_overlap: Optional[int] = None, model_name: str = EMBEDDING_MODEL_NAME,
+                      batch_size: int = EMBED_BATCH_SIZE, documents: int = SWEEP_SAMPLE_DOCUMENTS,
+                      random_state: int = 42):
+    """
+    Chunk and embed a random sample of documents with these settings without storing anything. Records chunk
+    counts and sizes, the share of chunks longer than the model reads, chunking and encoding time, and how
+    close the chunks of a document stay to its mean (coherence) compared to other documents (separation)
+    """
+    conn = connect_db()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id FROM documents WHERE raw_text IS NOT NULL ORDER BY id")
+            ids = np.array([row[0] for row in cur.fetchall()], dtype=np.int64)
+            sample = np.random.default_rng(random_state).choice(ids, size=min(documents, len(ids)), replace=False)
+            cur.execute("SELECT raw_text FROM documents WHERE id = ANY(%s) ORDER BY id", (sample.tolist(),))
+            texts = [row[0] for row in cur.fetchall() if row[0]]
+        conn.commit()
+    finally:
+        conn.close()
+    if not texts:
+        print("No documents to evaluate")
+        return
+
+    engine = get_embedding_engine(model_name)
+    chunker = get_chunker(chunk_strategy, engine.model, chunk_size, chunk_overlap)
+    start = time.perf_counter()
+    doc_chunks = [[text[s:e] for s, e in spans.tolist()] for text, spans in zip(texts, chunker.spans_many(texts))]
+    doc_chunks = [chunks for chunks in doc_chunks if chunks]
+    chunk_seconds = time.perf_counter() - start
+    chunks = [chunk for doc in doc_chunks for chunk in doc]
+
+    default_batch_size, engine.batch_size = engine.batch_size, batch_size
+    try:
+        start = time.perf_counter()
+        # straight to the model, the embedding cache would hide the encoding time of chunks seen before
+        vectors = normalize(engine.encode_batches(chunks))
+        encode_seconds = time.perf_counter() - start
+    finally:
+        engine.batch_size = default_batch_size
+    record_progress(documents=len(doc_chunks), chunks=len(chunks))
+
+    counts = np.array([len(doc) for doc in doc_chunks])
+    doc_rows = np.repeat(np.arange(len(doc_chunks)), counts)
+    means = normalize(np.add.reduceat(vectors, np.cumsum(counts) - counts))
+    coherence = float(np.mean(np.einsum('ij,ij->i', vectors, means[doc_rows])))
+    similarities = means @ means.T
+    others = (similarities.sum() - np.trace(similarities)) / max(len(means) * (len(means) - 1), 1)
+    lengths = np.array([len(chunk) for chunk in chunks])
+    quality = {
+        'chunks_per_document': finite(counts.mean()),
+        'chunk_chars_mean': finite(lengths.mean()),
+        'chunk_chars_p95': finite(np.percentile(lengths, 95)),
+        'chunk_seconds': chunk_seconds,
+        'encode_seconds': encode_seconds,
+        'encoded_chunks_per_second': finite(len(chunks) / encode_seconds) if encode_seconds > 0 else None,
+        'coherence': finite(coherence),
+        'separation': finite(coherence - others),
+    }
+    tokenizer = getattr(engine.model, 'tokenizer', None)
+    max_seq_length = getattr(engine.model, 'max_seq_length', None)
+    if tokenizer is not None and max_seq_length:
+        token_counts = np.array([len(ids) for ids in tokenizer(chunks, truncation=False, verbose=False)['input_ids']])
+        quality['truncated_share'] = finite(np.mean(token_counts > max_seq_length))
+    print(f"Evaluated {chunk_strategy} chunking on {len(doc_chunks)} documents: {quality}")
+    record_quality(**quality)
@@ -0,0 +1,274 @@
+"""terms stage: spaCy term extraction into terms and document_terms"""
+import multiprocessing
+from typing import List, Tuple, Dict, Iterable, Iterator, Optional
+from collections import Counter, deque
+from psycopg2.extras import execute_values
+
+from config import (SPACY_MODEL, SPACY_MAX_LENGTH, SPACY_DISABLED_COMPONENTS, TERMS_PROCESSES,
+                    TERMS_BATCH_SIZE)
+from db import connect_db, iter_documents
+from metrics import record_progress
+from models import cached_model
+
+def terms_from_doc(doc, extract_ngrams: bool = True) -> Counter:
+    """Apply the token and noun chunk filter to a parsed spaCy doc, returns Counter({term: frequency})"""
+    terms = Counter()
+    
+    # Extract nouns, verbs, adjectives (customize as needed)
+    for token in doc:
+        if (not token.is_stop and 
+            not token.is_punct and 
+            not token.is_space and
+            len(token.text) > 1 and
+            token.pos_ in ['NOUN', 'VERB', 'ADJ', 'PROPN'] and
+            token.is_alpha):
+            terms[token.lemma_.lower()] += 1
+    
+    # Extract noun chunks (phrases)
+    if extract_ngrams:
+        for chunk in doc.noun_chunks:
+            if len(chunk.text.split()) > 1:  # Only multi-word phrases
+                clean_chunk = ' '.join(token.lemma_.lower() for token in chunk 
+                                     if not token.is_stop and token.is_alpha)
+                if len(clean_chunk.split()) > 1:  # Ensure we still have multiple words
+                    terms[clean_chunk] += 1
+    
+    return terms
+
+# spaCy pipeline of a term extraction worker process, loaded once by _init_term_worker
+_term_worker_nlp = None
+
+def load_spacy(spacy_model: str = SPACY_MODEL):
+    """The spaCy pipeline for term extraction, loaded once per process"""
+    def load():
+        import spacy
+        nlp = spacy.load(spacy_model, disable=SPACY_DISABLED_COMPONENTS)
+        nlp.max_length = SPACY_MAX_LENGTH
+        return nlp
+    return cached_model(('spacy', spacy_model, tuple(SPACY_DISABLED_COMPONENTS)), load)
+
+def _init_term_worker(spacy_model: str):
+    global _term_worker_nlp
+    _term_worker_nlp = load_spacy(spacy_model)
+
+def _extract_terms_worker(batch: List[Tuple[int, str]]) -> List[Tuple[int, Counter]]:
+    """Runs in a worker process, parses a batch with nlp.pipe and hands back only the term counts"""
+    nlp = _term_worker_nlp
+    try:
+        docs = nlp.pipe((text for _, text in batch), batch_size=len(batch))
+        return [(doc_id, terms_from_doc(doc)) for (doc_id, _), doc in zip(batch, docs)]
+    except Exception:
+        # one bad text fails the whole pipe call, retry the batch one document at a time
+        results = []
+        for doc_id, text in batch:
+            try:
+                results.append((doc_id, terms_from_doc(nlp(text))))
+            except Exception as e:
+                print(f"Got an exception with a text of {len(text)} chars: {e}")
+                results.append((doc_id, Counter()))
+        return results
+
+class TermProcessor:
+    def __init__(self, db_connection, spacy_model=SPACY_MODEL):
+        self.conn = db_connection
+        self.spacy_model = spacy_model
+        self.nlp = load_spacy(spacy_model)
+        # term_text -> id of the terms this processor has stored, filled batch by batch
+        self.term_ids: Dict[str, int] = {}
+    
+    def _resolve_term_ids(self, term_texts: Iterable[str]) -> Dict[str, int]:
+        """
+        Make sure every term has an id: terms not seen yet are looked up in one query and the unknown ones
+        inserted with one set-based upsert, so a sub-task never loads the whole term dictionary.
+        Returns the term_text -> id dictionary (self.term_ids)
+        """
+        new_terms = sorted(set(t for t in term_texts if t not in self.term_ids))
+        if not new_terms:
+            return self.term_ids
+        
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT term_text, id FROM terms WHERE term_text = ANY(%s)", (new_terms,))
+            self.term_ids.update(cur.fetchall())
+            new_terms = [t for t in new_terms if t not in self.term_ids]
+            if not new_terms:
+                return self.term_ids
+            
+            term_types = ['phrase' if ' ' in t else 'word' for t in new_terms]
+            cur.execute(
+                """INSERT INTO terms (term_text, term_type)
+                   SELECT * FROM unnest(%s::text[], %s::varchar[])
+                   ON CONFLICT (term_text) DO NOTHING
+                   RETURNING term_text, id""",
+                (new_terms, term_types)
+            )
+            self.term_ids.update(cur.fetchall())
+            
+            # terms inserted concurrently by another worker are not returned by DO NOTHING, fetch them
+            missing = [t for t in new_terms if t not in self.term_ids]
+            if missing:
+                cur.execute("SELECT term_text, id FROM terms WHERE term_text = ANY(%s)", (missing,))
+                self.term_ids.update(cur.fetchall())
+        return self.term_ids
+    
+    def _get_or_create_term_id(self, term_text: str, term_type: str = 'word') -> int:
+        """Get existing term ID or create new term, returns term_id"""
+        return self._resolve_term_ids([term_text])[term_text]
+    
+    def extract_terms_from_text(self, text: str, extract_ngrams: bool = True) -> Dict[str, int]:
+        """Extract terms from text using spaCy, returns {term: frequency}"""
+        doc = None
+        try:
+            doc = self.nlp(text)
+        except Exception as e:
+            print( f"Got an exception with a text of {len(text)} chars")
+            return {}
+        
+        return dict(terms_from_doc(doc, extract_ngrams))
+    
+    def extract_terms_parallel(self, documents: Iterable[Tuple[int, str]], n_process: int = TERMS_PROCESSES,
+                               batch_size: int = TERMS_BATCH_SIZE) -> Iterator[Tuple[int, Counter]]:
+        """
+        Extract terms on n_process worker processes, each running nlp.pipe over batches of batch_size documents.
+        Only the compact per-document Counters come back to this process, yields (document_id, Counter)
+        """
+        def batches():
+            batch = []
+            for doc_id, text in documents:
+                batch.append((doc_id, text or ""))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        
+        # imap would drain the whole document stream into the task queue, so keep a bounded window in flight
+        # not fork: the heartbeat and metrics threads may hold a lock at that moment, the children load spaCy anyway
+        ctx = multiprocessing.get_context('forkserver')
+        with ctx.Pool(n_process, initializer=_init_term_worker, initargs=(self.spacy_model,)) as pool:
+            pending = deque()
+            for batch in batches():
+                pending.append(pool.apply_async(_extract_terms_worker, (batch,)))
+                if len(pending) >= 2 * n_process:
+                    yield from pending.popleft().get()
+            while pending:
+                yield from pending.popleft().get()
+    
+    def process_document(self, document_id: int, text: str, batch_mode: bool = False):
+        """Process a single document and store its terms"""
+        terms_freq = self.extract_terms_from_text(text)
+        
+        term_ids = self._resolve_term_ids(terms_freq)
+        term_associations = [
+            (document_id, term_ids[term_text], frequency) for term_text, frequency in terms_freq.items()
+        ]
+        
+        # Batch insert document-term associations
+        with self.conn.cursor() as cur:
+            execute_values(
+                cur,
+                """INSERT INTO document_terms (document_id, term_id, frequency) 
+                   VALUES %s 
+                   ON CONFLICT (document_id, term_id) 
+                   DO UPDATE SET frequency = EXCLUDED.frequency""",
+                term_associations
+            )
+        
+        if not batch_mode:
+            self.conn.commit()
+    
+    def process_documents_batch(self, documents_batch: List[tuple]):
+        """Process multiple documents in a batch for efficiency"""
+        # documents_batch should be [(document_id, text), ...]
+        print( "entering process batch")
+        self.process_term_counts(
+            [(doc_id, self.extract_terms_from_text(text)) for doc_id, text in documents_batch]
+        )
+    
+    def process_term_counts(self, documents_terms: List[Tuple[int, Dict[str, int]]]):
+        """Store already extracted terms, documents_terms should be [(document_id, {term: frequency}), ...]"""
+        # Resolve every distinct term of the batch in one round-trip
+        term_ids = self._resolve_term_ids(
+            term_text for _, terms_freq in documents_terms for term_text in terms_freq
+        )
+        all_associations = [
+            (doc_id, term_ids[term_text], frequency)
+            for doc_id, terms_freq in documents_terms
+            for term_text, frequency in terms_freq.items()
+        ]
+        
+        # Massive batch insert
+        with self.conn.cursor() as cur:
+            execute_values(
+                cur,
+                """INSERT INTO document_terms (document_id, term_id, frequency) 
+                   VALUES %s 
+                   ON CONFLICT (document_id, term_id) 
+                   DO UPDATE SET frequency = EXCLUDED.frequency""",
+                all_associations
+            )
+        
+        self.conn.commit()
+        record_progress(documents=len(documents_terms))
+        print(f"Processed {len(documents_terms)} documents, {len(all_associations)} term associations")
+
+def terms_parallel(conn, processor: TermProcessor, scope: str = "", params=None, processes: int = TERMS_PROCESSES,
+                   batch_size: int = TERMS_BATCH_SIZE):
+    """Fan term extraction out over processes processes, DB writes stay in this process"""
+    read_conn = connect_db()
+    documents = iter_documents(
+        read_conn,
+        "SELECT id, raw_text FROM documents WHERE id NOT IN (SELECT DISTINCT document_id FROM document_terms)" + scope,
+        params,
+        name='term_documents'
+    )
+    print(f"Extracting terms with {processes} processes")
+    
+    batch, n_docs = [], 0
+    try:
+        for doc_id, terms_freq in processor.extract_terms_parallel(documents, processes, batch_size):
+            batch.append((doc_id, terms_freq))
+            if len(batch) >= batch_size:
+                processor.process_term_counts(batch)
+                n_docs += len(batch)
+                batch = []
+        if batch:
+            processor.process_term_counts(batch)
+            n_docs += len(batch)
+    finally:
+        read_conn.close()
+    print(f"Extracted terms for {n_docs} documents")
+
+def terms(document_ids: Optional[List[int]] = None, processes: int = TERMS_PROCESSES,
+          batch_size: int = TERMS_BATCH_SIZE):
+    """
+    Extract terms of every document without terms, or only those of document_ids (a job queue sub-task),
+    on processes processes (1 keeps the serial path) in batches of batch_size documents
+    """
+    # Database connection
+    conn = connect_db()
+    scope, params = "", None
+    if document_ids is not None:
+        scope, params = " AND id = ANY(%s)", (list(document_ids),)
+    
+    # Initialize processor
+    print( "about to init term processor")
+    processor = TermProcessor(conn)
+    print( "done to init term processor")
+    
+    if processes > 1:
+        terms_parallel(conn, processor, scope, params, processes, batch_size)
+        conn.close()
+        return
+    
+    # Get documents to process
+    with conn.cursor() as cur:
+        cur.execute("SELECT id, raw_text FROM documents WHERE id NOT IN (SELECT DISTINCT document_id FROM document_terms)" + scope, params)
+        documents = cur.fetchall()
+    print( f"There are {len(documents)} to process ")
+    # Process in batches
+    for i in range(0, len(documents), batch_size):
+        batch = documents[i:i + batch_size]
+        processor.process_documents_batch(batch)
+        print(f"Completed batch {i//batch_size + 1}/{(len(documents)-1)//batch_size + 1}")
+    
+    conn.close()
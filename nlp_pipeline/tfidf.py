@@ -0,0 +1,143 @@
+"""tf_idf stage: class based tf-idf labels, in SQL procedures or with scipy sparse matrices"""
+import io
+import time
+import numpy as np
+from typing import Tuple, Iterator, TYPE_CHECKING
+
+from config import TFIDF_MODE, TFIDF_FULL_REBUILD_RATIO, TFIDF_ENGINE, TFIDF_WEIGHTING, TFIDF_TOP_K
+from db import connect_db, copy_int_columns, copy_text_escape, bump_pipeline_version
+
+if TYPE_CHECKING:
+    from scipy import sparse
+
+def topic_term_matrix(conn) -> Tuple[np.ndarray, 'sparse.csr_matrix']:
+    """
+    Sum term frequencies per topic: a doc x term CSR matrix from document_terms, multiplied by the
+    topic x doc membership matrix from document_topics. Returns (topic ids, topic x term CSR matrix),
+    term ids are used as column indices
+    """
+    from scipy import sparse
+    doc_ids, term_ids, frequencies = copy_int_columns(
+        conn,
+        "SELECT document_id, term_id, frequency FROM document_terms WHERE document_id IS NOT NULL AND term_id IS NOT NULL",
+        3
+    )
+    topic_doc_ids, doc_topic_ids = copy_int_columns(conn, "SELECT document_id, topic_id FROM document_topics", 2)
+    conn.commit()
+
+    n_docs = int(max(doc_ids.max(initial=-1), topic_doc_ids.max(initial=-1))) + 1
+    n_terms = int(term_ids.max(initial=-1)) + 1
+    doc_terms = sparse.csr_matrix((frequencies.astype(np.float64), (doc_ids, term_ids)), shape=(n_docs, n_terms))
+    del doc_ids, term_ids, frequencies
+
+    topic_ids, topic_rows = np.unique(doc_topic_ids, return_inverse=True)
+    membership = sparse.csr_matrix(
+        (np.ones(len(topic_rows)), (topic_rows, topic_doc_ids)), shape=(len(topic_ids), n_docs)
+    )
+    return topic_ids, (membership @ doc_terms).tocsr()
+
+def class_tfidf_scores(topic_terms: 'sparse.csr_matrix', n_topics: int, weighting: str = TFIDF_WEIGHTING) -> 'sparse.csr_matrix':
+    """
+    Score every non-zero (topic, term) cell.
+    legacy: tf * ln(n_topics / df) with the integer division refresh_topic_tables() does, df = topics containing the term
+    ctfidf: (tf / topic size) * ln(1 + average topic size / term frequency over all topics)
+    """
+    scores = topic_terms.copy()
+    columns = topic_terms.indices
+    if weighting == 'legacy':
+        df = np.bincount(columns, minlength=topic_terms.shape[1])
+        scores.data = topic_terms.data * np.log(n_topics // np.maximum(df[columns], 1))
+    elif weighting == 'ctfidf':
+        topic_sizes = np.asarray(topic_terms.sum(axis=1)).ravel()
+        term_totals = np.asarray(topic_terms.sum(axis=0)).ravel()
+        average_size = topic_sizes.mean() if len(topic_sizes) else 0.0
+        rows = np.repeat(np.arange(topic_terms.shape[0]), np.diff(topic_terms.indptr))
+        scores.data = (topic_terms.data / np.maximum(topic_sizes[rows], 1)) * np.log1p(average_size / term_totals[columns])
+    else:
+        raise ValueError(f"Unknown tf-idf weighting: {weighting}")
+    return scores
+
+def top_k_per_topic(scores: 'sparse.csr_matrix', top_k: int) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+    """Yield (topic row, term ids, scores) with the top_k highest scores of each topic, best first"""
+    for row in range(scores.shape[0]):
+        start, end = scores.indptr[row], scores.indptr[row + 1]
+        values = scores.data[start:end]
+        if len(values) == 0:
+            continue
+        if len(values) > top_k:
+            best = np.argpartition(-values, top_k - 1)[:top_k]
+        else:
+            best = np.arange(len(values))
+        best = best[np.argsort(-values[best], kind='stable')]
+        yield row, scores.indices[start:end][best], values[best]
+
+def tf_idf_sparse(top_k: int = TFIDF_TOP_K, weighting: str = TFIDF_WEIGHTING):
+    """
+    Compute topic_top_terms in memory and replace it in one transaction. The other topic tables are left alone
+    and marked for a full rebuild by the next SQL refresh, their labels are no longer the ones in topic_top_terms
+    """
+    conn = connect_db()
+    try:
+        start = time.time()
+        # the topic count, document_terms and document_topics from one snapshot
+        conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        with conn.cursor() as cur:
+            cur.execute("SELECT COUNT(id) FROM topics")
+            n_topics = cur.fetchone()[0]
+        topic_ids, topic_terms = topic_term_matrix(conn)
+        conn.set_session(isolation_level='DEFAULT', readonly=False)
+        print(f"Loaded {topic_terms.nnz} (topic, term) pairs for {len(topic_ids)} topics in {time.time() - start:.1f}s")
+
+        scores = class_tfidf_scores(topic_terms, n_topics, weighting)
+        top_terms = list(top_k_per_topic(scores, top_k))
+        term_ids = np.unique(np.concatenate([terms for _, terms, _ in top_terms])) if top_terms else np.empty(0)
+
+        with conn.cursor() as cur:
+            cur.execute("SELECT id, term_text FROM terms WHERE id = ANY(%s)", (term_ids.tolist(),))
+            term_texts = dict(cur.fetchall())
+            buffer = io.StringIO()
+            for row, terms, values in top_terms:
+                for rank, (term_id, value) in enumerate(zip(terms.tolist(), values.tolist()), start=1):
+                    buffer.write(f"{topic_ids[row]}\t{copy_text_escape(term_texts[term_id])}\t{value!r}\t{rank}\n")
+            buffer.seek(0)
+            cur.execute("DELETE FROM topic_top_terms")
+            cur.copy_expert("COPY topic_top_terms (topic_id, term_text, tf_idf, rank) FROM STDIN", buffer)
+            # the incremental SQL refresh would re-rank only changed topics next to these rows, make it rebuild
+            cur.execute("UPDATE ctfidf_state SET n_topics = NULL")
+            bump_pipeline_version(cur)
+        conn.commit()
+        print(f"Saved top {top_k} {weighting} terms for {len(top_terms)} topics in {time.time() - start:.1f}s")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def tf_idf(mode: str = TFIDF_MODE, engine: str = TFIDF_ENGINE, weighting: str = TFIDF_WEIGHTING,
+           top_k: int = TFIDF_TOP_K, full_rebuild_ratio: float = TFIDF_FULL_REBUILD_RATIO):
+    """
+    Refresh the topic labels: engine 'sql' runs the refresh procedures (mode 'full' or 'incremental', the legacy
+    weighting), 'python' computes topic_top_terms with tf_idf_sparse. top_k terms are kept per topic
+    """
+    if mode not in ('full', 'incremental'):
+        raise ValueError(f"Unknown tf-idf mode: {mode}")
+    if engine == 'python':
+        tf_idf_sparse(top_k, weighting)
+        return
+    if engine != 'sql':
+        raise ValueError(f"Unknown tf-idf engine: {engine}")
+    # Database connection
+    conn = connect_db()
+    # one snapshot for the whole refresh, changes committed meanwhile stay queued for the next run
+    conn.set_session(isolation_level='REPEATABLE READ')
+    cur = conn.cursor()
+    if mode == 'full':
+        cur.execute( "call refresh_topic_tables(%s);", (top_k,) )
+    else:
+        cur.execute( "call refresh_topic_tables_incremental(%s, %s);", (full_rebuild_ratio, top_k) )
+    for notice in conn.notices:
+        print(notice.strip())
+    bump_pipeline_version(cur)
+    conn.commit()
+    cur.close()
+    conn.close()